@@ -13,4 +13,18 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'DSI_COM.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from whatsapp_manager import http_client, outbound_queue, webhook_queue  # noqa: E402
+
+
+async def application(scope, receive, send):
+    # El loop del servidor ASGI vive todo el proceso: las llamadas HTTP async comparten un cliente keep-alive
+    http_client.registrar_loop_servidor()
+    await django_application(scope, receive, send)
+
+
+# Con la cola del webhook en este proceso, se vacía lo pendiente al arrancar;
+# la cola de salida adopta los mensajes que otro proceso dejó sin enviar
+webhook_queue.iniciar_en_proceso()
+outbound_queue.iniciar_mantenimiento()
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/6.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -121,3 +122,125 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/6.0/howto/static-files/
 
 STATIC_URL = 'static/'
+
+
+# --- WHATSAPP: COLA DEL WEBHOOK ---
+# Si está activo, el webhook solo guarda los mensajes (WebhookEvent) y responde 200;
+# un pool de workers los procesa en segundo plano manteniendo el orden por conexión.
+WHATSAPP_WEBHOOK_ASYNC = True
+WHATSAPP_WEBHOOK_WORKERS = 4
+WHATSAPP_WEBHOOK_MAX_INTENTOS = 3
+WHATSAPP_WEBHOOK_INTERVALO_SONDEO = 2.0  # segundos
+# False si los workers corren aparte con: python manage.py run_webhook_workers
+WHATSAPP_WEBHOOK_WORKERS_EN_PROCESO = True
+# Plazo de un evento en curso: su proceso lo renueva cada LEASE/3 s; si muere, al vencer lo retoma otro
+WHATSAPP_WEBHOOK_LEASE = 300
+
+# --- WHATSAPP: LOG CRUDO DEL WEBHOOK (WebhookLog) ---
+# Muestreo por tipo de POST y retención; archivar con: python manage.py archive_webhook_logs (p. ej. en cron diario)
+WHATSAPP_WEBHOOK_LOG = {
+    'RETENCION_DIAS': 7,
+    'MUESTREO': {'messages': 1.0, 'statuses': 0.1, 'other': 1.0},
+    'DIRECTORIO_ARCHIVO': BASE_DIR / 'webhook_archive',
+    'LOTE': 1000,
+    'PAUSA': 0.05,  # segundos entre lotes de borrado
+}
+
+# --- WHATSAPP: SERVICIOS EXTERNOS ---
+# URLs base configurables (p. ej. para apuntar a un servidor falso con: python manage.py bench_async_http)
+WHATSAPP_GRAPH_API_URL = os.environ.get('WHATSAPP_GRAPH_API_URL', 'https://graph.facebook.com/v18.0')
+DSI_API_URL = os.environ.get('DSI_API_URL', 'https://dsi-a.datametric-dsi.com/api/chat/')
+
+# --- WHATSAPP: CLIENTE HTTP SALIENTE ---
+# Pool keep-alive por host, timeouts (conexión, lectura) y reintentos con backoff
+# (429/5xx en GET y demás idempotentes; en POST solo 429, el resto lo decide la cola de salida).
+WHATSAPP_HTTP_CLIENT = {
+    'POOL_MAXSIZE': 20,
+    'MAX_CONEXIONES_ASYNC': 200,  # llamadas en vuelo a la vez desde las vistas async (ASGI)
+    'TIMEOUT': (5, 30),
+    'TIMEOUTS_POR_HOST': {
+        'graph.facebook.com': (5, 20),
+        'dsi-a.datametric-dsi.com': (5, 30),
+        'datmail.datametric-dsi.com': (5, 10),
+    },
+    'REINTENTOS': 3,
+    'BACKOFF': 0.5,
+    'MAX_RETRY_AFTER': 30,  # tope en segundos del Retry-After que pida el servidor
+}
+
+# --- WHATSAPP: MULTIMEDIA RECIBIDA ---
+# Descargas en streaming, guardadas por sha256 en MEDIA_ROOT/whatsapp_received (caché LRU con presupuesto).
+WHATSAPP_MEDIA = {
+    'MAX_BYTES': {
+        'image': 5 * 1024 * 1024,
+        'audio': 16 * 1024 * 1024,
+        'video': 16 * 1024 * 1024,
+        'document': 100 * 1024 * 1024,
+        'sticker': 500 * 1024,
+    },
+    'TIEMPO_MAXIMO': 120,  # segundos por descarga
+    'DESCARGAS_SIMULTANEAS': 4,
+    # True: solo se guarda el media_id y el archivo se descarga al abrirlo (/whatsapp/media/<id>/)
+    'BAJO_DEMANDA': True,
+    # Tamaño máximo de la caché en disco; se borran primero los archivos usados hace más tiempo
+    'PRESUPUESTO_BYTES': 2 * 1024 * 1024 * 1024,
+}
+
+# --- WHATSAPP: DETECCIÓN DE DUPLICADOS ---
+# Caché en memoria de wamids recientes (los reintentos de Meta no llegan a la base de datos)
+WHATSAPP_DEDUP_CACHE_MAX = 50000
+WHATSAPP_DEDUP_CACHE_TTL = 86400  # segundos
+
+# --- WHATSAPP: REGISTRO DE CONEXIONES ---
+# Segundos que el webhook reutiliza la conexión (y su chatbot) resuelta por phone_number_id / verify_token
+WHATSAPP_CONNECTION_CACHE_TTL = 60
+
+# --- WHATSAPP: BANDEJA DEL CHAT ---
+WHATSAPP_INBOX_PAGE_SIZE = 50
+WHATSAPP_THREAD_PAGE_SIZE = 50  # Mensajes por página en el hilo ("Cargar anteriores")
+
+# --- WHATSAPP: ACTUALIZACIONES EN VIVO (SSE) ---
+# Requiere servir con ASGI (DSI_COM.asgi, p. ej. uvicorn/daphne); con WSGI el inspector vuelve al sondeo.
+WHATSAPP_LIVE_MAX_PENDIENTES = 200  # eventos en cola por pestaña antes de descartar los más viejos
+WHATSAPP_LIVE_LATIDO = 15  # segundos entre pings para mantener la conexión abierta
+
+# --- WHATSAPP: COLA DE SALIDA ---
+# Límite por línea (token bucket), hilos de envío y reintentos ante fallos transitorios (red, 429, 5xx).
+WHATSAPP_OUTBOUND = {
+    'TASA_API': 20,  # mensajes/segundo por línea de Cloud API
+    'RAFAGA_API': 40,
+    'CONCURRENCIA_API': 4,
+    'TASA_BROWSER': 0.5,  # WhatsApp Web: un mensaje cada 2 segundos
+    'RAFAGA_BROWSER': 3,
+    'MAX_INTENTOS': 4,
+    'BACKOFF': 2,  # segundos, se duplica en cada reintento
+    'PLAZO_RECLAMO': 120,  # sin latidos de su proceso en este tiempo, otro proceso adopta los mensajes
+    'PROCESOS': 1,  # procesos web/workers que envían a la vez: la tasa de cada línea se reparte entre ellos
+}
+
+# --- WHATSAPP: SUPERVISOR DE NAVEGADORES (bot de WhatsApp Web) ---
+# El tope de Chromium abiertos se fija con la variable de entorno BOT_MAX_NAVEGADORES (10 por defecto).
+WHATSAPP_BROWSER_SUPERVISOR = {
+    'INTERVALO': 15,  # segundos entre revisiones
+    'INACTIVIDAD_HIBERNAR': 600,  # cerrar Chrome de sesiones sin bot tras 10 min sin uso
+    'BACKOFF_BASE': 5,  # relanzamiento de bots caídos: 5s, 10s, 20s... hasta BACKOFF_MAX
+    'BACKOFF_MAX': 300,
+    'ESTABLE_TRAS': 300,
+    'MAX_FALLOS': 10,  # tras 10 caídas seguidas (o un QR sin escanear) no se relanza solo
+}
+# False si los navegadores corren aparte con: python manage.py run_bot_browser
+# (el web le envía las órdenes de QR/estado/envío por la tabla BotCommand)
+WHATSAPP_BOT_EN_PROCESO = True
+WHATSAPP_BOT_TIMEOUT_COMANDO = 20  # segundos que el web espera la respuesta del worker
+
+# --- API REST ---
+API_MESSAGES_MAX_PAGE_SIZE = 200  # Tope de ?limit= en /api/v1/messages/
+API_CHANGES_MAX_BATCH = 1000  # Tope de ?limit= en /api/v1/changes/
+# Segundos antes de publicar un cambio en /api/v1/changes/ (transacciones que confirman fuera de orden de id)
+API_CHANGES_VENTANA = 5
+API_BROADCAST_MAX_RECIPIENTS = 100000  # Destinatarios por envío masivo (/api/v1/broadcast/)
+# Firma de los JWT (HS256). Si queda vacío los tokens se aceptan sin verificar la firma.
+API_JWT_SECRET = os.environ.get('API_JWT_SECRET', '')
+API_JWT_ALGORITHMS = ['HS256']
+API_AUTH_CACHE_TTL = 300  # segundos que se reutiliza un token ya verificado
+API_AUTH_CACHE_MAX = 10000
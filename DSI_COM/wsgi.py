@@ -14,3 +14,10 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'DSI_COM.settings')
 
 application = get_wsgi_application()
+
+# Con la cola del webhook en este proceso, se vacía lo pendiente al arrancar;
+# la cola de salida adopta los mensajes que otro proceso dejó sin enviar
+from whatsapp_manager import outbound_queue, webhook_queue  # noqa: E402
+
+webhook_queue.iniciar_en_proceso()
+outbound_queue.iniciar_mantenimiento()
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class ApiManagerConfig(AppConfig):
     name = 'api_manager'
+
+    def ready(self):
+        # Conecta las señales del change feed y de la caché de autenticación
+        from . import authentication, changefeed  # noqa: F401
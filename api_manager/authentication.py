@@ -0,0 +1,208 @@
+"""
+Autenticación JWT para la API REST.
+
+Una sola clase de DRF reemplaza la decodificación manual que hacía cada vista:
+verifica la firma del token (HS256/384/512 con settings.API_JWT_SECRET) y su expiración,
+resuelve el ApiClient del 'sub' y guarda ambos en una caché en memoria con TTL.
+Mientras el token esté en caché, la autenticación no hace ninguna consulta a la base de datos.
+La caché se invalida al guardar o borrar el ApiClient (p. ej. al desactivarlo).
+"""
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework import exceptions
+from rest_framework.authentication import BaseAuthentication
+
+from api_manager.models import ApiClient
+
+logger = logging.getLogger(__name__)
+
+ALGORITMOS_HMAC = {
+    'HS256': hashlib.sha256,
+    'HS384': hashlib.sha384,
+    'HS512': hashlib.sha512,
+}
+
+
+def _b64decode(segmento):
+    return base64.urlsafe_b64decode(segmento + '=' * (-len(segmento) % 4))
+
+
+_aviso_emitido = False
+
+
+def _avisar_sin_secreto():
+    global _aviso_emitido
+    if not _aviso_emitido:
+        _aviso_emitido = True
+        logger.warning("⚠️ API_JWT_SECRET no configurado: los tokens se aceptan sin verificar la firma.")
+
+
+def verificar_jwt(token):
+    """Decodifica y valida el token. Lanza AuthenticationFailed si no es válido."""
+    try:
+        header_b64, payload_b64, firma_b64 = token.split('.')
+        header = json.loads(_b64decode(header_b64))
+        payload = json.loads(_b64decode(payload_b64))
+    except (ValueError, TypeError):
+        raise exceptions.AuthenticationFailed("Token inválido")
+
+    if not isinstance(payload, dict) or 'sub' not in payload:
+        raise exceptions.AuthenticationFailed("Token inválido o sin 'sub'")
+
+    secreto = getattr(settings, 'API_JWT_SECRET', '')
+    if secreto:
+        algoritmo = header.get('alg') if isinstance(header, dict) else None
+        if algoritmo not in getattr(settings, 'API_JWT_ALGORITHMS', ['HS256']) or algoritmo not in ALGORITMOS_HMAC:
+            raise exceptions.AuthenticationFailed("Algoritmo de firma no permitido")
+
+        esperada = hmac.new(secreto.encode(), f"{header_b64}.{payload_b64}".encode(), ALGORITMOS_HMAC[algoritmo])
+        try:
+            firma = _b64decode(firma_b64)
+        except ValueError:
+            raise exceptions.AuthenticationFailed("Firma inválida")
+        if not hmac.compare_digest(esperada.digest(), firma):
+            raise exceptions.AuthenticationFailed("Firma inválida")
+    else:
+        _avisar_sin_secreto()
+
+    ahora = time.time()
+    if isinstance(payload.get('exp'), (int, float)) and payload['exp'] < ahora:
+        raise exceptions.AuthenticationFailed("Token expirado")
+    if isinstance(payload.get('nbf'), (int, float)) and payload['nbf'] > ahora:
+        raise exceptions.AuthenticationFailed("Token aún no válido")
+
+    return payload
+
+
+class CacheTokens:
+    """
+    Caché token -> (payload, ApiClient) con TTL y tamaño acotado.
+    Se indexa por hash del token para no guardar credenciales en claro.
+    """
+
+    def __init__(self, ttl=300, max_items=10000):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._datos = OrderedDict()
+        self._por_cliente = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _clave(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def obtener(self, token):
+        clave = self._clave(token)
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                return None
+            expira, payload, client = entrada
+            if expira < time.monotonic():
+                self._quitar(clave)
+                return None
+            self._datos.move_to_end(clave)
+            return payload, client
+
+    def guardar(self, token, payload, client):
+        ttl = self.ttl
+        if isinstance(payload.get('exp'), (int, float)):
+            # Nunca mantener en caché un token más allá de su expiración
+            ttl = min(ttl, payload['exp'] - time.time())
+        if ttl <= 0:
+            return
+
+        clave = self._clave(token)
+        with self._lock:
+            self._datos[clave] = (time.monotonic() + ttl, payload, client)
+            self._datos.move_to_end(clave)
+            self._por_cliente.setdefault(client.pk, set()).add(clave)
+            while len(self._datos) > self.max_items:
+                self._quitar(next(iter(self._datos)))
+
+    def invalidar_cliente(self, client_id):
+        with self._lock:
+            for clave in list(self._por_cliente.get(client_id, ())):
+                self._quitar(clave)
+
+    def _quitar(self, clave):
+        entrada = self._datos.pop(clave, None)
+        if entrada is not None:
+            claves = self._por_cliente.get(entrada[2].pk)
+            if claves is not None:
+                claves.discard(clave)
+                if not claves:
+                    del self._por_cliente[entrada[2].pk]
+
+
+cache_tokens = CacheTokens(
+    ttl=getattr(settings, 'API_AUTH_CACHE_TTL', 300),
+    max_items=getattr(settings, 'API_AUTH_CACHE_MAX', 10000),
+)
+
+
+class ApiClientJWTAuthentication(BaseAuthentication):
+    """
+    Autentica 'Authorization: Bearer <jwt>'.
+    request.user es el ApiClient y request.auth el payload del token.
+    """
+    auto_provision = False
+
+    def authenticate(self, request):
+        auth_header = request.headers.get('Authorization', '')
+        if not auth_header.startswith('Bearer '):
+            return None
+
+        token = auth_header[len('Bearer '):].strip()
+        entrada = cache_tokens.obtener(token)
+        if entrada is None:
+            payload = verificar_jwt(token)
+            client = self.resolver_cliente(payload)
+            cache_tokens.guardar(token, payload, client)
+        else:
+            payload, client = entrada
+
+        if not client.is_active:
+            raise exceptions.PermissionDenied("Cliente inactivo")
+        return client, payload
+
+    def resolver_cliente(self, payload):
+        client_api_key = payload['sub']
+        if self.auto_provision:
+            client_name = payload.get('username', payload.get('name', f"Cliente {client_api_key}"))
+            client, created = ApiClient.objects.get_or_create(
+                api_key=client_api_key,
+                defaults={'name': client_name, 'is_active': True}
+            )
+            if created:
+                logger.info(f"✨ Cliente nuevo creado automáticamente: {client.name}")
+            return client
+
+        try:
+            return ApiClient.objects.get(api_key=client_api_key)
+        except ApiClient.DoesNotExist:
+            raise exceptions.PermissionDenied("Cliente no registrado")
+
+    def authenticate_header(self, request):
+        return 'Bearer realm="api"'
+
+
+class ProvisioningJWTAuthentication(ApiClientJWTAuthentication):
+    """Igual que la anterior, pero crea el ApiClient la primera vez que aparece un 'sub'."""
+    auto_provision = True
+
+
+@receiver(post_save, sender=ApiClient, dispatch_uid='auth_cache_client_saved')
+@receiver(post_delete, sender=ApiClient, dispatch_uid='auth_cache_client_deleted')
+def invalidar_cache_cliente(sender, instance, **kwargs):
+    cache_tokens.invalidar_cliente(instance.pk)
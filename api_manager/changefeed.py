@@ -0,0 +1,75 @@
+"""
+Change feed para sincronización incremental (/api/v1/changes/).
+
+Cada alta, modificación o baja de Message y WhatsappConnection deja una fila en ChangeEvent.
+Los guardados normales llegan por señales; las escrituras masivas (bulk_create, update) deben
+llamar explícitamente a registrar_cambios porque Django no emite señales para ellas.
+"""
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from api_manager.models import ApiClient, ChangeEvent
+from whatsapp_manager.models import Message, WhatsappConnection
+
+
+def _clientes_por_conexion(mensajes):
+    # Si el mensaje ya trae la conexión cargada evitamos la consulta
+    clientes = {m.connection_id: m.connection.client_id for m in mensajes if Message.connection.is_cached(m)}
+    faltantes = {m.connection_id for m in mensajes} - set(clientes)
+    if faltantes:
+        clientes.update(WhatsappConnection.objects.filter(id__in=faltantes).values_list('id', 'client_id'))
+    return clientes
+
+
+def registrar_cambios(entity, objetos, action='upsert'):
+    """
+    Registra en bloque los cambios de una lista de Message o WhatsappConnection.
+    Las conexiones sin cliente (creadas desde el panel) no generan eventos: nadie las sincroniza.
+    """
+    objetos = list(objetos)
+    if not objetos:
+        return
+
+    if entity == 'connection':
+        filas = [
+            ChangeEvent(client_id=obj.client_id, entity=entity, action=action, object_id=obj.id, connection_id=obj.id)
+            for obj in objetos if obj.client_id
+        ]
+    else:
+        clientes = _clientes_por_conexion(objetos)
+        filas = [
+            ChangeEvent(client_id=clientes[obj.connection_id], entity=entity, action=action, object_id=obj.id,
+                        connection_id=obj.connection_id)
+            for obj in objetos if clientes.get(obj.connection_id)
+        ]
+
+    ChangeEvent.objects.bulk_create(filas, batch_size=500)
+
+
+@receiver(post_save, sender=Message, dispatch_uid='changefeed_message_saved')
+def message_guardado(sender, instance, raw=False, **kwargs):
+    if not raw:
+        registrar_cambios('message', [instance])
+
+
+def _borrado_por_cliente(origin):
+    # Si se borra el ApiClient completo su feed desaparece con él (cascada sobre ChangeEvent)
+    return isinstance(origin, ApiClient) or getattr(origin, 'model', None) is ApiClient
+
+
+@receiver(post_delete, sender=Message, dispatch_uid='changefeed_message_deleted')
+def message_borrado(sender, instance, origin=None, **kwargs):
+    if not _borrado_por_cliente(origin):
+        registrar_cambios('message', [instance], action='delete')
+
+
+@receiver(post_save, sender=WhatsappConnection, dispatch_uid='changefeed_connection_saved')
+def connection_guardada(sender, instance, raw=False, **kwargs):
+    if not raw:
+        registrar_cambios('connection', [instance])
+
+
+@receiver(post_delete, sender=WhatsappConnection, dispatch_uid='changefeed_connection_deleted')
+def connection_borrada(sender, instance, origin=None, **kwargs):
+    if not _borrado_por_cliente(origin):
+        registrar_cambios('connection', [instance], action='delete')
@@ -0,0 +1,30 @@
+# Generated by Django 6.0 on 2026-10-17 18:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api_manager', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entity', models.CharField(choices=[('message', 'Mensaje'), ('connection', 'Conexión')], max_length=20)),
+                ('action', models.CharField(choices=[('upsert', 'Alta/Modificación'), ('delete', 'Baja')], default='upsert', max_length=10)),
+                ('object_id', models.BigIntegerField()),
+                ('connection_id', models.BigIntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('client', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='change_events', to='api_manager.apiclient')),
+            ],
+            options={
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['client', 'id'], name='change_event_feed_idx')],
+            },
+        ),
+    ]
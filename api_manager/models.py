@@ -11,5 +11,32 @@ class ApiClient(models.Model):
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # DRF usa el ApiClient como request.user (ver authentication.py)
+    is_authenticated = True
+
+    def __str__(self):
+        return self.name
+
+class ChangeEvent(models.Model):
+    """
+    Registro de cambios para la sincronización incremental (change feed).
+    El id autoincremental es el número de secuencia que consumen los clientes.
+    """
+    ENTITY_CHOICES = [('message', 'Mensaje'), ('connection', 'Conexión')]
+    ACTION_CHOICES = [('upsert', 'Alta/Modificación'), ('delete', 'Baja')]
+
+    client = models.ForeignKey(ApiClient, on_delete=models.CASCADE, related_name='change_events')
+    entity = models.CharField(max_length=20, choices=ENTITY_CHOICES)
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES, default='upsert')
+    object_id = models.BigIntegerField()
+    connection_id = models.BigIntegerField(null=True, blank=True)  # Sin FK: debe sobrevivir al borrado
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['client', 'id'], name='change_event_feed_idx'),
+        ]
+
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return f"#{self.id} {self.entity}:{self.object_id} ({self.action})"
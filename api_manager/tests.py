@@ -1,3 +1,191 @@
-from django.test import TestCase
+import base64
+import hashlib
+import hmac
+import json
+import time
+from datetime import timedelta
 
-# Create your tests here.
+from django.conf import settings
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+from rest_framework import exceptions
+from rest_framework.test import APIClient
+
+from api_manager.authentication import ApiClientJWTAuthentication
+from api_manager.models import ApiClient, ChangeEvent
+from whatsapp_manager import delivery_status
+from whatsapp_manager.models import BotCommand, Message, WhatsappConnection
+
+
+def _bearer(cliente):
+    """Authorization con un JWT HS256 del cliente (el iat lo hace único: no lo sirve la caché de otra prueba)."""
+    segmentos = [
+        base64.urlsafe_b64encode(json.dumps(parte).encode()).decode().rstrip('=')
+        for parte in ({'alg': 'HS256', 'typ': 'JWT'}, {'sub': cliente.api_key, 'iat': time.time()})
+    ]
+    firma = hmac.new(settings.API_JWT_SECRET.encode(), '.'.join(segmentos).encode(), hashlib.sha256).digest()
+    return 'Bearer ' + '.'.join(segmentos + [base64.urlsafe_b64encode(firma).decode().rstrip('=')])
+
+
+class ChangeFeedTests(TestCase):
+    """/api/v1/changes/ con un cliente autenticado y una conexión propia."""
+
+    def setUp(self):
+        self.cliente = ApiClient.objects.create(name='Réplica', api_key='replica')
+        self.connection = WhatsappConnection.objects.create(
+            client=self.cliente, name='Línea', access_token='token', phone_number_id='1000'
+        )
+        ChangeEvent.objects.all().delete()  # el alta de la conexión no interesa aquí
+        self.api = APIClient()
+        self.api.credentials(HTTP_AUTHORIZATION=_bearer(self.cliente))
+
+    def _cambios(self, since=0):
+        response = self.api.get('/api/v1/changes/', {'since': since})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_cambios_recientes_esperan_la_ventana(self):
+        Message.objects.create(connection=self.connection, phone_number='5215555555555', direction='inbound', body='hola')
+
+        datos = self._cambios()
+        self.assertEqual(datos['changes'], [])
+        self.assertEqual(datos['next_since'], 0)
+
+        ChangeEvent.objects.update(created_at=timezone.now() - timedelta(seconds=60))
+        datos = self._cambios()
+        self.assertEqual([c['entity'] for c in datos['changes']], ['message'])
+
+    def test_lote_se_corta_en_el_primer_cambio_reciente(self):
+        antiguo = Message.objects.create(connection=self.connection, phone_number='5215555555555', direction='inbound')
+        ChangeEvent.objects.update(created_at=timezone.now() - timedelta(seconds=60))
+        Message.objects.create(connection=self.connection, phone_number='5215555555555', direction='inbound')
+
+        datos = self._cambios()
+        self.assertEqual([c['id'] for c in datos['changes']], [antiguo.id])
+        self.assertFalse(datos['has_more'])
+        self.assertEqual(datos['next_since'], ChangeEvent.objects.order_by('id').first().id)
+
+    def test_estado_de_entrega_llega_a_la_replica(self):
+        saliente = Message.objects.create(
+            connection=self.connection, phone_number='5215555555555', direction='outbound', body='hola',
+            wa_id='wamid.saliente', status='sent'
+        )
+        ChangeEvent.objects.update(created_at=timezone.now() - timedelta(seconds=60))
+        since = self._cambios()['next_since']
+
+        delivery_status.registrar_estados(self.connection, [
+            {'id': 'wamid.saliente', 'status': 'delivered', 'timestamp': '1790000000'},
+            {'id': 'wamid.saliente', 'status': 'read', 'timestamp': '1790000060'},
+        ])
+        ChangeEvent.objects.filter(id__gt=since).update(created_at=timezone.now() - timedelta(seconds=60))
+
+        cambios = self._cambios(since)['changes']
+        self.assertEqual([(c['entity'], c['id']) for c in cambios], [('message', saliente.id)])
+        datos = cambios[0]['data']
+        self.assertEqual(datos['status'], 'read')
+        self.assertEqual(datos['delivered_at'], '2026-09-21 14:13:20')
+        self.assertEqual(datos['read_at'], '2026-09-21 14:14:20')
+
+
+class MessageListTests(TestCase):
+    """/api/v1/messages/: paginación por cursor y ETag."""
+
+    def setUp(self):
+        self.cliente = ApiClient.objects.create(name='Réplica', api_key='replica')
+        self.connection = WhatsappConnection.objects.create(
+            client=self.cliente, name='Línea', access_token='token', phone_number_id='1000'
+        )
+        self.ids = [
+            Message.objects.create(connection=self.connection, phone_number='5215555555555', direction='inbound', body=str(i)).id
+            for i in range(5)
+        ]
+        self.api = APIClient()
+        self.api.credentials(HTTP_AUTHORIZATION=_bearer(self.cliente))
+
+    def _pagina(self, if_none_match=None, **params):
+        headers = {'HTTP_IF_NONE_MATCH': if_none_match} if if_none_match else {}
+        return self.api.get('/api/v1/messages/', {'connection_id': self.connection.id, 'limit': 2, **params}, **headers)
+
+    def test_cursores_recorren_todo_sin_huecos(self):
+        vistos, before = [], None
+        while True:
+            datos = self._pagina(**({'before': before} if before else {})).json()
+            vistos += [m['id'] for m in datos['messages']]
+            before = datos['cursors']['before']
+            if not datos['has_more']:
+                break
+        self.assertEqual(vistos, self.ids[::-1])
+
+        after = self._pagina().json()['cursors']['after']
+        nuevo = Message.objects.create(connection=self.connection, phone_number='5215555555555', direction='inbound')
+        datos = self._pagina(after=after).json()
+        self.assertEqual([m['id'] for m in datos['messages']], [nuevo.id])
+
+    def test_etag_responde_304_solo_si_coincide_exacto(self):
+        etag = self._pagina()['ETag']
+
+        self.assertEqual(self._pagina(if_none_match=f'"otro", W/{etag}').status_code, 304)
+        # Contenerlo como subcadena no basta
+        self.assertEqual(self._pagina(if_none_match=f'"v1{etag}"').status_code, 200)
+
+        # Un cambio de estado dentro de la página cambia el ETag
+        mensaje = Message.objects.get(id=self.ids[-1])
+        mensaje.status = 'read'
+        mensaje.save()
+        response = self._pagina(if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+@override_settings(WHATSAPP_BOT_EN_PROCESO=False, WHATSAPP_BOT_TIMEOUT_COMANDO=0.5)
+class BrowserLinkTests(TestCase):
+    """/api/v1/browser/link/ con los navegadores en el worker run_bot_browser (que aquí no corre)."""
+
+    def setUp(self):
+        self.cliente = ApiClient.objects.create(name='Panel', api_key='panel')
+        self.connection = WhatsappConnection.objects.create(
+            client=self.cliente, name='Línea', access_token='token', phone_number_id='2000'
+        )
+        self.api = APIClient()
+
+    def test_sin_token_responde_401_con_formato_de_la_api(self):
+        response = self.api.get('/api/v1/browser/link/', {'connection_id': self.connection.id})
+        self.assertEqual(response.status_code, 401)
+        self.assertIn('error', response.json())
+        self.assertEqual(response['WWW-Authenticate'], 'Bearer realm="api"')
+
+    def test_worker_sin_respuesta_no_bloquea_y_avisa(self):
+        self.api.credentials(HTTP_AUTHORIZATION=_bearer(self.cliente))
+        response = self.api.get('/api/v1/browser/link/', {'connection_id': self.connection.id})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], 'WORKER_NO_DISPONIBLE')
+        # La orden queda en la tabla para cuando el worker vuelva (otra consulta de QR la reutiliza)
+        self.assertEqual(list(BotCommand.objects.values_list('action', 'status')), [('qr', 'pending')])
+
+
+class CacheAutenticacionTests(TestCase):
+    """El token resuelto queda en caché hasta que el ApiClient se guarda o se borra."""
+
+    def setUp(self):
+        self.cliente = ApiClient.objects.create(name='Panel', api_key='cache')
+        self.request = RequestFactory().get('/api/v1/changes/', HTTP_AUTHORIZATION=_bearer(self.cliente))
+        self.autenticacion = ApiClientJWTAuthentication()
+
+    def test_token_en_cache_no_consulta_la_base(self):
+        self.autenticacion.authenticate(self.request)
+        with self.assertNumQueries(0):
+            client, _ = self.autenticacion.authenticate(self.request)
+        self.assertEqual(client.pk, self.cliente.pk)
+
+    def test_guardar_el_cliente_invalida_la_cache(self):
+        self.autenticacion.authenticate(self.request)
+
+        self.cliente.is_active = False
+        self.cliente.save()
+        with self.assertNumQueries(1), self.assertRaisesMessage(exceptions.PermissionDenied, "Cliente inactivo"):
+            self.autenticacion.authenticate(self.request)
+
+        self.cliente.delete()
+        with self.assertRaisesMessage(exceptions.PermissionDenied, "Cliente no registrado"):
+            self.autenticacion.authenticate(self.request)
@@ -1,5 +1,6 @@
 from django.urls import path
-from .views import SetupConnectionView, BrowserLinkView, ConnectionListView, MessageListView
+from .views import SetupConnectionView, BrowserLinkView, ConnectionListView, MessageListView, ChangeFeedView, \
+    BroadcastView, BroadcastDetailView
 
 urlpatterns = [
     # Endpoint: /api/v1/setup/
@@ -7,4 +8,7 @@ urlpatterns = [
     path('browser/link/', BrowserLinkView.as_view(), name='api_browser_link'),
     path('connections/', ConnectionListView.as_view(), name='api_connections_list'),
     path('messages/', MessageListView.as_view(), name='api_messages_list'),
+    path('changes/', ChangeFeedView.as_view(), name='api_changes_feed'),
+    path('broadcast/', BroadcastView.as_view(), name='api_broadcast'),
+    path('broadcast/<int:broadcast_id>/', BroadcastDetailView.as_view(), name='api_broadcast_detail'),
 ]
@@ -1,74 +1,97 @@
 import json
 import base64
-import threading
+import binascii
+import hashlib
 import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Count, Max
+from django.http import HttpResponseNotModified, JsonResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import parse_etags
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import exceptions, status
+from api_manager.authentication import ApiClientJWTAuthentication, ProvisioningJWTAuthentication
+from api_manager.models import ChangeEvent
+from whatsapp_manager.models import Broadcast, WhatsappConnection, Message
+from whatsapp_manager import bot_channel, broadcasts
+
+
+class ClientAPIView(View):
+    """
+    Base async de las vistas de la API: autentica el JWT (con caché) y deja el ApiClient en request.user.
+    Bajo ASGI los handlers no ocupan un hilo mientras esperan al bot o a la base: la autenticación
+    (síncrona, con su caché) va por sync_to_async y las consultas por el ORM async.
+    Los errores mantienen el formato {"error": ...} del resto de la API.
+    """
+    authentication_class = ApiClientJWTAuthentication
 
-from django.shortcuts import get_object_or_404
-from rest_framework.views import APIView
-from rest_framework.response import Response
-from rest_framework import status
-from api_manager.models import ApiClient
-from whatsapp_manager.models import WhatsappConnection, Message
-from whatsapp_manager import browser_service
-from whatsapp_manager.views import cerebro_ia
-
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Autenticación por token, sin cookies de sesión: CSRF no aplica
+        return csrf_exempt(super().as_view(**initkwargs))
 
-class SetupConnectionView(APIView):
+    async def dispatch(self, request, *args, **kwargs):
+        autenticador = self.authentication_class()
+        try:
+            resultado = await sync_to_async(autenticador.authenticate)(request)
+            if resultado is None:
+                raise exceptions.NotAuthenticated()
+        except (exceptions.AuthenticationFailed, exceptions.NotAuthenticated, exceptions.PermissionDenied) as exc:
+            response = self.respuesta({"error": exc.detail}, status=exc.status_code)
+            if exc.status_code == status.HTTP_401_UNAUTHORIZED:
+                response['WWW-Authenticate'] = autenticador.authenticate_header(request)
+            return response
+
+        request.user, request.auth = resultado
+        return await super().dispatch(request, *args, **kwargs)
+
+    @staticmethod
+    def respuesta(data, status=200, headers=None):
+        return JsonResponse(data, status=status, headers=headers, json_dumps_params={'ensure_ascii': False})
+
+    @staticmethod
+    def leer_datos(request):
+        """Cuerpo JSON o de formulario/multipart. Lanza ValueError si el JSON no es un objeto válido."""
+        if request.content_type == 'application/json':
+            data = json.loads(request.body or b'{}')
+            if not isinstance(data, dict):
+                raise ValueError(data)
+            return data
+        return request.POST
+
+
+class SetupConnectionView(ClientAPIView):
     """
     Endpoint para inicializar la estructura de datos.
     Espera un JWT en el header Authorization.
     """
 
-    def decode_jwt_payload_unsafe(self, token):
-        try:
-            payload_part = token.split('.')[1]
-            padding = '=' * (4 - len(payload_part) % 4)
-            decoded_bytes = base64.urlsafe_b64decode(payload_part + padding)
-            return json.loads(decoded_bytes)
-        except Exception as e:
-            print(f"❌ Error decodificando JWT: {e}")
-            return None
+    authentication_class = ProvisioningJWTAuthentication
 
-    def post(self, request):
+    async def post(self, request):
         print(f"\n🔍 [DEBUG] Iniciando solicitud POST a SetupConnectionView")
 
-        # 1. Autenticación
-        auth_header = request.headers.get('Authorization', '')
-        if not auth_header.startswith('Bearer '):
-            return Response({"error": "Formato token inválido"}, status=status.HTTP_401_UNAUTHORIZED)
-
-        token = auth_header.split(' ')[1]
-        payload = self.decode_jwt_payload_unsafe(token)
-
-        if not payload or 'sub' not in payload:
-            return Response({"error": "Token inválido"}, status=status.HTTP_400_BAD_REQUEST)
-
-        # 2. Gestión del Cliente (Auto-aprovisionamiento)
-        client_api_key = payload['sub']
-        client_name = payload.get('username', payload.get('name', f"Cliente {client_api_key}"))
-
-        print(f"👤 Procesando cliente: {client_api_key}")
-
-        try:
-            client, created = ApiClient.objects.get_or_create(
-                api_key=client_api_key,
-                defaults={'name': client_name, 'is_active': True}
-            )
-            if not client.is_active:
-                return Response({"error": "Cliente inactivo"}, status=status.HTTP_403_FORBIDDEN)
-
-        except Exception as e:
-            return Response({"error": str(e)}, status=500)
+        # 1-2. Autenticación y auto-aprovisionamiento del cliente (ProvisioningJWTAuthentication)
+        client = request.user
+        print(f"👤 Procesando cliente: {client.api_key}")
 
         # 3. Procesamiento de Datos (Lógica Flexible)
-        data = request.data
+        try:
+            data = self.leer_datos(request)
+        except ValueError:
+            return self.respuesta({"error": "JSON inválido"}, status=status.HTTP_400_BAD_REQUEST)
         conn_name = data.get('connection_name')
         phone_id = data.get('phone_number_id')
         access_token = data.get('access_token')
 
         # Validación mínima: Solo exigimos el nombre
         if not conn_name:
-            return Response(
+            return self.respuesta(
                 {"error": "Falta el campo obligatorio: connection_name"},
                 status=status.HTTP_400_BAD_REQUEST
             )
@@ -86,7 +109,7 @@ class SetupConnectionView(APIView):
 
         # 4. Crear/Actualizar Conexión
         try:
-            connection, conn_created = WhatsappConnection.objects.update_or_create(
+            connection, conn_created = await WhatsappConnection.objects.aupdate_or_create(
                 phone_number_id=phone_id,
                 defaults={
                     'name': conn_name,
@@ -99,7 +122,7 @@ class SetupConnectionView(APIView):
             action = "created" if conn_created else "updated"
             print(f"🎉 Éxito: Conexión {action} con ID {connection.id}")
 
-            return Response({
+            return self.respuesta({
                 "status": "success",
                 "message": f"Conexión {action} correctamente.",
                 "connection_id": connection.id,
@@ -108,47 +131,31 @@ class SetupConnectionView(APIView):
 
         except Exception as e:
             print(f"❌ Error guardando conexión: {e}")
-            return Response({"error": f"Error base de datos: {str(e)}"}, status=500)
-class BrowserLinkView(APIView):
+            return self.respuesta({"error": f"Error base de datos: {str(e)}"}, status=500)
+class BrowserLinkView(ClientAPIView):
     """
     Endpoint para obtener el QR de vinculación o verificar el estado.
     GET /api/v1/browser/link/?connection_id=1
     """
 
-    def decode_jwt_payload_unsafe(self, token):
-        # ... (reutiliza la lógica de decodificación anterior) ...
-        try:
-            payload_part = token.split('.')[1]
-            padding = '=' * (4 - len(payload_part) % 4)
-            return json.loads(base64.urlsafe_b64decode(payload_part + padding))
-        except:
-            return None
-
-    def get(self, request):
-        # 1. Autenticación (Reutilizable)
-        auth_header = request.headers.get('Authorization', '')
-        if not auth_header.startswith('Bearer '):
-            return Response({"error": "Token requerido"}, status=status.HTTP_401_UNAUTHORIZED)
-
-        payload = self.decode_jwt_payload_unsafe(auth_header.split(' ')[1])
-        if not payload: return Response({"error": "Token inválido"}, status=400)
-
+    async def get(self, request):
+        # 1. Autenticación: la resuelve ApiClientJWTAuthentication (request.user es el ApiClient)
         # 2. Obtener connection_id
-        conn_id = request.query_params.get('connection_id')
+        conn_id = request.GET.get('connection_id')
         if not conn_id:
-            return Response({"error": "connection_id es requerido"}, status=400)
+            return self.respuesta({"error": "connection_id es requerido"}, status=400)
 
         # 3. Validar Propiedad (Seguridad)
         # Solo permitimos ver el QR si la conexión pertenece al Cliente del Token
         try:
-            client = ApiClient.objects.get(api_key=payload['sub'])
-            connection = WhatsappConnection.objects.get(id=conn_id, client=client)
-        except (ApiClient.DoesNotExist, WhatsappConnection.DoesNotExist):
-            return Response({"error": "Conexión no encontrada o no autorizada"}, status=403)
+            connection = await WhatsappConnection.objects.aget(id=conn_id, client=request.user)
+        except WhatsappConnection.DoesNotExist:
+            return self.respuesta({"error": "Conexión no encontrada o no autorizada"}, status=403)
 
-        # 4. Interactuar con el Servicio de Navegador Refactorizado
-        # Llamamos a la lógica interna que ahora soporta ID
-        qr_base64, estado = browser_service.obtener_qr_screenshot(connection.id)
+        # 4. Interactuar con el Servicio de Navegador (en este proceso o en el worker run_bot_browser)
+        # La espera al worker (hasta WHATSAPP_BOT_TIMEOUT_COMANDO) no bloquea ningún hilo
+        resultado = await bot_channel.aejecutar_comando(connection.id, 'qr')
+        qr_base64, estado = resultado.get('qr_image'), resultado.get('estado', 'WORKER_NO_DISPONIBLE')
 
         response_data = {
             "connection_id": connection.id,
@@ -162,20 +169,9 @@ class BrowserLinkView(APIView):
             response_data["message"] = "✅ El bot ya está vinculado y listo."
 
             # --- AUTO-ARRANQUE DEL BOT ---
-            # Verificamos si ya hay un hilo corriendo para esta conexión específica
-            session_ctx = browser_service.get_session_context(connection.id)
-            if not (session_ctx.get('thread') and session_ctx['thread'].is_alive()):
+            # El supervisor lo lanza si no está corriendo y lo relanza si se cae
+            if (await bot_channel.aejecutar_comando(connection.id, 'start')).get('iniciado'):
                 print(f"🚀 [API] Iniciando bot automáticamente para ID {connection.id}...")
-
-                # Creamos y lanzamos el hilo usando la función lógica 'cerebro_ia' definida en este archivo
-                t = threading.Thread(
-                    target=browser_service.iniciar_bucle_bot,
-                    args=(connection.id, cerebro_ia),
-                    name=f"Bot_{connection.id}",
-                    daemon=True
-                )
-                t.start()
-                session_ctx['thread'] = t
             else:
                 print(f"ℹ️ [API] El bot para ID {connection.id} ya estaba corriendo.")
 
@@ -188,69 +184,33 @@ class BrowserLinkView(APIView):
         elif estado == "BOT_OCUPADO":
             response_data["message"] = "⚠️ El bot está ocupado procesando mensajes. Intenta luego."
 
-        return Response(response_data, status=status.HTTP_200_OK)
+        elif estado == "LIMITE_SESIONES":
+            response_data["message"] = "🚫 Se alcanzó el máximo de navegadores simultáneos. Intenta más tarde."
+
+        elif estado == "WORKER_NO_DISPONIBLE":
+            response_data["message"] = "⚠️ El worker de navegadores no respondió. ¿Está corriendo run_bot_browser?"
+
+        return self.respuesta(response_data, status=status.HTTP_200_OK)
 
 
-class ConnectionListView(APIView):
+class ConnectionListView(ClientAPIView):
     """
     Endpoint para listar las conexiones activas del cliente.
     GET /api/v1/connections/
     """
 
-    def decode_jwt_payload_unsafe(self, token):
-        try:
-            payload_part = token.split('.')[1]
-            padding = '=' * (4 - len(payload_part) % 4)
-            return json.loads(base64.urlsafe_b64decode(payload_part + padding))
-        except:
-            return None
-
-    def get(self, request):
-        # 1. Autenticación Manual
-        auth_header = request.headers.get('Authorization', '')
-        if not auth_header.startswith('Bearer '):
-            return Response({"error": "Token requerido"}, status=status.HTTP_401_UNAUTHORIZED)
-
-        payload = self.decode_jwt_payload_unsafe(auth_header.split(' ')[1])
-        if not payload or 'sub' not in payload:
-            return Response({"error": "Token inválido o sin 'sub'"}, status=400)
-
-        # 2. Identificación y Auto-aprovisionamiento del Cliente
-        client_api_key = payload['sub']
-
-        # Intentamos obtener el nombre del payload, o generamos uno genérico
-        client_name = payload.get('username', payload.get('name', f"Cliente {client_api_key}"))
-
-        print(f"👤 Buscando (o creando) ApiClient con key: {client_api_key}")
-
-        try:
-            # CORRECCIÓN: Usamos get_or_create para evitar el error 403 si es la primera vez
-            client, created = ApiClient.objects.get_or_create(
-                api_key=client_api_key,
-                defaults={
-                    'name': client_name,
-                    'is_active': True
-                }
-            )
+    authentication_class = ProvisioningJWTAuthentication
 
-            if created:
-                print(f"✨ Cliente nuevo creado automáticamente: {client.name}")
-            elif not client.is_active:
-                return Response({"error": "Cliente inactivo"}, status=status.HTTP_403_FORBIDDEN)
-
-        except Exception as e:
-            print(f"❌ Error DB gestionando cliente: {e}")
-            return Response(
-                {"error": f"Error interno del servidor: {str(e)}"},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
+    async def get(self, request):
+        # 1-2. Autenticación y auto-aprovisionamiento del cliente (ProvisioningJWTAuthentication)
+        client = request.user
 
         # 3. Obtención de Conexiones
         # Ahora que tenemos 'client' seguro, filtramos sus conexiones
-        connections = WhatsappConnection.objects.filter(client=client, is_active=True)
+        connections = WhatsappConnection.objects.filter(client=client, is_active=True).select_related('chatbot')
 
         data = []
-        for conn in connections:
+        async for conn in connections:
             data.append({
                 "id": conn.id,
                 "name": conn.name,
@@ -260,60 +220,323 @@ class ConnectionListView(APIView):
                 "created_at": conn.created_at.strftime("%Y-%m-%d %H:%M:%S")
             })
 
-        return Response({"connections": data}, status=status.HTTP_200_OK)
+        return self.respuesta({"connections": data}, status=status.HTTP_200_OK)
 
-class MessageListView(APIView):
+class MessageListView(ClientAPIView):
     """
     Endpoint para obtener el historial de mensajes de una conexión específica.
     GET /api/v1/messages/?connection_id=1&limit=50
+
+    Paginación por cursor (opaco):
+      - sin cursor o con ?before=<cursor>: mensajes más antiguos, del más nuevo al más viejo.
+      - ?after=<cursor>: mensajes nuevos desde ese punto, del más viejo al más nuevo (polling).
+    Filtros: ?since=<ISO-8601 o epoch> y ?fields=id,body,... para recibir solo esas columnas.
+    Soporta ETag / If-None-Match: si la página no cambió responde 304 sin cuerpo (y sin leerla).
     """
 
-    def decode_jwt_payload_unsafe(self, token):
+    # Campo de la API -> columna del modelo
+    CAMPOS = {
+        "id": "id",
+        "wa_id": "wa_id",
+        "phone_number": "phone_number",
+        "body": "body",
+        "direction": "direction",
+        "type": "msg_type",
+        "media_file": "media_file",
+        "mime_type": "mime_type",
+        "timestamp": "timestamp",
+        "status": "status",
+    }
+
+
+    @staticmethod
+    def encode_cursor(msg_id):
+        return base64.urlsafe_b64encode(f"id:{msg_id}".encode()).decode().rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """Retorna el id del cursor o lanza ValueError si no es válido."""
+        padding = '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(cursor + padding).decode()
+        prefix, _, msg_id = raw.partition(':')
+        if prefix != 'id':
+            raise ValueError(cursor)
+        return int(msg_id)
+
+    @staticmethod
+    def parse_since(value):
+        if value.isdigit():
+            return datetime.fromtimestamp(int(value), tz=dt_timezone.utc)
+        parsed = parse_datetime(value)
+        if parsed is None:
+            raise ValueError(value)
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        return parsed
+
+    @staticmethod
+    def etag_coincide(etag, if_none_match):
+        """If-None-Match es una lista de ETags separados por comas (o '*'); comparación débil, exacta por ETag."""
+        etiquetas = parse_etags(if_none_match)
+        return '*' in etiquetas or etag in [e.removeprefix('W/') for e in etiquetas]
+
+    async def get(self, request):
+        conn_id = request.GET.get('connection_id')
+
+        if not conn_id:
+            return self.respuesta({"error": "connection_id es requerido"}, status=400)
+
+        # --- Parámetros de paginación / filtrado ---
+        max_page_size = getattr(settings, 'API_MESSAGES_MAX_PAGE_SIZE', 200)
         try:
-            payload_part = token.split('.')[1]
-            padding = '=' * (4 - len(payload_part) % 4)
-            return json.loads(base64.urlsafe_b64decode(payload_part + padding))
-        except:
-            return None
+            limit = min(max(int(request.GET.get('limit', 20)), 1), max_page_size)
+            before = request.GET.get('before')
+            after = request.GET.get('after')
+            before_id = self.decode_cursor(before) if before else None
+            after_id = self.decode_cursor(after) if after else None
+            since = request.GET.get('since')
+            since = self.parse_since(since) if since else None
+        except (ValueError, UnicodeDecodeError, binascii.Error):
+            return self.respuesta({"error": "Parámetros inválidos (limit, before, after o since)"}, status=400)
+
+        if before_id is not None and after_id is not None:
+            return self.respuesta({"error": "Usa before o after, no ambos"}, status=400)
+
+        fields_param = request.GET.get('fields')
+        if fields_param:
+            fields = [f.strip() for f in fields_param.split(',') if f.strip()]
+            unknown = [f for f in fields if f not in self.CAMPOS]
+            if unknown:
+                return self.respuesta({"error": f"Campos desconocidos: {', '.join(unknown)}"}, status=400)
+        else:
+            fields = list(self.CAMPOS)
+
+        try:
+            # 1. Validar que la conexión pertenece al cliente del token
+            connection = await WhatsappConnection.objects.aget(id=conn_id, client=request.user)
+        except WhatsappConnection.DoesNotExist:
+            return self.respuesta({"error": "Conexión no encontrada o acceso denegado"}, status=403)
+
+        # 2. Obtener mensajes (solo las columnas pedidas, sin instanciar modelos)
+        qs = Message.objects.filter(connection=connection)
+        if since is not None:
+            qs = qs.filter(timestamp__gte=since)
+        if after_id is not None:
+            qs = qs.filter(id__gt=after_id).order_by('id')
+        else:
+            if before_id is not None:
+                qs = qs.filter(id__lt=before_id)
+            qs = qs.order_by('-id')
+
+        # 3. ETag antes de leer la página: los parámetros, un agregado barato de la ventana
+        # (id máximo + cantidad) y el último cambio registrado del cliente (altas y modificaciones)
+        ventana = await qs.values('id')[:limit + 1].aaggregate(max_id=Max('id'), total=Count('id'))
+        ultimo_cambio = await ChangeEvent.objects.filter(client=request.user).order_by('-id').values_list('id', flat=True).afirst()
+        etag = '"%s"' % hashlib.md5(json.dumps([
+            connection.id, fields, limit, before_id, after_id, since and since.isoformat(),
+            ventana['max_id'], ventana['total'], ultimo_cambio,
+        ]).encode()).hexdigest()
+        if self.etag_coincide(etag, request.headers.get('If-None-Match', '')):
+            return HttpResponseNotModified(headers={'ETag': etag})
+
+        columnas = {self.CAMPOS[f] for f in fields} | {'id'}
+        rows = [row async for row in qs.values(*columnas)[:limit + 1]]
+        has_more = len(rows) > limit
+        rows = rows[:limit]
 
-    def get(self, request):
-        auth_header = request.headers.get('Authorization', '')
-        if not auth_header.startswith('Bearer '):
-            return Response({"error": "Token requerido"}, status=status.HTTP_401_UNAUTHORIZED)
+        data = []
+        for row in rows:
+            item = {f: row[self.CAMPOS[f]] for f in fields}
+            if 'timestamp' in item:
+                item['timestamp'] = item['timestamp'].strftime("%Y-%m-%d %H:%M:%S")
+            data.append(item)
 
-        payload = self.decode_jwt_payload_unsafe(auth_header.split(' ')[1])
-        conn_id = request.query_params.get('connection_id')
-        limit = int(request.query_params.get('limit', 20))
+        ids = [row['id'] for row in rows]
+        response_data = {
+            "connection": connection.name,
+            "count": len(data),
+            "has_more": has_more,
+            "cursors": {
+                # before: para pedir mensajes más antiguos; after: para consultar los nuevos
+                "before": self.encode_cursor(min(ids)) if ids else before,
+                "after": self.encode_cursor(max(ids)) if ids else after,
+            },
+            "messages": data
+        }
+
+        return self.respuesta(response_data, status=status.HTTP_200_OK, headers={'ETag': etag})
 
-        if not conn_id:
-            return Response({"error": "connection_id es requerido"}, status=400)
 
+class ChangeFeedView(ClientAPIView):
+    """
+    Change feed para mantener una réplica local sincronizada.
+    GET /api/v1/changes/?since=<seq>&limit=500
+
+    Devuelve los cambios de mensajes y conexiones del cliente posteriores a 'since', en orden.
+    El cliente guarda 'next_since' y lo envía en la siguiente consulta; si 'has_more' es true
+    conviene pedir el siguiente lote de inmediato.
+
+    Garantía: un cambio se publica API_CHANGES_VENTANA segundos después de registrarse.
+    El seq es el id autoincremental, y en Postgres dos transacciones concurrentes pueden confirmar
+    fuera de orden de id; servir solo cambios con esa antigüedad (y cortar el lote en el primero
+    más reciente) evita que un cliente avance 'since' por encima de un seq aún no visible. Ningún
+    cambio se pierde mientras las transacciones que escriben confirmen dentro de esa ventana.
+    """
+
+    @staticmethod
+    async def serializar_mensajes(ids):
+        rows = Message.objects.filter(id__in=ids).values(
+            'id', 'connection_id', 'wa_id', 'phone_number', 'body', 'direction', 'msg_type', 'media_file', 'mime_type',
+            'timestamp', 'status', 'error', 'sent_at', 'delivered_at', 'read_at'
+        )
+
+        def _hora(valor):
+            return valor.strftime("%Y-%m-%d %H:%M:%S") if valor else None
+
+        return {
+            row['id']: {
+                "id": row['id'],
+                "connection_id": row['connection_id'],
+                "wa_id": row['wa_id'],
+                "phone_number": row['phone_number'],
+                "body": row['body'],
+                "direction": row['direction'],
+                "type": row['msg_type'],
+                "media_file": row['media_file'],
+                "mime_type": row['mime_type'],
+                "timestamp": row['timestamp'].strftime("%Y-%m-%d %H:%M:%S"),
+                # Entrega de los salientes: cada confirmación de Meta genera un cambio
+                "status": row['status'],
+                "error": row['error'],
+                "sent_at": _hora(row['sent_at']),
+                "delivered_at": _hora(row['delivered_at']),
+                "read_at": _hora(row['read_at']),
+            } async for row in rows
+        }
+
+    @staticmethod
+    async def serializar_conexiones(ids):
+        conns = WhatsappConnection.objects.filter(id__in=ids).select_related('chatbot')
+        return {
+            conn.id: {
+                "id": conn.id,
+                "name": conn.name,
+                "phone_number_id": conn.phone_number_id,
+                "display_phone_number": conn.display_phone_number,
+                "chatbot": conn.chatbot.name if conn.chatbot else None,
+                "is_active": conn.is_active,
+                "created_at": conn.created_at.strftime("%Y-%m-%d %H:%M:%S")
+            } async for conn in conns
+        }
+
+    async def get(self, request):
+        max_batch = getattr(settings, 'API_CHANGES_MAX_BATCH', 1000)
         try:
-            # 1. Validar que la conexión pertenece al cliente del token
-            client = ApiClient.objects.get(api_key=payload['sub'])
-            connection = WhatsappConnection.objects.get(id=conn_id, client=client)
-
-            # 2. Obtener mensajes
-            messages = Message.objects.filter(connection=connection).order_by('-timestamp')[:limit]
-
-            data = []
-            for msg in messages:  # Invertimos para orden cronológico si se desea en frontend
-                data.append({
-                    "id": msg.id,
-                    "wa_id": msg.wa_id,
-                    "phone_number": msg.phone_number,
-                    "body": msg.body,
-                    "direction": msg.direction,
-                    "type": msg.msg_type,
-                    "media_file": msg.media_file,
-                    "timestamp": msg.timestamp.strftime("%Y-%m-%d %H:%M:%S")
-                })
-
-            return Response({
-                "connection": connection.name,
-                "count": len(data),
-                "messages": data
-            }, status=status.HTTP_200_OK)
-
-        except (ApiClient.DoesNotExist, WhatsappConnection.DoesNotExist):
-            return Response({"error": "Conexión no encontrada o acceso denegado"}, status=403)
\ No newline at end of file
+            since = int(request.GET.get('since', 0))
+            limit = min(max(int(request.GET.get('limit', 500)), 1), max_batch)
+        except ValueError:
+            return self.respuesta({"error": "since y limit deben ser enteros"}, status=400)
+
+        events = [
+            event async for event in ChangeEvent.objects.filter(client=request.user, id__gt=since)
+            .order_by('id')
+            .values('id', 'entity', 'action', 'object_id', 'connection_id', 'created_at')[:limit + 1]
+        ]
+        has_more = len(events) > limit
+        events = events[:limit]
+
+        # Solo cambios fuera de la ventana de visibilidad; desde el primero más reciente, esperan
+        limite_visible = timezone.now() - timedelta(seconds=getattr(settings, 'API_CHANGES_VENTANA', 5))
+        for i, event in enumerate(events):
+            if event['created_at'] > limite_visible:
+                events = events[:i]
+                has_more = False
+                break
+
+        # Dentro del lote solo importa el último cambio de cada objeto
+        latest = {}
+        for event in events:
+            latest[(event['entity'], event['object_id'])] = event
+
+        upserts = [e for e in latest.values() if e['action'] == 'upsert']
+        datos = {
+            'message': await self.serializar_mensajes([e['object_id'] for e in upserts if e['entity'] == 'message']),
+            'connection': await self.serializar_conexiones([e['object_id'] for e in upserts if e['entity'] == 'connection']),
+        }
+
+        changes = []
+        for event in sorted(latest.values(), key=lambda e: e['id']):
+            data = datos[event['entity']].get(event['object_id']) if event['action'] == 'upsert' else None
+            changes.append({
+                "seq": event['id'],
+                "entity": event['entity'],
+                # Si el objeto ya no existe, el cambio efectivo es una baja
+                "action": event['action'] if event['action'] == 'delete' or data else 'delete',
+                "id": event['object_id'],
+                "connection_id": event['connection_id'],
+                "data": data,
+            })
+
+        return self.respuesta({
+            "count": len(changes),
+            "has_more": has_more,
+            "next_since": events[-1]['id'] if events else since,
+            "changes": changes
+        }, status=status.HTTP_200_OK)
+
+
+class BroadcastView(ClientAPIView):
+    """
+    Envío masivo de un texto.
+    POST /api/v1/broadcast/
+      - JSON: {"connection_id": 1, "message": "...", "recipients": ["5215550001", ...]}
+      - multipart: connection_id, message y un CSV en 'recipients_file' (se lee línea a línea)
+    Responde 202 en cuanto se crea el broadcast ('loading'): la carga de destinatarios y el envío
+    siguen en segundo plano; el progreso se consulta en /api/v1/broadcast/<id>/.
+    """
+
+    async def post(self, request):
+        try:
+            data = self.leer_datos(request)
+        except ValueError:
+            return self.respuesta({"error": "JSON inválido"}, status=400)
+        conn_id = data.get('connection_id')
+        body = (data.get('message') or '').strip()
+        if not conn_id or not body:
+            return self.respuesta({"error": "connection_id y message son requeridos"}, status=400)
+
+        try:
+            connection = await WhatsappConnection.objects.aget(id=conn_id, client=request.user)
+        except (WhatsappConnection.DoesNotExist, ValueError):
+            return self.respuesta({"error": "Conexión no encontrada o no autorizada"}, status=403)
+
+        archivo = request.FILES.get('recipients_file')
+        if archivo is not None:
+            # Copia del upload a un temporal: E/S de disco, en un hilo
+            destinatarios = await sync_to_async(broadcasts.leer_csv)(archivo)
+        else:
+            destinatarios = data.get('recipients')
+            if not isinstance(destinatarios, list) or not destinatarios:
+                return self.respuesta({"error": "recipients (lista) o recipients_file (CSV) es requerido"}, status=400)
+            maximo = getattr(settings, 'API_BROADCAST_MAX_RECIPIENTS', 100000)
+            if len(destinatarios) > maximo:
+                return self.respuesta({"error": f"Máximo {maximo} destinatarios por envío"}, status=400)
+            # Se aceptan strings o {"phone": ...}
+            destinatarios = (d.get('phone', '') if isinstance(d, dict) else d for d in destinatarios)
+
+        # crear_broadcast usa transaction.on_commit: corre entero en un hilo
+        broadcast = await sync_to_async(broadcasts.crear_broadcast)(connection, body, destinatarios)
+        return self.respuesta(await sync_to_async(broadcasts.progreso)(broadcast), status=status.HTTP_202_ACCEPTED)
+
+
+class BroadcastDetailView(ClientAPIView):
+    """
+    Progreso de un envío masivo.
+    GET /api/v1/broadcast/<id>/
+    """
+
+    async def get(self, request, broadcast_id):
+        broadcast = await Broadcast.objects.filter(id=broadcast_id, connection__client=request.user).afirst()
+        if broadcast is None:
+            return self.respuesta({"error": "Broadcast no encontrado"}, status=status.HTTP_404_NOT_FOUND)
+        return self.respuesta(await sync_to_async(broadcasts.progreso)(broadcast), status=status.HTTP_200_OK)
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class WhatsappManagerConfig(AppConfig):
     name = 'whatsapp_manager'
+
+    def ready(self):
+        # Conecta las señales del registro de conexiones y de las actualizaciones en vivo
+        from . import connection_registry, live_hub  # noqa: F401
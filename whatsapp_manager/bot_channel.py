@@ -0,0 +1,259 @@
+"""
+Canal de órdenes entre el proceso web y los bots de navegador.
+
+Con WHATSAPP_BOT_EN_PROCESO = True (por defecto) las órdenes se ejecutan directamente
+en este proceso, como antes. Con False, los navegadores viven en un proceso aparte
+(python manage.py run_bot_browser): el web inserta un BotCommand, el worker lo reclama,
+lo ejecuta con browser_service y deja el resultado en la misma fila.
+
+Así Selenium no compite con las peticiones HTTP por el GIL y los bots sobreviven
+a los reinicios del servidor web.
+"""
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from . import browser_service, browser_supervisor
+from .models import BotCommand
+
+logger = logging.getLogger(__name__)
+
+# Órdenes de solo lectura: si ya hay una igual en curso para la conexión, se espera esa
+ACCIONES_REUTILIZABLES = ('qr', 'status')
+
+
+def _en_proceso():
+    return getattr(settings, 'WHATSAPP_BOT_EN_PROCESO', True)
+
+
+# ==============================================================================
+# EJECUCIÓN (en el proceso que tiene los navegadores)
+# ==============================================================================
+
+def _accion_qr(connection_id, payload):
+    qr_image, estado = browser_service.obtener_qr_screenshot(connection_id)
+    return {'estado': estado, 'qr_image': qr_image}
+
+
+def _accion_status(connection_id, payload):
+    context = browser_service.active_sessions.get(connection_id) or {}
+    return {
+        'bot_activo': browser_service.bot_activo(connection_id),
+        'navegador_abierto': context.get('driver') is not None,
+    }
+
+
+def _accion_start(connection_id, payload):
+    from .views import crear_callback_browser
+
+    supervisor = browser_supervisor.obtener_supervisor()
+    return {'iniciado': supervisor.iniciar_bot(connection_id, crear_callback_browser(connection_id))}
+
+
+def _accion_stop(connection_id, payload):
+    browser_supervisor.obtener_supervisor().detener_bot(connection_id)
+    return {'detenido': browser_service.detener_bot(connection_id)}
+
+
+def _accion_send(connection_id, payload):
+    enviado = browser_service.enviar_mensaje_browser(connection_id, payload.get('destino'), payload.get('mensaje', ''))
+    return {'enviado': bool(enviado)}
+
+
+ACCIONES = {
+    'qr': _accion_qr,
+    'status': _accion_status,
+    'start': _accion_start,
+    'stop': _accion_stop,
+    'send': _accion_send,
+}
+
+
+def ejecutar_local(connection_id, accion, payload=None):
+    return ACCIONES[accion](connection_id, payload or {})
+
+
+# ==============================================================================
+# LADO WEB
+# ==============================================================================
+
+def ejecutar_comando(connection_id, accion, payload=None, timeout=None):
+    """
+    Ejecuta una orden sobre el navegador de una conexión y devuelve su resultado (dict).
+    Con timeout=0 solo encola la orden y retorna {'encolado': True}.
+    Si el worker no responde a tiempo retorna {'error': 'TIMEOUT', 'cancelado': bool}: las órdenes
+    que aún no había tomado se cancelan (no se ejecutarán); con cancelado False ya estaba en curso.
+    """
+    if accion not in ACCIONES:
+        raise ValueError(f"Acción de bot desconocida: {accion}")
+
+    # En el proceso de los navegadores (p. ej. respuestas que encola el propio bot) no hace falta la tabla
+    if _en_proceso() or browser_service.bot_activo(connection_id):
+        return ejecutar_local(connection_id, accion, payload)
+
+    if timeout is None:
+        timeout = getattr(settings, 'WHATSAPP_BOT_TIMEOUT_COMANDO', 20)
+
+    comando = None
+    if accion in ACCIONES_REUTILIZABLES:
+        comando = BotCommand.objects.filter(
+            connection_id=connection_id, action=accion, status__in=('pending', 'processing'),
+            created_at__gte=timezone.now() - timedelta(seconds=timeout),
+        ).order_by('-id').first()
+    if comando is None:
+        comando = BotCommand.objects.create(connection_id=connection_id, action=accion, payload=payload or {})
+
+    if not timeout:
+        return {'encolado': True, 'comando_id': comando.id}
+
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        time.sleep(0.2)
+        fila = BotCommand.objects.filter(id=comando.id).values('status', 'result').first()
+        if fila is None:
+            break
+        if fila['status'] in ('done', 'failed'):
+            return fila['result'] or {}
+
+    logger.warning(f"⏳ El worker de navegadores no respondió a '{accion}' (conexión {connection_id}).")
+    if accion in ACCIONES_REUTILIZABLES:
+        # Solo lectura: puede terminar cuando quiera, otra consulta la reutiliza
+        return {'error': 'TIMEOUT', 'cancelado': False}
+
+    # Cancelación atómica: si el worker todavía no la tomó, ya no la ejecutará (p. ej. un 'send' duplicado)
+    cancelado = BotCommand.objects.filter(id=comando.id, status='pending').update(
+        status='failed', result={'error': 'CANCELADO'}, processed_at=timezone.now()
+    )
+    if not cancelado:
+        fila = BotCommand.objects.filter(id=comando.id).values('status', 'result').first()
+        if fila and fila['status'] in ('done', 'failed'):
+            return fila['result'] or {}
+    return {'error': 'TIMEOUT', 'cancelado': bool(cancelado)}
+
+
+async def aejecutar_comando(connection_id, accion, payload=None, timeout=None):
+    """
+    Versión async de ejecutar_comando (vistas bajo ASGI): la espera al worker usa asyncio.sleep
+    y el ORM async, así que no ocupa un hilo mientras el navegador responde. Mismos resultados.
+    """
+    if accion not in ACCIONES:
+        raise ValueError(f"Acción de bot desconocida: {accion}")
+
+    if _en_proceso() or browser_service.bot_activo(connection_id):
+        # Selenium bloquea: en un hilo propio para no frenar al resto de vistas sync
+        return await sync_to_async(ejecutar_local, thread_sensitive=False)(connection_id, accion, payload)
+
+    if timeout is None:
+        timeout = getattr(settings, 'WHATSAPP_BOT_TIMEOUT_COMANDO', 20)
+
+    comando = None
+    if accion in ACCIONES_REUTILIZABLES:
+        comando = await BotCommand.objects.filter(
+            connection_id=connection_id, action=accion, status__in=('pending', 'processing'),
+            created_at__gte=timezone.now() - timedelta(seconds=timeout),
+        ).order_by('-id').afirst()
+    if comando is None:
+        comando = await BotCommand.objects.acreate(connection_id=connection_id, action=accion, payload=payload or {})
+
+    if not timeout:
+        return {'encolado': True, 'comando_id': comando.id}
+
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        await asyncio.sleep(0.2)
+        fila = await BotCommand.objects.filter(id=comando.id).values('status', 'result').afirst()
+        if fila is None:
+            break
+        if fila['status'] in ('done', 'failed'):
+            return fila['result'] or {}
+
+    logger.warning(f"⏳ El worker de navegadores no respondió a '{accion}' (conexión {connection_id}).")
+    if accion in ACCIONES_REUTILIZABLES:
+        return {'error': 'TIMEOUT', 'cancelado': False}
+
+    cancelado = await BotCommand.objects.filter(id=comando.id, status='pending').aupdate(
+        status='failed', result={'error': 'CANCELADO'}, processed_at=timezone.now()
+    )
+    if not cancelado:
+        fila = await BotCommand.objects.filter(id=comando.id).values('status', 'result').afirst()
+        if fila and fila['status'] in ('done', 'failed'):
+            return fila['result'] or {}
+    return {'error': 'TIMEOUT', 'cancelado': bool(cancelado)}
+
+
+# ==============================================================================
+# LADO WORKER (manage.py run_bot_browser)
+# ==============================================================================
+
+class BotCommandWorker:
+    """
+    Atiende la tabla BotCommand. Las órdenes se ejecutan en un pool pequeño para que
+    un envío lento en una conexión no retrase el QR de otra.
+    """
+
+    def __init__(self, num_hilos=4, intervalo_sondeo=0.5, expiracion=60, retencion=timedelta(days=1)):
+        self.intervalo_sondeo = intervalo_sondeo
+        self.expiracion = expiracion
+        self.retencion = retencion
+        self._executor = ThreadPoolExecutor(max_workers=num_hilos, thread_name_prefix="BotCommand")
+        self._detener = threading.Event()
+
+    def detener(self):
+        self._detener.set()
+
+    def ejecutar(self):
+        # Órdenes que quedaron a medias si el worker anterior murió: nadie las está esperando ya
+        BotCommand.objects.filter(status='processing').update(
+            status='failed', result={'error': 'WORKER_REINICIADO'}, processed_at=timezone.now()
+        )
+
+        ultima_limpieza = 0
+        while not self._detener.is_set():
+            atendidas = 0
+            try:
+                atendidas = self._atender_pendientes()
+                if time.monotonic() - ultima_limpieza > 3600:
+                    ultima_limpieza = time.monotonic()
+                    BotCommand.objects.filter(processed_at__lt=timezone.now() - self.retencion).delete()
+            except Exception as e:
+                logger.error(f"❌ Error leyendo órdenes del bot: {e}")
+                close_old_connections()
+
+            if not atendidas:
+                self._detener.wait(self.intervalo_sondeo)
+
+        self._executor.shutdown(wait=False)
+
+    def _atender_pendientes(self):
+        # Una orden vieja (p. ej. un QR pedido hace minutos) ya no la espera nadie: se descarta
+        BotCommand.objects.filter(
+            status='pending', created_at__lt=timezone.now() - timedelta(seconds=self.expiracion)
+        ).update(status='failed', result={'error': 'EXPIRADO'}, processed_at=timezone.now())
+
+        atendidas = 0
+        for comando_id in list(BotCommand.objects.filter(status='pending').values_list('id', flat=True)[:50]):
+            # Reclamo atómico: solo un worker pasa la orden a 'processing'
+            if BotCommand.objects.filter(id=comando_id, status='pending').update(status='processing'):
+                self._executor.submit(self._ejecutar_comando, comando_id)
+                atendidas += 1
+        return atendidas
+
+    def _ejecutar_comando(self, comando_id):
+        close_old_connections()
+        comando = BotCommand.objects.get(id=comando_id)
+        try:
+            resultado = ejecutar_local(comando.connection_id, comando.action, comando.payload)
+            estado = 'done'
+        except Exception as e:
+            logger.error(f"❌ Orden {comando.action} de la conexión {comando.connection_id} falló: {e}")
+            resultado, estado = {'error': str(e)}, 'failed'
+
+        BotCommand.objects.filter(id=comando_id).update(status=estado, result=resultado, processed_at=timezone.now())
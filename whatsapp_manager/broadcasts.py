@@ -0,0 +1,201 @@
+"""
+Envíos masivos (broadcast): un mismo texto a miles de destinatarios.
+
+Los destinatarios se consumen como iterador (lista JSON o CSV leído línea a línea) en un
+hilo aparte: la petición responde en cuanto existe el Broadcast ('loading'). Se insertan en
+bloques con bulk_create como Messages 'queued' y se entregan a outbound_queue, que hace el
+envío concurrente respetando el límite de la línea. Si la carga falla, el broadcast queda 'failed'.
+El progreso se calcula contando los Message del broadcast por estado. El paso a 'done' lo da
+quien deja el último mensaje en un estado final (cerrar_si_termino, desde outbound_queue).
+"""
+import csv
+import io
+import logging
+import tempfile
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+from api_manager.changefeed import registrar_cambios
+
+from . import conversations, live_hub, outbound_queue
+from .models import Broadcast, Message, normalizar_telefono
+
+logger = logging.getLogger(__name__)
+
+TAMANO_BLOQUE = 500
+COLUMNAS_TELEFONO = ('phone', 'phone_number', 'telefono', 'teléfono', 'numero', 'número')
+
+
+def leer_csv(archivo):
+    """
+    Itera los teléfonos de un CSV subido sin cargarlo entero en memoria.
+    Usa la columna 'phone'/'telefono' si hay cabecera; si no, la primera columna.
+    El archivo se copia antes a un temporal propio: Django cierra el subido al terminar la
+    petición y la carga sigue después en otro hilo.
+    """
+    copia = tempfile.TemporaryFile()
+    for trozo in archivo.chunks():
+        copia.write(trozo)
+    copia.seek(0)
+    return _telefonos_csv(copia)
+
+
+def _telefonos_csv(copia):
+    texto = io.TextIOWrapper(copia, encoding='utf-8-sig', newline='')
+    columna = 0
+    try:
+        for i, fila in enumerate(csv.reader(texto)):
+            if not fila:
+                continue
+            if i == 0:
+                cabecera = [c.strip().lower() for c in fila]
+                encontrada = next((cabecera.index(c) for c in COLUMNAS_TELEFONO if c in cabecera), None)
+                if encontrada is not None:
+                    columna = encontrada
+                    continue
+                if not any(ch.isdigit() for ch in fila[0]):
+                    continue  # Cabecera desconocida
+            if columna < len(fila):
+                yield fila[columna]
+    finally:
+        texto.close()
+
+
+def _destinatario_valido(connection, phone):
+    if not phone:
+        return False
+    # En el bot de navegador el destinatario es el nombre del chat; en Cloud API, un número E.164
+    return connection.es_browser or phone.startswith('+')
+
+
+def crear_broadcast(connection, body, destinatarios):
+    """
+    Crea el broadcast ('loading') y lanza la carga de destinatarios en un hilo al confirmarse.
+    Retorna enseguida; el progreso se consulta con progreso().
+    """
+    broadcast = Broadcast.objects.create(connection=connection, body=body)
+    transaction.on_commit(lambda: threading.Thread(
+        target=_cargar_en_hilo, args=(broadcast.id, destinatarios), name=f"Broadcast_{broadcast.id}", daemon=True
+    ).start())
+    return broadcast
+
+
+def _cargar_en_hilo(broadcast_id, destinatarios):
+    close_old_connections()
+    try:
+        # Instancia propia: la de la petición la sigue usando la vista para responder
+        cargar_destinatarios(Broadcast.objects.select_related('connection').get(id=broadcast_id), destinatarios)
+    except Exception as e:
+        logger.error(f"❌ Broadcast {broadcast_id}: falló la carga de destinatarios: {e}")
+        # Lo ya encolado se sigue enviando; el broadcast no queda en 'loading' para siempre
+        Broadcast.objects.filter(id=broadcast_id, status='loading').update(status='failed', finished_at=timezone.now())
+    finally:
+        close_old_connections()
+
+
+def cargar_destinatarios(broadcast, destinatarios):
+    """
+    Inserta los mensajes del broadcast en bloques. Cada bloque se confirma por separado,
+    así el envío empieza mientras se siguen cargando los destinatarios.
+    Los destinatarios por encima de API_BROADCAST_MAX_RECIPIENTS se cuentan como descartados.
+    """
+    connection = broadcast.connection
+    maximo = getattr(settings, 'API_BROADCAST_MAX_RECIPIENTS', 100000)
+    vistos = set()
+    total = descartados = 0
+
+    iterador = iter(destinatarios)
+    agotado = False
+    while not agotado and total < maximo:
+        bloque = []
+        for raw in iterador:
+            phone = normalizar_telefono(str(raw).strip())
+            if not _destinatario_valido(connection, phone) or phone in vistos:
+                descartados += 1
+                continue
+            vistos.add(phone)
+            bloque.append(phone)
+            if len(bloque) >= min(TAMANO_BLOQUE, maximo - total):
+                break
+        else:
+            agotado = True
+        _insertar_bloque(broadcast, bloque)
+        total += len(bloque)
+
+    # Lo que queda tras el tope no se envía, pero se informa en el conteo de descartados
+    excedentes = sum(1 for _ in iterador)
+    if excedentes:
+        logger.warning(f"⚠️ Broadcast {broadcast.id}: {excedentes} destinatarios por encima del máximo ({maximo}).")
+    descartados += excedentes
+
+    Broadcast.objects.filter(id=broadcast.id).update(total=total, duplicates=descartados, status='sending')
+    # Si los mensajes ya salieron todos mientras se cargaba, nadie más lo cerraría
+    cerrar_si_termino(broadcast.id)
+    broadcast.refresh_from_db()
+    logger.info(f"📣 Broadcast {broadcast.id}: {total} destinatarios encolados ({descartados} descartados).")
+    return broadcast
+
+
+def _insertar_bloque(broadcast, phones):
+    if not phones:
+        return
+    connection = broadcast.connection
+    ahora = timezone.now()
+    with transaction.atomic():
+        mensajes = Message.objects.bulk_create([
+            Message(connection=connection, phone_number=phone, body=broadcast.body, direction='outbound',
+                    status='queued', broadcast=broadcast, claimed_by=outbound_queue.DUENO, claimed_at=ahora)
+            for phone in phones
+        ])
+        # bulk_create no emite señales: bandeja y change feed se actualizan a mano
+        conversations.registrar_lote(connection.id, mensajes)
+        registrar_cambios('message', mensajes)
+        live_hub.publicar_mensajes(mensajes)
+        outbound_queue.encolar_lote(connection, mensajes)
+        # El total crece mientras se carga: el progreso ya es consultable
+        Broadcast.objects.filter(id=broadcast.id).update(total=F('total') + len(mensajes))
+
+
+def cerrar_si_termino(broadcast_id):
+    """Pasa el broadcast a 'done' si ya terminó de cargarse y no le quedan mensajes por enviar."""
+    if Message.objects.filter(broadcast_id=broadcast_id, status__in=('queued', 'sending')).exists():
+        return False
+    return bool(Broadcast.objects.filter(id=broadcast_id, status='sending').update(
+        status='done', finished_at=timezone.now()
+    ))
+
+
+def progreso(broadcast):
+    """Conteo por estado, porcentaje y ritmo de envío (mensajes/segundo)."""
+    # order_by() vacío: el ordering por timestamp de Message rompería el GROUP BY
+    conteo = dict(
+        broadcast.messages.order_by().values('status').annotate(n=Count('id')).values_list('status', 'n')
+    )
+    enviados = conteo.get('sent', 0) + conteo.get('delivered', 0) + conteo.get('read', 0)
+    fallidos = conteo.get('failed', 0)
+    pendientes = conteo.get('queued', 0) + conteo.get('sending', 0)
+
+    fin = broadcast.finished_at or timezone.now()
+    segundos = max((fin - broadcast.created_at).total_seconds(), 0.001)
+    ritmo = enviados / segundos
+    return {
+        "id": broadcast.id,
+        "connection_id": broadcast.connection_id,
+        "status": broadcast.status,
+        "total": broadcast.total,
+        "discarded": broadcast.duplicates,
+        "queued": pendientes,
+        "sent": enviados,
+        "failed": fallidos,
+        "delivered": conteo.get('delivered', 0) + conteo.get('read', 0),
+        "read": conteo.get('read', 0),
+        "progress": round((enviados + fallidos) / broadcast.total * 100, 1) if broadcast.total else 100.0,
+        "throughput_per_sec": round(ritmo, 2),
+        "eta_seconds": round(pendientes / ritmo) if ritmo and pendientes else None,
+        "created_at": broadcast.created_at.isoformat(),
+        "finished_at": broadcast.finished_at.isoformat() if broadcast.finished_at else None,
+    }
@@ -5,10 +5,9 @@ import time
 import logging
 import re
 import threading
-import base64
-import io
-import uuid
-from PIL import Image
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
@@ -18,15 +17,34 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.keys import Keys
 
+from django.conf import settings
+
+from . import image_pipeline, media_store
+
 # Configuración de Logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # --- GESTIÓN DE SESIONES MÚLTIPLES ---
-# Estructura: { connection_id: { 'driver': driver_obj, 'lock': RLock(), 'thread': thread_obj } }
+# Estructura: { connection_id: { 'driver': driver_obj, 'lock': RLock(), 'thread': thread_obj, 'salida': Queue(),
+#                                'ultimo_uso': monotonic, 'detener': Event(), 'arrancando': bool } }
+# 'salida' guarda las respuestas de la IA ya calculadas, pendientes de escribir en el navegador.
+# 'detener' pide al bucle del bot que termine (detener_bot).
+# 'arrancando' reserva el cupo mientras Chrome se lanza (aún sin driver).
+# 'sin_vincular': el último intento de login venció sin que nadie escaneara el QR.
 active_sessions = {}
 global_registry_lock = threading.RLock()  # Candado para modificar el diccionario active_sessions
 
+# Cada Chromium headless consume cientos de MB: tope de navegadores abiertos a la vez en este proceso
+MAX_NAVEGADORES = int(os.environ.get('BOT_MAX_NAVEGADORES', 10))
+
+
+class LimiteSesionesError(Exception):
+    """No hay cupo para abrir otro navegador (todas las sesiones abiertas están en uso)."""
+
+# La IA (Ollama puede tardar hasta 30s) corre fuera del lock del navegador, en este pool compartido
+executor_ia = ThreadPoolExecutor(max_workers=int(os.environ.get('BOT_IA_WORKERS', 4)), thread_name_prefix="BotIA")
+
 
 def get_session_context(connection_id):
     """
@@ -38,16 +56,113 @@ def get_session_context(connection_id):
             active_sessions[connection_id] = {
                 'driver': None,
                 'lock': threading.RLock(),
-                'thread': None
+                'thread': None,
+                'salida': queue.Queue(),
+                'ultimo_uso': time.monotonic(),
+                'detener': threading.Event(),
+                'arrancando': False,
+                'sin_vincular': False,
+                # titulo -> badge al leerlo: chats ya leídos cuyo badge no se limpia (p. ej. silenciados)
+                'sin_limpiar': {},
             }
         return active_sessions[connection_id]
 
 
+# --- PERFILES DE ARRANQUE DE CHROME ---
+CHROME_BIN = "/usr/bin/chromium"
+CHROMEDRIVER_PATH = "/usr/bin/chromedriver"
+CHROME_ROOT_MOUNT = "/app/chrome_user_data"
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+
+# Si el bot no descarga imágenes recibidas, tampoco hace falta dejar pasar los CDN de media
+DESCARGAR_ADJUNTOS = os.environ.get('BOT_DESCARGAR_ADJUNTOS', '1') != '0'
+
+# 'estandar': el arranque de siempre. 'ligero': menos memoria y carga de página
+# (ventana más chica, sin servicios de fondo de Chrome y sin recursos que el bot no usa).
+PERFILES_CHROME = {
+    'estandar': {
+        'ventana': '1920,1080',
+        'argumentos': [],
+        'bloquear': [],
+    },
+    'ligero': {
+        # WhatsApp Web necesita ~1000px de ancho para mostrar la lista de chats junto al chat abierto
+        'ventana': '1100,800',
+        'argumentos': [
+            '--disable-extensions',
+            '--disable-background-networking',
+            '--disable-component-update',
+            '--disable-default-apps',
+            '--disable-sync',
+            '--disable-features=Translate,MediaRouter,OptimizationHints',
+            '--no-first-run',
+            '--mute-audio',
+            '--renderer-process-limit=2',
+        ],
+        # Patrones de Network.setBlockedURLs (CDP)
+        'bloquear': [
+            '*.woff', '*.woff2', '*.ttf', '*.otf',  # Fuentes: el bot lee texto, no lo dibuja
+            '*.mp3', '*.ogg', '*.wav',  # Sonidos de notificación
+            '*pps.whatsapp.net*',  # Fotos de perfil
+        ],
+    },
+}
+# CDN de adjuntos (imágenes, audio, video, documentos). Las imágenes 'blob:' salen de aquí.
+BLOQUEO_MEDIA = ['*mmg.whatsapp.net*', '*media*.cdn.whatsapp.net*']
+
+PERFIL_CHROME = os.environ.get('BOT_PERFIL_CHROME', 'estandar')
+
+
+def opciones_chrome(profile_dir, perfil=None):
+    config = PERFILES_CHROME[perfil or PERFIL_CHROME]
+    opts = Options()
+    opts.binary_location = CHROME_BIN
+    opts.add_argument(f"user-data-dir={profile_dir}")
+    opts.add_argument("--headless=new")
+    opts.add_argument("--no-sandbox")
+    opts.add_argument("--disable-dev-shm-usage")
+    opts.add_argument("--disable-gpu")
+    opts.add_argument(f"--window-size={config['ventana']}")
+    for argumento in config['argumentos']:
+        opts.add_argument(argumento)
+    opts.add_argument(f"user-agent={USER_AGENT}")
+    return opts
+
+
+def urls_bloqueadas(perfil=None):
+    bloquear = list(PERFILES_CHROME[perfil or PERFIL_CHROME]['bloquear'])
+    if bloquear and not DESCARGAR_ADJUNTOS:
+        bloquear += BLOQUEO_MEDIA
+    return bloquear
+
+
+def crear_driver(profile_dir, perfil=None, log_path=None):
+    """
+    Lanza Chrome con el perfil de arranque indicado (PERFIL_CHROME por defecto).
+    No navega ni registra la sesión: eso lo hace iniciar_navegador.
+    """
+    service = Service(executable_path=CHROMEDRIVER_PATH, log_path=log_path)
+    driver = webdriver.Chrome(service=service, options=opciones_chrome(profile_dir, perfil))
+
+    bloquear = urls_bloqueadas(perfil)
+    if bloquear:
+        # Bloqueo a nivel de red (CDP): ni siquiera se descargan
+        try:
+            driver.execute_cdp_cmd('Network.enable', {})
+            driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': bloquear})
+        except Exception as e:
+            print(f"⚠️ No se pudo aplicar el bloqueo de recursos: {e}")
+
+    driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
+    return driver
+
+
 def iniciar_navegador(connection_id):
     """
     Inicia el navegador para una conexión específica con su propio perfil persistente.
     """
     context = get_session_context(connection_id)
+    context['ultimo_uso'] = time.monotonic()
     driver = context.get('driver')
 
     # Verificar si el driver actual sigue vivo
@@ -62,31 +177,24 @@ def iniciar_navegador(connection_id):
                 pass
             context['driver'] = None
 
-    print(f"[ID:{connection_id}] 🔧 Iniciando motor de Chrome...")
-    chrome_bin = "/usr/bin/chromium"
-    driver_path = "/usr/bin/chromedriver"
-    root_mount = "/app/chrome_user_data"
+    # Arranque perezoso: solo aquí se abre Chrome, y solo si hay cupo (queda reservado hasta tener driver)
+    _reservar_cupo(connection_id)
+    try:
+        return _lanzar_navegador(connection_id, context)
+    finally:
+        with global_registry_lock:
+            context['arrancando'] = False
+
+
+def _lanzar_navegador(connection_id, context):
+    print(f"[ID:{connection_id}] 🔧 Iniciando motor de Chrome (perfil {PERFIL_CHROME})...")
 
     # PERFIL AISLADO POR ID
-    profile_dir = os.path.join(root_mount, f"session_{connection_id}")
-
-    def get_options():
-        opts = Options()
-        opts.binary_location = chrome_bin
-        opts.add_argument(f"user-data-dir={profile_dir}")
-        opts.add_argument("--headless=new")
-        opts.add_argument("--no-sandbox")
-        opts.add_argument("--disable-dev-shm-usage")
-        opts.add_argument("--disable-gpu")
-        opts.add_argument("--window-size=1920,1080")
-        opts.add_argument(
-            "user-agent=Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36")
-        return opts
-
-    service = Service(executable_path=driver_path, log_path=f"/app/chromedriver_{connection_id}.log")
+    profile_dir = os.path.join(CHROME_ROOT_MOUNT, f"session_{connection_id}")
+    log_path = f"/app/chromedriver_{connection_id}.log"
 
     try:
-        driver = webdriver.Chrome(service=service, options=get_options())
+        driver = crear_driver(profile_dir, log_path=log_path)
     except Exception as e:
         print(f"[ID:{connection_id}] ⚠️ Perfil bloqueado o corrupto. Limpiando...")
         try:
@@ -96,16 +204,79 @@ def iniciar_navegador(connection_id):
             pass
 
         print(f"[ID:{connection_id}] 🔄 Reiniciando limpio...")
-        driver = webdriver.Chrome(service=service, options=get_options())
-
-    driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
-    driver.get("https://web.whatsapp.com")
+        driver = crear_driver(profile_dir, log_path=log_path)
 
-    # Guardamos la referencia en el contexto de la sesión
+    # Guardamos la referencia en el contexto de la sesión antes de navegar: si driver.get falla,
+    # el Chrome sigue contado en el cupo y el próximo arranque lo reutiliza (o lo cierra si murió)
     context['driver'] = driver
+
+    driver.get("https://web.whatsapp.com")
     return driver
 
 
+def bot_activo(connection_id):
+    context = active_sessions.get(connection_id)
+    return bool(context and context.get('thread') and context['thread'].is_alive())
+
+
+def navegadores_abiertos():
+    with global_registry_lock:
+        return [cid for cid, ctx in active_sessions.items() if ctx.get('driver') is not None]
+
+
+def hibernar_sesion(connection_id):
+    """
+    Cierra el Chrome de una sesión sin bot conservando su perfil en disco:
+    al volver a usarla se reabre ya vinculada (sin escanear el QR de nuevo).
+    Retorna False si la sesión está en uso.
+    """
+    context = active_sessions.get(connection_id)
+    if context is None or context.get('driver') is None or bot_activo(connection_id):
+        return False
+    if not context['lock'].acquire(blocking=False):
+        return False
+    try:
+        driver, context['driver'] = context['driver'], None
+        if driver is None:
+            return False
+        try:
+            driver.quit()
+        except Exception:
+            pass
+        print(f"[ID:{connection_id}] 💤 Navegador hibernado (perfil conservado).")
+        return True
+    finally:
+        context['lock'].release()
+
+
+def _reservar_cupo(connection_id):
+    """
+    Garantiza un hueco antes de abrir otro Chrome. Si se alcanzó MAX_NAVEGADORES hiberna
+    la sesión ociosa usada hace más tiempo; si todas tienen bot, lanza LimiteSesionesError.
+    El hueco queda reservado ('arrancando') dentro del lock: los Chrome que se están lanzando
+    también cuentan, así varios arranques simultáneos no superan el tope.
+    """
+    with global_registry_lock:
+        ocupados = [
+            cid for cid, ctx in active_sessions.items()
+            if cid != connection_id and (ctx.get('driver') is not None or ctx.get('arrancando'))
+        ]
+        if len(ocupados) < MAX_NAVEGADORES:
+            active_sessions[connection_id]['arrancando'] = True
+            return
+
+        candidatos = sorted(
+            (cid for cid in ocupados if not bot_activo(cid) and active_sessions[cid].get('driver') is not None),
+            key=lambda cid: active_sessions[cid]['ultimo_uso']
+        )
+        for cid in candidatos:
+            if hibernar_sesion(cid):
+                active_sessions[connection_id]['arrancando'] = True
+                return
+
+    raise LimiteSesionesError(f"Límite de {MAX_NAVEGADORES} navegadores alcanzado")
+
+
 # --- LÓGICA DE SECUENCIA INTELIGENTE ---
 
 def garantizar_sesion_activa(connection_id):
@@ -132,6 +303,7 @@ def garantizar_sesion_activa(connection_id):
             # ESCENARIO A: YA ESTAMOS DENTRO
             if elemento.get_attribute("id") == "pane-side":
                 print(f"[ID:{connection_id}] ✅ ¡ÉXITO! Panel de chats detectado.")
+                context['sin_vincular'] = False
                 return True
 
             # ESCENARIO B: NECESITAMOS ESCANEAR
@@ -156,9 +328,12 @@ def garantizar_sesion_activa(connection_id):
 
             if time.time() - start_time >= timeout:
                 print(f"\n[ID:{connection_id}] ❌ Timeout esperando escaneo.")
+                # El supervisor no relanza sesiones sin vincular: reabrir Chrome no escanea el QR
+                context['sin_vincular'] = True
                 return False
 
             print(f"\n[ID:{connection_id}] 🎉 ¡VINCULACIÓN DETECTADA!")
+            context['sin_vincular'] = False
 
             # Estabilización
             for i in range(5, 0, -1):
@@ -190,6 +365,81 @@ def imprimir_resumen_chats(connection_id):
         print("-------------------------\n")
 
 
+SCRIPT_BUSCAR_CHAT = """
+    var titulo = arguments[0], prefijo = arguments[1], parecido = null;
+    var spans = document.querySelectorAll('#pane-side span[title]');
+    for (var i = 0; i < spans.length; i++) {
+        var actual = spans[i].getAttribute('title');
+        if (actual === titulo) { return spans[i]; }
+        if (prefijo && parecido === null && actual.indexOf(titulo) === 0) { parecido = spans[i]; }
+    }
+    return parecido;
+"""
+
+# Message.phone_number guarda el nombre del contacto truncado a este largo (ver crear_callback_browser)
+LARGO_CONTACTO = 20
+
+
+def _es_prefijo(nombre_contacto):
+    # Un nombre que llega con el largo máximo puede estar truncado: basta con que el título empiece así
+    return len(nombre_contacto) >= LARGO_CONTACTO
+
+
+def _chat_abierto(driver, nombre_contacto):
+    try:
+        titulo = driver.find_element(By.XPATH, '//header//span[@dir="auto"]').text
+    except Exception:
+        return False
+    return titulo == nombre_contacto or (_es_prefijo(nombre_contacto) and titulo.startswith(nombre_contacto))
+
+
+def _limpiar_buscador(buscador):
+    # Con la lista filtrada por la búsqueda no se verían los badges de otros chats
+    if buscador is None:
+        return
+    try:
+        buscador.send_keys(Keys.CONTROL, "a")
+        buscador.send_keys(Keys.BACKSPACE)
+    except Exception:
+        pass
+
+
+def _abrir_chat(driver, nombre_contacto):
+    """
+    Abre el chat cuyo título coincide con nombre_contacto.
+    Primero lo busca en la lista visible; si no está, usa el buscador de WhatsApp Web.
+    """
+    if _chat_abierto(driver, nombre_contacto):
+        return True
+
+    # Comparación exacta en JS: evita escapar comillas del nombre dentro de un XPath
+    elemento = driver.execute_script(SCRIPT_BUSCAR_CHAT, nombre_contacto, _es_prefijo(nombre_contacto))
+    buscador = None
+    if elemento is None:
+        try:
+            buscador = WebDriverWait(driver, 5).until(EC.element_to_be_clickable(
+                (By.XPATH, '//div[@contenteditable="true"][@data-tab="3"]')))
+            buscador.click()
+            buscador.send_keys(Keys.CONTROL, "a")
+            buscador.send_keys(nombre_contacto)
+            time.sleep(1.5)
+            elemento = driver.execute_script(SCRIPT_BUSCAR_CHAT, nombre_contacto, _es_prefijo(nombre_contacto))
+        except Exception:
+            elemento = None
+        if elemento is None:
+            _limpiar_buscador(buscador)
+            return False
+
+    try:
+        elemento.click()
+    except Exception:
+        driver.execute_script("arguments[0].click();", elemento)
+    time.sleep(1)
+
+    _limpiar_buscador(buscador)
+    return True
+
+
 def enviar_mensaje_browser(connection_id, nombre_contacto, mensaje):
     context = get_session_context(connection_id)
 
@@ -197,6 +447,11 @@ def enviar_mensaje_browser(connection_id, nombre_contacto, mensaje):
         driver = iniciar_navegador(connection_id)
         print(f"[ID:{connection_id}] ⌨️ Intentando escribir a: {nombre_contacto}...")
         try:
+            # La respuesta puede llegar cuando ya hay otro chat abierto: abrimos el del destinatario
+            if nombre_contacto and not _abrir_chat(driver, nombre_contacto):
+                print(f"[ID:{connection_id}] ❌ No se encontró el chat de {nombre_contacto}.")
+                return False
+
             xpath_input = '//footer//div[@contenteditable="true"][@role="textbox"]'
             wait = WebDriverWait(driver, 10)
 
@@ -221,10 +476,10 @@ def enviar_mensaje_browser(connection_id, nombre_contacto, mensaje):
                            """
             driver.execute_script(script_escritura, caja_texto, mensaje)
 
-            time.sleep(1)
-
+            # El botón de enviar aparece en cuanto WhatsApp registra el texto (antes: sleep fijo de 1s)
             try:
-                boton_enviar = driver.find_element(By.XPATH, '//span[@data-icon="send"]/ancestor::button')
+                boton_enviar = WebDriverWait(driver, 3, poll_frequency=0.1).until(EC.element_to_be_clickable(
+                    (By.XPATH, '//span[@data-icon="send"]/ancestor::button')))
                 boton_enviar.click()
             except:
                 caja_texto.send_keys(Keys.ENTER)
@@ -237,145 +492,409 @@ def enviar_mensaje_browser(connection_id, nombre_contacto, mensaje):
             return False
 
 
-def procesar_nuevos_mensajes(connection_id, callback_inteligencia):
-    context = get_session_context(connection_id)
+# --- LECTURA DE CHATS NO LEÍDOS ---
+# Presupuesto por ciclo: ningún chat con mucho tráfico puede acaparar el bot
+MAX_CHATS_POR_CICLO = int(os.environ.get('BOT_MAX_CHATS_POR_CICLO', 10))
+MAX_MENSAJES_POR_CHAT = int(os.environ.get('BOT_MAX_MENSAJES_POR_CHAT', 20))
 
+XPATH_INDICADORES = '//div[@id="pane-side"]//span[contains(@aria-label, "unread") or contains(@aria-label, "no leído")]'
+
+SCRIPT_BLOB_BASE64 = """
+    var uri = arguments[0];
+    var callback = arguments[1];
+    fetch(uri).then(r => r.blob()).then(blob => {
+        var reader = new FileReader();
+        reader.readAsDataURL(blob);
+        reader.onloadend = function() { callback(reader.result); }
+    }).catch(e => callback(null));
+"""
+
+
+def _contar_no_leidos(indicador):
+    """Lee el número del badge ('3 unread messages' / '3 mensajes no leídos'). Mínimo 1."""
     try:
-        # Usamos el lock de esta sesión específica
-        with context['lock']:
-            driver = iniciar_navegador(connection_id)
-            wait = WebDriverWait(driver, 5)
+        match = re.search(r'\d+', indicador.get_attribute("aria-label") or indicador.text or '')
+        return max(int(match.group()), 1) if match else 1
+    except Exception:
+        return 1
 
-            xpath_indicadores = '//div[@id="pane-side"]//span[contains(@aria-label, "unread") or contains(@aria-label, "no leído")]'
-            indicadores = driver.find_elements(By.XPATH, xpath_indicadores)
 
-            if not indicadores:
-                return False
+def _titulo_chat(chat_element):
+    try:
+        return chat_element.find_element(By.XPATH, './/span[@title]').get_attribute("title")
+    except Exception:
+        return None
 
-            print(f"\n[ID:{connection_id}] 🔔 Mensaje nuevo detectado ({len(indicadores)} pendientes).")
-            indicador = indicadores[0]
 
-            try:
-                chat_element = indicador.find_element(By.XPATH, './ancestor::div[@role="listitem"]')
-            except:
-                chat_element = indicador
+# blob: ya traídos del navegador -> Future de image_pipeline (una imagen que se vuelve a leer no se transfiere otra vez)
+_blobs_traidos = OrderedDict()
+_blobs_lock = threading.Lock()
+MAX_BLOBS_RECORDADOS = 500
 
-            driver.execute_script("arguments[0].scrollIntoView(true);", chat_element)
-            time.sleep(0.5)
 
-            try:
-                chat_element.click()
-            except:
-                driver.execute_script("arguments[0].click();", chat_element)
+def _descargar_imagen(driver, img_element):
+    """
+    Trae la imagen (blob: de WhatsApp Web) del navegador. Es lo único que necesita el lock:
+    el hash, el WEBP y las dimensiones se calculan en image_pipeline.
+    Devuelve un Future con el resultado, o None.
+    """
+    blob_url = img_element.get_attribute("src")
+    with _blobs_lock:
+        futuro = _blobs_traidos.get(blob_url)
+    if futuro is not None:
+        return futuro
+
+    data_url = driver.execute_async_script(SCRIPT_BLOB_BASE64, blob_url)
+    if not data_url:
+        return None
+
+    # Mismo almacén (y presupuesto de caché) que la multimedia de la Cloud API
+    futuro = image_pipeline.procesar(data_url, settings.MEDIA_ROOT, media_store.SUBDIRECTORIO)
+    with _blobs_lock:
+        _blobs_traidos[blob_url] = futuro
+        while len(_blobs_traidos) > MAX_BLOBS_RECORDADOS:
+            _blobs_traidos.popitem(last=False)
+    return futuro
+
+
+def _extraer_mensaje(driver, msg_container):
+    """
+    Extrae (texto, nombre, tipo_adjunto) de un div.message-in.
+    tipo_adjunto es 'VIDEO'/'AUDIO'/'DOCUMENTO', el Future de la imagen (image_pipeline) o None.
+    """
+    texto = ""
+    nombre = "Desconocido"
+    tipo_adjunto = None
+
+    try:
+        if msg_container.find_elements(By.CSS_SELECTOR, "span[data-icon='video-play']"):
+            tipo_adjunto = "VIDEO"
+        elif msg_container.find_elements(By.CSS_SELECTOR, "span[data-icon='audio-play']"):
+            tipo_adjunto = "AUDIO"
+        elif msg_container.find_elements(By.CSS_SELECTOR, "span[data-icon^='doc-']"):
+            tipo_adjunto = "DOCUMENTO"
+        else:
+            imgs_detectadas = msg_container.find_elements(By.CSS_SELECTOR, "div[role='button'] img[src^='blob:']")
+            if imgs_detectadas:
+                tipo_adjunto = "IMAGEN"
+                try:
+                    # Con BOT_DESCARGAR_ADJUNTOS=0 solo se informa el tipo
+                    if DESCARGAR_ADJUNTOS:
+                        tipo_adjunto = _descargar_imagen(driver, imgs_detectadas[0]) or tipo_adjunto
+                except Exception as e_img:
+                    print(f"   ⚠️ Error imagen: {e_img}")
 
-            time.sleep(2)
+    except Exception as e_media:
+        print(f"⚠️ Error media: {e_media}")
 
-            # --- LECTURA DE MENSAJES ---
-            msgs_containers = driver.find_elements(By.CSS_SELECTOR, "div.message-in")
-            if not msgs_containers:
-                webdriver.ActionChains(driver).send_keys(Keys.ESCAPE).perform()
-                return False
+    try:
+        nucleo_mensaje = msg_container.find_element(By.CSS_SELECTOR, "div[data-pre-plain-text]")
+        raw_data = nucleo_mensaje.get_attribute("data-pre-plain-text")
+        if raw_data:
+            match = re.search(r']\s(.*?):', raw_data)
+            if match: nombre = match.group(1).strip()
 
-            last_msg_container = msgs_containers[-1]
-            texto = ""
-            nombre = "Desconocido"
-            tipo_adjunto = None
+        try:
+            element_texto = nucleo_mensaje.find_element(By.CSS_SELECTOR, "span[data-testid='selectable-text']")
+            texto = element_texto.text
+        except:
+            element_texto = nucleo_mensaje.find_element(By.CSS_SELECTOR, "span.selectable-text")
+            texto = element_texto.text
+    except:
+        try:
+            texto = msg_container.text.split('\n')[0]
+        except:
+            pass
 
-            try:
-                if last_msg_container.find_elements(By.CSS_SELECTOR, "span[data-icon='video-play']"):
-                    tipo_adjunto = "VIDEO"
-                elif last_msg_container.find_elements(By.CSS_SELECTOR, "span[data-icon='audio-play']"):
-                    tipo_adjunto = "AUDIO"
-                elif last_msg_container.find_elements(By.CSS_SELECTOR, "span[data-icon^='doc-']"):
-                    tipo_adjunto = "DOCUMENTO"
-                else:
-                    imgs_detectadas = last_msg_container.find_elements(By.CSS_SELECTOR,
-                                                                       "div[role='button'] img[src^='blob:']")
-                    if imgs_detectadas:
-                        tipo_adjunto = "IMAGEN"
-                        try:
-                            blob_url = imgs_detectadas[0].get_attribute("src")
-                            script_js = """
-                                var uri = arguments[0];
-                                var callback = arguments[1];
-                                fetch(uri).then(r => r.blob()).then(blob => {
-                                    var reader = new FileReader();
-                                    reader.readAsDataURL(blob);
-                                    reader.onloadend = function() { callback(reader.result); }
-                                }).catch(e => callback(null));
-                            """
-                            resultado_base64 = driver.execute_async_script(script_js, blob_url)
-
-                            if resultado_base64:
-                                header, encoded = resultado_base64.split(",", 1)
-                                data_bytes = base64.b64decode(encoded)
-                                imagen_pil = Image.open(io.BytesIO(data_bytes))
-
-                                output_dir = "/app/media/whatsapp_received"
-                                os.makedirs(output_dir, exist_ok=True)
-                                nombre_archivo = f"img_{uuid.uuid4().hex[:8]}.webp"
-                                ruta_final = os.path.join(output_dir, nombre_archivo)
-                                imagen_pil.save(ruta_final, "WEBP", quality=80)
-
-                                tipo_adjunto = ruta_final
-                        except Exception as e_img:
-                            print(f"   ⚠️ Error imagen: {e_img}")
-
-            except Exception as e_media:
-                print(f"⚠️ Error media: {e_media}")
-
-            # Extracción de Texto y Nombre (Simplificada para brevedad, misma lógica original)
-            try:
-                nucleo_mensaje = last_msg_container.find_element(By.CSS_SELECTOR, "div[data-pre-plain-text]")
-                raw_data = nucleo_mensaje.get_attribute("data-pre-plain-text")
-                if raw_data:
-                    match = re.search(r']\s(.*?):', raw_data)
-                    if match: nombre = match.group(1).strip()
+    return texto, nombre, tipo_adjunto
 
-                try:
-                    element_texto = nucleo_mensaje.find_element(By.CSS_SELECTOR, "span[data-testid='selectable-text']")
-                    texto = element_texto.text
-                except:
-                    element_texto = nucleo_mensaje.find_element(By.CSS_SELECTOR, "span.selectable-text")
-                    texto = element_texto.text
-            except:
-                try:
-                    texto = last_msg_container.text.split('\n')[0]
-                except:
-                    pass
 
-            if nombre == "Desconocido":
-                try:
-                    nombre = driver.find_element(By.XPATH, '//header//span[@dir="auto"]').text
-                except:
-                    nombre = "Usuario"
+def _invocar_callback(callback_inteligencia, texto, nombre, adjunto, lote, destino=None):
+    # Callbacks antiguos no conocen 'destino', 'lote' (ni a veces 'adjunto'): degradamos la firma
+    try:
+        return callback_inteligencia(texto, nombre, adjunto=adjunto, lote=lote, destino=destino)
+    except TypeError:
+        pass
+    try:
+        return callback_inteligencia(texto, nombre, adjunto=adjunto, lote=lote)
+    except TypeError:
+        try:
+            return callback_inteligencia(texto, nombre, adjunto=adjunto)
+        except TypeError:
+            return callback_inteligencia(texto, nombre)
 
-            print(f"[ID:{connection_id}] 📩 {nombre}: {texto} [Adj: {tipo_adjunto}]")
 
-            if texto or tipo_adjunto:
-                try:
-                    # Pasamos connection_id al callback por si necesita contexto (opcional) o la lógica original
+def _tarea_ia(connection_id, callback_inteligencia, destino, texto, nombre, adjunto, lote):
+    """Corre en executor_ia, sin el lock del navegador. Deja la respuesta en la cola de salida."""
+    # Las imágenes se terminan de procesar en image_pipeline: aquí se espera la ruta final
+    adjunto, _ = image_pipeline.resolver(adjunto)
+    for recibido in lote:
+        recibido['adjunto'], recibido['imagen'] = image_pipeline.resolver(recibido['adjunto'])
+        # El mismo Future puede llegar en varios lotes: el archivo nuevo se cuenta una vez
+        if recibido['imagen'] and recibido['imagen'].pop('nuevo', False):
+            media_store.registrar_en_cache(recibido['imagen']['bytes'])
+
+    try:
+        respuesta = _invocar_callback(callback_inteligencia, texto, nombre, adjunto, lote, destino)
+    except Exception as e:
+        print(f"❌ Error en callback IA: {e}")
+        return
+
+    if respuesta:
+        print(f"[ID:{connection_id}] 🤖 Respuesta para {destino}: {respuesta[:30]}...")
+        get_session_context(connection_id)['salida'].put((destino, respuesta))
+
+
+def enviar_respuestas_pendientes(connection_id):
+    """
+    Escribe en el navegador las respuestas que ya calculó la IA.
+    Sin respuestas pendientes no toma el lock. Devuelve cuántas se enviaron.
+    """
+    salida = get_session_context(connection_id)['salida']
+    enviadas = 0
+    while True:
+        try:
+            destino, respuesta = salida.get_nowait()
+        except queue.Empty:
+            return enviadas
+        if enviar_mensaje_browser(connection_id, destino, respuesta):
+            enviadas += 1
+
+
+def _procesar_chat(connection_id, driver, indicador, callback_inteligencia):
+    """
+    Abre el chat del indicador, lee TODOS sus mensajes no leídos (hasta MAX_MENSAJES_POR_CHAT)
+    y encola la ráfaga para la IA. Devuelve el título del chat procesado.
+    """
+    pendientes = min(_contar_no_leidos(indicador), MAX_MENSAJES_POR_CHAT)
+
+    try:
+        chat_element = indicador.find_element(By.XPATH, './ancestor::div[@role="listitem"]')
+    except:
+        chat_element = indicador
+    titulo = _titulo_chat(chat_element)
+
+    driver.execute_script("arguments[0].scrollIntoView(true);", chat_element)
+    time.sleep(0.5)
+
+    try:
+        chat_element.click()
+    except:
+        driver.execute_script("arguments[0].click();", chat_element)
+
+    time.sleep(2)
+
+    msgs_containers = driver.find_elements(By.CSS_SELECTOR, "div.message-in")
+    if not msgs_containers:
+        webdriver.ActionChains(driver).send_keys(Keys.ESCAPE).perform()
+        return titulo
+
+    lote = []
+    nombre = "Desconocido"
+    for msg_container in msgs_containers[-pendientes:]:
+        texto, nombre_msg, tipo_adjunto = _extraer_mensaje(driver, msg_container)
+        if nombre_msg != "Desconocido":
+            nombre = nombre_msg
+        if texto or tipo_adjunto:
+            lote.append({'texto': texto, 'adjunto': tipo_adjunto})
+
+    if nombre == "Desconocido":
+        try:
+            nombre = driver.find_element(By.XPATH, '//header//span[@dir="auto"]').text
+        except:
+            nombre = titulo or "Usuario"
+
+    print(f"[ID:{connection_id}] 📩 {nombre}: {len(lote)} mensaje(s) nuevo(s).")
+
+    if lote:
+        # Una sola llamada por ráfaga: textos unidos y el adjunto más reciente.
+        # La IA corre en executor_ia; el navegador queda libre para el siguiente chat.
+        texto = "\n".join(m['texto'] for m in lote if m['texto'])
+        adjunto = next((m['adjunto'] for m in reversed(lote) if m['adjunto']), None)
+        executor_ia.submit(_tarea_ia, connection_id, callback_inteligencia, titulo or nombre,
+                           texto, nombre, adjunto, lote)
+
+    webdriver.ActionChains(driver).send_keys(Keys.ESCAPE).perform()
+    time.sleep(1)
+    return titulo
+
+
+def procesar_nuevos_mensajes(connection_id, callback_inteligencia):
+    """
+    Recorre todos los chats con mensajes no leídos en una sola pasada.
+    Devuelve cuántos chats se procesaron (0 si no había nada pendiente).
+    """
+    context = get_session_context(connection_id)
+    sin_limpiar = context['sin_limpiar']
+    procesados = 0
+    vistos = set()
+    leidos = {}  # titulo -> badge al abrirlo en esta pasada
+
+    try:
+        # Usamos el lock de esta sesión específica
+        with context['lock']:
+            driver = iniciar_navegador(connection_id)
+
+            while procesados < MAX_CHATS_POR_CICLO:
+                # Se vuelve a consultar tras cada chat: el DOM de la lista cambia al abrirlos
+                candidatos = []
+                for candidato in driver.find_elements(By.XPATH, XPATH_INDICADORES):
                     try:
-                        respuesta = callback_inteligencia(texto, nombre, adjunto=tipo_adjunto)
-                    except TypeError:
-                        respuesta = callback_inteligencia(texto, nombre)
-
-                    if respuesta:
-                        print(f"[ID:{connection_id}] 🤖 Respuesta: {respuesta[:30]}...")
-                        # IMPORTANTE: Llamada recursiva interna usa el ID
-                        # Para evitar deadlock, enviar_mensaje_browser también adquiere el lock,
-                        # pero RLock permite reentrada del mismo hilo.
-                        enviar_mensaje_browser(connection_id, nombre, respuesta)
-                except Exception as e:
-                    print(f"❌ Error en callback IA: {e}")
-
-            webdriver.ActionChains(driver).send_keys(Keys.ESCAPE).perform()
-            time.sleep(1)
-            return True
+                        chat = candidato.find_element(By.XPATH, './ancestor::div[@role="listitem"]')
+                    except:
+                        chat = candidato
+                    candidatos.append((candidato, _titulo_chat(chat), _contar_no_leidos(candidato)))
+
+                for _, titulo, no_leidos in candidatos:
+                    if leidos.get(titulo) == no_leidos:
+                        sin_limpiar[titulo] = no_leidos  # ya se leyó y el badge sigue igual
+                # Un chat cuyo badge no se limpió no se repite en el mismo ciclo, ni en los siguientes
+                # mientras el badge no cambie: si no, cada evento del panel lo volvería a abrir
+                pendientes = [
+                    (candidato, no_leidos) for candidato, titulo, no_leidos in candidatos
+                    if titulo is None or (titulo not in vistos and sin_limpiar.get(titulo) != no_leidos)
+                ]
+                if procesados == 0:
+                    presentes = {titulo for _, titulo, _ in candidatos}
+                    for titulo in [t for t in sin_limpiar if t not in presentes]:
+                        del sin_limpiar[titulo]  # su badge ya se limpió
+                    if pendientes:
+                        print(f"\n[ID:{connection_id}] 🔔 Mensajes nuevos detectados ({len(pendientes)} chats pendientes).")
+
+                if not pendientes:
+                    break
+
+                indicador, no_leidos = pendientes[0]
+                titulo = _procesar_chat(connection_id, driver, indicador, callback_inteligencia)
+                vistos.add(titulo)
+                if titulo:
+                    leidos[titulo] = no_leidos
+                procesados += 1
+
+            if procesados >= MAX_CHATS_POR_CICLO:
+                print(f"[ID:{connection_id}] ⏭️ Presupuesto del ciclo agotado ({MAX_CHATS_POR_CICLO} chats). Sigue en el próximo.")
+            return procesados
 
     except Exception as e:
         print(f"[ID:{connection_id}] ⚠️ Error leve procesando mensaje: {e}")
-        return False
+        return procesados
+
+
+# --- DETECCIÓN POR EVENTOS (MutationObserver) ---
+# 'observer': WhatsApp Web avisa de los mensajes nuevos y el bot solo lee una cola en memoria.
+# 'polling': modo clásico, XPath sobre #pane-side cada INTERVALO_POLLING segundos.
+MODO_DETECCION = os.environ.get('BOT_MODO_DETECCION', 'observer')
+INTERVALO_POLLING = 5
+INTERVALO_EVENTOS = 0.5  # Segundos entre lecturas de la cola de eventos (una llamada execute_script)
+ESCANEO_SEGURIDAD = 60  # Escaneo completo periódico por si el observer perdiera algún cambio
+MAX_PASADAS_SEGUIDAS = 5  # Pasadas sin esperar cuando se agota el presupuesto de chats del ciclo
+
+# Instala (si hace falta) el observer sobre el DOM y devuelve los eventos acumulados.
+# Retorna null si todavía no existe el panel de chats.
+SCRIPT_EVENTOS = """
+    var selector = '#pane-side span[aria-label*="unread"], #pane-side span[aria-label*="no leído"]';
+    if (!window.__dsiObservador) {
+        var app = document.getElementById('app') || document.body;
+        if (!document.getElementById('pane-side')) { return null; }
+        window.__dsiEventos = [];
+        window.__dsiObservador = new MutationObserver(function(mutaciones) {
+            for (var i = 0; i < mutaciones.length; i++) {
+                var nodo = mutaciones[i].target;
+                var el = nodo.nodeType === 1 ? nodo : nodo.parentElement;
+                if (el && el.closest && el.closest('#pane-side')) {
+                    var pendientes = document.querySelectorAll(selector).length;
+                    if (pendientes && window.__dsiEventos.length < 100) {
+                        window.__dsiEventos.push({ts: Date.now(), pendientes: pendientes});
+                    }
+                    return;
+                }
+            }
+        });
+        window.__dsiObservador.observe(app, {
+            childList: true, subtree: true, characterData: true,
+            attributes: true, attributeFilter: ['aria-label']
+        });
+        // Chats que ya estaban sin leer al instalar el observer
+        var iniciales = document.querySelectorAll(selector).length;
+        if (iniciales) { window.__dsiEventos.push({ts: Date.now(), pendientes: iniciales}); }
+    }
+    return window.__dsiEventos.splice(0);
+"""
+
+
+def leer_eventos(connection_id):
+    """
+    Lee (y vacía) la cola de eventos que llena el MutationObserver dentro de WhatsApp Web.
+    Retorna una lista de eventos, o None si no se pudo instalar el observer.
+    Si la página se recarga, el observer se reinstala solo en la siguiente lectura.
+    """
+    context = get_session_context(connection_id)
+    with context['lock']:
+        driver = iniciar_navegador(connection_id)
+        try:
+            return driver.execute_script(SCRIPT_EVENTOS)
+        except Exception as e:
+            print(f"[ID:{connection_id}] ⚠️ No se pudo leer la cola de eventos: {e}")
+            return None
+
+
+def _esperar(connection_id, segundos):
+    """Pausa del bucle que sigue enviando las respuestas de la IA a medida que terminan."""
+    limite = time.monotonic() + segundos
+    while True:
+        enviar_respuestas_pendientes(connection_id)
+        restante = limite - time.monotonic()
+        if restante <= 0:
+            return
+        time.sleep(min(INTERVALO_EVENTOS, restante))
+
+
+def _bucle_polling(connection_id, callback_ia):
+    detener = get_session_context(connection_id)['detener']
+    iteracion = 0
+    while not detener.is_set():
+        iteracion += 1
+        if iteracion % 6 == 0:
+            print(f"   [ID:{connection_id}] ♻️ Escaneando... ({time.strftime('%H:%M:%S')})")
+
+        procesar_nuevos_mensajes(connection_id, callback_ia)
+        _esperar(connection_id, INTERVALO_POLLING)
+
+
+def _bucle_eventos(connection_id, callback_ia):
+    """
+    Reacciona a los eventos del MutationObserver: sin mensajes nuevos no toca el DOM
+    (solo una llamada barata a execute_script cada INTERVALO_EVENTOS).
+    """
+    context = get_session_context(connection_id)
+    detener = context['detener']
+    ultimo_escaneo = 0
+    while not detener.is_set():
+        eventos = leer_eventos(connection_id)
+        if eventos and max(e.get('pendientes', 0) for e in eventos) <= len(context['sin_limpiar']):
+            # Solo quedan badges que ya se leyeron y no se limpian: el panel cambia (escribiendo...,
+            # horas) pero no hay nada nuevo. Un cambio dentro de esos chats lo recoge ESCANEO_SEGURIDAD
+            eventos = []
+
+        if eventos is None:
+            # Observer no disponible (panel aún cargando): degradamos a polling en este ciclo
+            procesar_nuevos_mensajes(connection_id, callback_ia)
+            _esperar(connection_id, INTERVALO_POLLING)
+            continue
+
+        if eventos or time.monotonic() - ultimo_escaneo > ESCANEO_SEGURIDAD:
+            if eventos:
+                print(f"[ID:{connection_id}] ⚡ {len(eventos)} evento(s) de mensajes nuevos.")
+            ultimo_escaneo = time.monotonic()
+            # Si se agotó el presupuesto del ciclo repetimos sin esperar (quedan chats pendientes),
+            # con tope y enviando entre pasadas las respuestas que ya calculó la IA
+            for _ in range(MAX_PASADAS_SEGUIDAS):
+                if procesar_nuevos_mensajes(connection_id, callback_ia) < MAX_CHATS_POR_CICLO or detener.is_set():
+                    break
+                enviar_respuestas_pendientes(connection_id)
+            continue
+
+        _esperar(connection_id, INTERVALO_EVENTOS)
 
 
 def iniciar_bucle_bot(connection_id, callback_ia):
@@ -383,6 +902,7 @@ def iniciar_bucle_bot(connection_id, callback_ia):
     Inicia el bucle para UN ID específico.
     """
     print(f"[ID:{connection_id}] 🚀 SISTEMA DE BOT INICIADO")
+    get_session_context(connection_id)['detener'].clear()
 
     if not garantizar_sesion_activa(connection_id):
         print(f"[ID:{connection_id}] ❌ Fallo crítico al iniciar sesión.")
@@ -390,20 +910,25 @@ def iniciar_bucle_bot(connection_id, callback_ia):
 
     imprimir_resumen_chats(connection_id)
 
-    print(f"[ID:{connection_id}] ✅ ROBOT OPERATIVO Y ESCUCHANDO...")
+    print(f"[ID:{connection_id}] ✅ ROBOT OPERATIVO Y ESCUCHANDO... (modo: {MODO_DETECCION})")
 
-    iteracion = 0
     try:
-        while True:
-            iteracion += 1
-            if iteracion % 6 == 0:
-                print(f"   [ID:{connection_id}] ♻️ Escaneando... ({time.strftime('%H:%M:%S')})")
-
-            procesar_nuevos_mensajes(connection_id, callback_ia)
-            time.sleep(5)
+        if MODO_DETECCION == 'polling':
+            _bucle_polling(connection_id, callback_ia)
+        else:
+            _bucle_eventos(connection_id, callback_ia)
 
     except KeyboardInterrupt:
-        print(f"\n[ID:{connection_id}] 🛑 Detenido.")
+        pass
+    print(f"\n[ID:{connection_id}] 🛑 Detenido.")
+
+
+def detener_bot(connection_id):
+    """Pide al bucle del bot que termine tras el ciclo en curso. Retorna False si no había bot."""
+    if not bot_activo(connection_id):
+        return False
+    get_session_context(connection_id)['detener'].set()
+    return True
 
 
 def obtener_qr_screenshot(connection_id):
@@ -437,6 +962,8 @@ def obtener_qr_screenshot(connection_id):
         except:
             return None, "CARGANDO"
 
+    except LimiteSesionesError:
+        return None, "LIMITE_SESIONES"
     except Exception as e:
         print(f"❌ Error obteniendo QR ({connection_id}): {e}")
         return None, "ERROR"
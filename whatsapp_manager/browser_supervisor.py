@@ -0,0 +1,283 @@
+"""
+Supervisor de las sesiones de navegador (bot de WhatsApp Web).
+
+browser_service abre un Chromium por conexión bajo demanda y respeta el tope
+BOT_MAX_NAVEGADORES. Este módulo añade la parte de operación:
+
+- Arranque de bots registrado: el supervisor recuerda qué conexiones deben tener bot
+  y, si el hilo muere, lo relanza con backoff exponencial. Deja de hacerlo tras MAX_FALLOS
+  caídas seguidas, o si el bot terminó porque nadie escaneó el QR (relanzarlo solo reabriría
+  Chrome); en ambos casos se vuelve a iniciar a mano.
+- Hibernación: las sesiones sin bot que llevan un rato sin usarse cierran Chrome
+  (el perfil queda en disco, así que al volver no hace falta escanear el QR).
+- Métricas por sesión: memoria (RSS) y CPU del árbol de procesos chromedriver + Chrome,
+  leídas de /proc.
+"""
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from . import browser_service
+
+logger = logging.getLogger(__name__)
+
+CONFIG_POR_DEFECTO = {
+    'INTERVALO': 15,  # segundos entre revisiones
+    'INACTIVIDAD_HIBERNAR': 600,  # segundos sin uso antes de cerrar Chrome de una sesión sin bot
+    'BACKOFF_BASE': 5,
+    'BACKOFF_MAX': 300,
+    'ESTABLE_TRAS': 300,  # segundos vivo tras los que se olvidan los fallos anteriores
+    'MAX_FALLOS': 10,  # caídas seguidas tras las que el bot deja de relanzarse
+}
+
+
+def _config():
+    return {**CONFIG_POR_DEFECTO, **getattr(settings, 'WHATSAPP_BROWSER_SUPERVISOR', {})}
+
+
+# --- MÉTRICAS DE PROCESOS (/proc) ---
+
+_TICKS_POR_SEGUNDO = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+_TAMANO_PAGINA = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def _leer_stat(pid):
+    """Devuelve (ppid, ticks de CPU, rss en bytes) o None si el proceso ya no existe."""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # El nombre del proceso va entre paréntesis y puede contener espacios
+            campos = f.read().rsplit(')', 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    ppid = int(campos[1])
+    ticks = int(campos[11]) + int(campos[12])  # utime + stime
+    rss = int(campos[21]) * _TAMANO_PAGINA
+    return ppid, ticks, rss
+
+
+def _arbol_procesos(pid_raiz):
+    """pid_raiz y todos sus descendientes (Chrome lanza renderer, GPU, zygote...)."""
+    hijos = {}
+    try:
+        pids = [int(p) for p in os.listdir('/proc') if p.isdigit()]
+    except OSError:
+        return {}
+    stats = {}
+    for pid in pids:
+        stat = _leer_stat(pid)
+        if stat:
+            stats[pid] = stat
+            hijos.setdefault(stat[0], []).append(pid)
+
+    arbol = {}
+    pendientes = [pid_raiz]
+    while pendientes:
+        pid = pendientes.pop()
+        if pid in stats and pid not in arbol:
+            arbol[pid] = stats[pid]
+            pendientes.extend(hijos.get(pid, []))
+    return arbol
+
+
+def _pid_driver(driver):
+    try:
+        return driver.service.process.pid
+    except AttributeError:
+        return None
+
+
+def memoria_driver(driver):
+    """(cantidad de procesos, RSS total en bytes) de chromedriver + Chrome de un driver."""
+    pid = _pid_driver(driver)
+    arbol = _arbol_procesos(pid) if pid else {}
+    return len(arbol), sum(rss for _, _, rss in arbol.values())
+
+
+class BrowserSupervisor:
+    """Hilo que vigila las sesiones de browser_service. Uno por proceso (obtener_supervisor)."""
+
+    def __init__(self, intervalo=15, inactividad_hibernar=600, backoff_base=5, backoff_max=300, estable_tras=300,
+                 max_fallos=10):
+        self.intervalo = intervalo
+        self.inactividad_hibernar = inactividad_hibernar
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.estable_tras = estable_tras
+        self.max_fallos = max_fallos
+        # connection_id -> {'callback', 'fallos', 'proximo_intento', 'iniciado'}
+        self._bots = {}
+        self._muestras_cpu = {}  # connection_id -> (instante, ticks)
+        self._lock = threading.Lock()
+        self._detener = threading.Event()
+        self._hilo = None
+
+    # --- CICLO DE VIDA ---
+
+    def esta_activo(self):
+        return self._hilo is not None and self._hilo.is_alive()
+
+    def iniciar(self):
+        with self._lock:
+            if self.esta_activo():
+                return False
+            self._detener.clear()
+            self._hilo = threading.Thread(target=self._bucle, name="BrowserSupervisor", daemon=True)
+            self._hilo.start()
+            logger.info(f"🚀 Supervisor de navegadores iniciado (máx. {browser_service.MAX_NAVEGADORES}).")
+            return True
+
+    def detener(self):
+        self._detener.set()
+
+    # --- BOTS ---
+
+    def iniciar_bot(self, connection_id, callback):
+        """
+        Registra el bot de una conexión y lo lanza si no está corriendo.
+        A partir de aquí el supervisor lo relanza si el hilo muere.
+        """
+        self.iniciar()
+        # Comprobar y lanzar bajo el lock: dos 'start' a la vez (worker de órdenes, API y panel)
+        # no pueden abrir dos hilos sobre el mismo perfil de Chrome
+        with self._lock:
+            # Un arranque manual empieza de cero (p. ej. tras escanear el QR)
+            self._bots[connection_id] = {'fallos': 0, 'proximo_intento': 0, 'iniciado': 0, 'callback': callback}
+            if browser_service.bot_activo(connection_id):
+                return False
+            self._lanzar(connection_id)
+            return True
+
+    def detener_bot(self, connection_id):
+        """Deja de supervisar el bot (no lo relanza). Para cortar el hilo: browser_service.detener_bot."""
+        with self._lock:
+            self._bots.pop(connection_id, None)
+
+    def _lanzar(self, connection_id):
+        # Llamar con self._lock tomado
+        estado = self._bots.get(connection_id)
+        if estado is None:
+            return
+        context = browser_service.get_session_context(connection_id)
+        t = threading.Thread(
+            target=browser_service.iniciar_bucle_bot,
+            args=(connection_id, estado['callback']),
+            name=f"Bot_{connection_id}",
+            daemon=True
+        )
+        estado['iniciado'] = time.monotonic()
+        context['thread'] = t
+        t.start()
+
+    # --- REVISIÓN PERIÓDICA ---
+
+    def _bucle(self):
+        while not self._detener.wait(self.intervalo):
+            try:
+                self.revisar()
+            except Exception as e:
+                logger.error(f"❌ Error en el supervisor de navegadores: {e}")
+
+    def revisar(self):
+        ahora = time.monotonic()
+
+        with self._lock:
+            bots = list(self._bots.items())
+        for connection_id, estado in bots:
+            if browser_service.bot_activo(connection_id):
+                if estado['fallos'] and ahora - estado['iniciado'] > self.estable_tras:
+                    estado['fallos'] = 0
+                continue
+
+            # El hilo murió (Chrome caído, sesión cerrada, límite de navegadores...)
+            if ahora < estado['proximo_intento']:
+                continue
+            context = browser_service.active_sessions.get(connection_id, {})
+            if context.get('sin_vincular'):
+                logger.warning(f"⏸️ [ID:{connection_id}] Bot detenido: el QR no se escaneó. No se relanza "
+                               f"hasta iniciarlo de nuevo.")
+                self.detener_bot(connection_id)
+                continue
+            if estado['fallos'] >= self.max_fallos:
+                logger.error(f"⛔ [ID:{connection_id}] Bot caído {estado['fallos']} veces seguidas. "
+                             f"No se relanza hasta iniciarlo de nuevo.")
+                self.detener_bot(connection_id)
+                continue
+            with self._lock:
+                if self._bots.get(connection_id) is not estado or browser_service.bot_activo(connection_id):
+                    continue  # lo acaba de (re)iniciar un 'start'
+                estado['fallos'] += 1
+                espera = min(self.backoff_base * 2 ** (estado['fallos'] - 1), self.backoff_max)
+                estado['proximo_intento'] = ahora + espera
+                logger.warning(f"♻️ [ID:{connection_id}] Bot caído, relanzando (intento {estado['fallos']}, "
+                               f"siguiente en {espera}s si vuelve a fallar).")
+                self._lanzar(connection_id)
+
+        for connection_id in browser_service.navegadores_abiertos():
+            context = browser_service.active_sessions[connection_id]
+            if ahora - context['ultimo_uso'] > self.inactividad_hibernar:
+                browser_service.hibernar_sesion(connection_id)
+
+    # --- MÉTRICAS ---
+
+    def metricas(self):
+        """Estado, memoria y CPU de cada sesión conocida en este proceso."""
+        ahora = time.monotonic()
+        resultado = []
+        with browser_service.global_registry_lock:
+            sesiones = list(browser_service.active_sessions.items())
+
+        for connection_id, context in sesiones:
+            driver = context.get('driver')
+            estado = self._bots.get(connection_id, {})
+            fila = {
+                'connection_id': connection_id,
+                'navegador_abierto': driver is not None,
+                'bot_activo': browser_service.bot_activo(connection_id),
+                'bot_supervisado': connection_id in self._bots,
+                'fallos': estado.get('fallos', 0),
+                'inactivo_seg': round(ahora - context['ultimo_uso'], 1),
+                'procesos': 0,
+                'memoria_mb': None,
+                'cpu_pct': None,
+            }
+
+            pid = _pid_driver(driver) if driver is not None else None
+            if pid:
+                arbol = _arbol_procesos(pid)
+                ticks = sum(t for _, t, _ in arbol.values())
+                fila['procesos'] = len(arbol)
+                fila['memoria_mb'] = round(sum(r for _, _, r in arbol.values()) / (1024 * 1024), 1)
+
+                anterior = self._muestras_cpu.get(connection_id)
+                self._muestras_cpu[connection_id] = (ahora, ticks)
+                if anterior and ahora > anterior[0]:
+                    segundos_cpu = (ticks - anterior[1]) / _TICKS_POR_SEGUNDO
+                    fila['cpu_pct'] = round(max(segundos_cpu, 0) / (ahora - anterior[0]) * 100, 1)
+            else:
+                self._muestras_cpu.pop(connection_id, None)
+
+            resultado.append(fila)
+        return resultado
+
+
+_supervisor = None
+_supervisor_lock = threading.Lock()
+
+
+def obtener_supervisor():
+    global _supervisor
+    with _supervisor_lock:
+        if _supervisor is None:
+            config = _config()
+            _supervisor = BrowserSupervisor(
+                intervalo=config['INTERVALO'],
+                inactividad_hibernar=config['INACTIVIDAD_HIBERNAR'],
+                backoff_base=config['BACKOFF_BASE'],
+                backoff_max=config['BACKOFF_MAX'],
+                estable_tras=config['ESTABLE_TRAS'],
+                max_fallos=config['MAX_FALLOS'],
+            )
+        return _supervisor
@@ -0,0 +1,81 @@
+"""
+Registro en memoria de las conexiones activas, para el webhook de Meta.
+
+Cada cambio del webhook necesita la WhatsappConnection de su phone_number_id y, para la IA,
+su Chatbot. Aquí se guardan ambas (select_related) con TTL, así el webhook en régimen
+estable no consulta la base de datos para resolver la conexión. También se cachea la
+verificación del verify_token (GET de Meta), incluidas las respuestas negativas.
+
+Al guardar o borrar una WhatsappConnection o un Chatbot se vacía el registro de este proceso;
+los demás procesos ven el cambio cuando vence el TTL (WHATSAPP_CONNECTION_CACHE_TTL).
+Las conexiones devueltas son compartidas entre hilos: tratarlas como solo lectura.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Chatbot, WhatsappConnection
+
+
+class RegistroConexiones:
+    """Caché phone_number_id -> conexión y verify_token -> válido, con TTL."""
+
+    def __init__(self, ttl=60, max_items=10000):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._por_phone_number_id = {}  # phone_number_id -> (expira, conexión o None)
+        self._tokens = {}  # verify_token -> (expira, bool)
+        self._lock = threading.Lock()
+
+    def _leer(self, tabla, clave):
+        with self._lock:
+            entrada = tabla.get(clave)
+        if entrada is None or entrada[0] < time.monotonic():
+            return False, None
+        return True, entrada[1]
+
+    def _guardar(self, tabla, clave, valor):
+        with self._lock:
+            if len(tabla) >= self.max_items:
+                # Tokens o IDs inventados no pueden hacer crecer la caché sin límite
+                tabla.clear()
+            tabla[clave] = (time.monotonic() + self.ttl, valor)
+
+    def por_phone_number_id(self, phone_number_id):
+        """Conexión activa del phone_number_id (con su chatbot cargado) o None."""
+        encontrada, connection = self._leer(self._por_phone_number_id, phone_number_id)
+        if not encontrada:
+            connection = (
+                WhatsappConnection.objects.select_related('chatbot')
+                .filter(phone_number_id=phone_number_id, is_active=True).first()
+            )
+            # También se recuerdan los IDs desconocidos: Meta reintenta y no hace falta consultar cada vez
+            self._guardar(self._por_phone_number_id, phone_number_id, connection)
+        return connection
+
+    def token_valido(self, verify_token):
+        encontrado, valido = self._leer(self._tokens, verify_token)
+        if not encontrado:
+            valido = WhatsappConnection.objects.filter(verify_token=verify_token, is_active=True).exists()
+            self._guardar(self._tokens, verify_token, valido)
+        return valido
+
+    def invalidar(self):
+        with self._lock:
+            self._por_phone_number_id.clear()
+            self._tokens.clear()
+
+
+registro = RegistroConexiones(ttl=getattr(settings, 'WHATSAPP_CONNECTION_CACHE_TTL', 60))
+
+
+@receiver(post_save, sender=WhatsappConnection, dispatch_uid='registro_connection_saved')
+@receiver(post_delete, sender=WhatsappConnection, dispatch_uid='registro_connection_deleted')
+@receiver(post_save, sender=Chatbot, dispatch_uid='registro_chatbot_saved')
+@receiver(post_delete, sender=Chatbot, dispatch_uid='registro_chatbot_deleted')
+def invalidar_registro(sender, instance, **kwargs):
+    # Las conexiones cambian poco: se vacía todo en lugar de buscar las entradas afectadas
+    registro.invalidar()
@@ -0,0 +1,101 @@
+"""
+Mantenimiento incremental de la tabla Conversation (bandeja del chat).
+
+Cada vez que se guarda un Message (webhook, envío desde la UI, bot de navegador) se llama a
+registrar_mensaje, que actualiza una sola fila por contacto. Así la bandeja se lee paginada
+desde un índice en lugar de recorrer todos los mensajes de la conexión.
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .models import Conversation, normalizar_telefono
+
+PREVIEW_MAX = 255
+
+
+def _vista_previa(message):
+    return (message.body or f"[{message.msg_type}]")[:PREVIEW_MAX]
+
+
+def registrar_mensaje(message):
+    """Actualiza (o crea) la conversación del mensaje recién guardado."""
+    phone = normalizar_telefono(message.phone_number)
+    no_leidos = 1 if message.direction == 'inbound' else 0
+    campos = {
+        'last_message': _vista_previa(message),
+        'last_direction': message.direction,
+        'last_timestamp': message.timestamp,
+    }
+
+    filtro = Conversation.objects.filter(connection_id=message.connection_id, phone_number=phone)
+    if filtro.update(unread_count=F('unread_count') + no_leidos, **campos):
+        return
+
+    try:
+        with transaction.atomic():
+            Conversation.objects.create(
+                connection_id=message.connection_id, phone_number=phone, unread_count=no_leidos, **campos
+            )
+    except IntegrityError:
+        # Otro hilo la creó entre el update y el create
+        filtro.update(unread_count=F('unread_count') + no_leidos, **campos)
+
+
+def marcar_leida(connection, phone):
+    Conversation.objects.filter(
+        connection=connection, phone_number=normalizar_telefono(phone), unread_count__gt=0
+    ).update(unread_count=0)
+
+
+def registrar_lote(connection_id, mensajes):
+    """
+    Versión en bloque de registrar_mensaje para mensajes creados con bulk_create.
+    Pocas consultas por lote en lugar de dos por mensaje; si un contacto aparece
+    varias veces manda su último mensaje.
+    """
+    ultimos = {}
+    no_leidos = {}
+    for message in mensajes:
+        phone = normalizar_telefono(message.phone_number)
+        ultimos[phone] = message
+        if message.direction == 'inbound':
+            no_leidos[phone] = no_leidos.get(phone, 0) + 1
+    if not ultimos:
+        return
+
+    existentes = set(
+        Conversation.objects.filter(connection_id=connection_id, phone_number__in=list(ultimos))
+        .values_list('phone_number', flat=True)
+    )
+    nuevas = [
+        Conversation(
+            connection_id=connection_id, phone_number=phone, unread_count=no_leidos.get(phone, 0),
+            last_message=_vista_previa(m), last_direction=m.direction, last_timestamp=m.timestamp,
+        )
+        for phone, m in ultimos.items() if phone not in existentes
+    ]
+    try:
+        with transaction.atomic():
+            Conversation.objects.bulk_create(nuevas)
+    except IntegrityError:
+        # Otro hilo creó alguna entre la consulta y el insert: una a una, y las que ya
+        # existen pasan al update (como en registrar_mensaje)
+        for conversacion in nuevas:
+            conversacion.pk = None
+            try:
+                with transaction.atomic():
+                    conversacion.save(force_insert=True)
+            except IntegrityError:
+                existentes.add(conversacion.phone_number)
+
+    # Agrupamos por contenido: en un envío masivo todos comparten vista previa y hora
+    grupos = {}
+    for phone, m in ultimos.items():
+        if phone in existentes:
+            clave = (_vista_previa(m), m.direction, m.timestamp, no_leidos.get(phone, 0))
+            grupos.setdefault(clave, []).append(phone)
+    for (preview, direction, timestamp, leidos), phones in grupos.items():
+        Conversation.objects.filter(connection_id=connection_id, phone_number__in=phones).update(
+            last_message=preview, last_direction=direction, last_timestamp=timestamp,
+            unread_count=F('unread_count') + leidos,
+        )
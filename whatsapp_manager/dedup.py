@@ -0,0 +1,156 @@
+"""
+Detección de mensajes duplicados (reintentos de Meta).
+
+Dos niveles:
+1. Caché en memoria (LRU acotada con TTL) de los wamids vistos recientemente: los reintentos
+   de Meta se descartan en el webhook sin tocar la base de datos.
+2. Índice único (connection, wa_id) en Message: la inserción es atómica (insert-or-ignore),
+   así dos entregas simultáneas del mismo mensaje nunca generan dos filas ni dos respuestas.
+
+Los mensajes de un mismo webhook se insertan juntos (registrar_entrantes): un SELECT ... IN
+descarta los ya guardados y el resto entra con un único bulk_create.
+
+Un wamid entra en la caché solo cuando su guardado se confirma (recordar, vía on_commit): si la
+transacción se deshace, el reintento de Meta tiene que poder pasar.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from api_manager.changefeed import registrar_cambios
+
+from . import live_hub
+from .models import Message, normalizar_telefono
+
+
+class CacheRecientes:
+    """LRU con expiración por tiempo, segura entre hilos."""
+
+    def __init__(self, max_items=50000, ttl=86400):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _vigente(self, clave, ahora):
+        expira = self._datos.get(clave)
+        if expira is None:
+            return False
+        if expira < ahora:
+            del self._datos[clave]
+            return False
+        return True
+
+    def contiene(self, clave):
+        with self._lock:
+            return self._vigente(clave, time.monotonic())
+
+    def agregar(self, clave):
+        with self._lock:
+            self._guardar(clave, time.monotonic())
+
+    def _guardar(self, clave, ahora):
+        self._datos[clave] = ahora + self.ttl
+        self._datos.move_to_end(clave)
+        while len(self._datos) > self.max_items:
+            self._datos.popitem(last=False)
+
+
+recientes = CacheRecientes(
+    max_items=getattr(settings, 'WHATSAPP_DEDUP_CACHE_MAX', 50000),
+    ttl=getattr(settings, 'WHATSAPP_DEDUP_CACHE_TTL', 86400),
+)
+
+
+def recordar(connection, wa_ids):
+    """Agrega los wamids a la caché cuando la transacción en curso se confirme."""
+    claves = [(connection.id, wa_id) for wa_id in wa_ids if wa_id]
+    if not claves:
+        return
+
+    def _agregar():
+        for clave in claves:
+            recientes.agregar(clave)
+
+    transaction.on_commit(_agregar)
+
+
+def filtrar_nuevos(connection, mensajes):
+    """
+    Descarta en memoria los mensajes cuyo wamid ya pasó por este proceso (o se repite en el lote).
+    Pensado para el webhook, antes de encolar o procesar. No los recuerda: eso lo hace quien
+    los guarda, con recordar.
+    """
+    nuevos = []
+    vistos = set()
+    for mensaje in mensajes:
+        wa_id = mensaje.get('id')
+        if wa_id:
+            if wa_id in vistos or recientes.contiene((connection.id, wa_id)):
+                continue
+            vistos.add(wa_id)
+        nuevos.append(mensaje)
+    return nuevos
+
+
+def registrar_entrante(connection, wa_id, **campos):
+    """
+    Inserta el mensaje entrante solo si (connection, wa_id) no existe.
+    Retorna el Message creado, o None si era un duplicado.
+    """
+    try:
+        with transaction.atomic():
+            mensaje = Message.objects.create(connection=connection, wa_id=wa_id, direction='inbound', **campos)
+    except IntegrityError:
+        return None
+
+    recordar(connection, [wa_id])
+    return mensaje
+
+
+def registrar_entrantes(connection, filas):
+    """
+    Versión en bloque de registrar_entrante. Cada fila es un dict con wa_id y los campos del Message.
+    Retorna una lista alineada con filas: el Message creado o None si era un duplicado.
+    """
+    wa_ids = [fila['wa_id'] for fila in filas if fila.get('wa_id')]
+    existentes = set()
+    if wa_ids:
+        existentes = set(
+            Message.objects.filter(connection=connection, wa_id__in=wa_ids).values_list('wa_id', flat=True)
+        )
+
+    resultado = [None] * len(filas)
+    nuevos = {}  # índice -> Message sin guardar
+    for i, fila in enumerate(filas):
+        wa_id = fila.get('wa_id')
+        if wa_id in existentes:
+            continue
+        if wa_id:
+            existentes.add(wa_id)  # Mismo wamid repetido dentro del lote
+        nuevos[i] = Message(connection=connection, direction='inbound', **fila)
+        # bulk_create no pasa por Message.save(): el teléfono se normaliza aquí, como en Conversation
+        nuevos[i].phone_number = normalizar_telefono(nuevos[i].phone_number)
+    if not nuevos:
+        return resultado
+
+    try:
+        with transaction.atomic():
+            Message.objects.bulk_create(list(nuevos.values()))
+    except IntegrityError:
+        # Otra entrega del mismo mensaje se coló entre el SELECT y el INSERT: fila a fila
+        for i in nuevos:
+            campos = dict(filas[i])
+            resultado[i] = registrar_entrante(connection, campos.pop('wa_id', None), **campos)
+        return resultado
+
+    # bulk_create no emite señales: el change feed se alimenta a mano
+    registrar_cambios('message', list(nuevos.values()))
+    live_hub.publicar_mensajes(nuevos.values())
+    for i, mensaje in nuevos.items():
+        resultado[i] = mensaje
+    recordar(connection, [mensaje.wa_id for mensaje in nuevos.values()])
+    return resultado
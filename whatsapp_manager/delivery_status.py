@@ -0,0 +1,173 @@
+"""
+Confirmaciones de entrega de Meta (nodo 'statuses' del webhook).
+
+Meta manda un evento por cada paso de cada mensaje saliente (sent, delivered, read o failed),
+a menudo el triple de eventos que de mensajes. Aquí no se guarda cada evento: se aplican como
+transiciones sobre el Message saliente, localizado por el wamid que devolvió la Graph API
+al enviarlo (Message.wa_id, ver outbound_queue).
+
+- Todo el lote se compacta primero en memoria (por wamid y estado, gana la primera hora).
+- Un UPDATE por estado y bloque de wamids, con CASE para las horas de cada mensaje.
+- Los estados solo avanzan (un 'delivered' tardío no pisa un 'read'); las horas se completan siempre.
+- Meta puede avisar antes de que outbound_queue guarde el wamid (la respuesta de la Graph API llega
+  después que el webhook). Esos estados se guardan en PendingStatus y se aplican al guardar el wamid
+  (aplicar_pendientes); los que nunca encuentran su mensaje se purgan tras RETENCION_PENDIENTES.
+"""
+import logging
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import transaction
+from django.db.models import Case, F, TextField, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from api_manager.changefeed import registrar_cambios
+
+from . import live_hub
+from .models import Message, PendingStatus
+
+logger = logging.getLogger(__name__)
+
+TAMANO_BLOQUE = 500
+RETENCION_PENDIENTES = 86400  # segundos que se guarda un estado sin mensaje (p. ej. de otro sistema)
+
+# Estado de Meta -> (campo con la hora, estados desde los que se puede llegar)
+TRANSICIONES = {
+    'sent': ('sent_at', ('queued', 'sending')),
+    'delivered': ('delivered_at', ('queued', 'sending', 'sent')),
+    'read': ('read_at', ('queued', 'sending', 'sent', 'delivered')),
+    'failed': (None, ('queued', 'sending', 'sent')),
+}
+
+
+def _hora(valor):
+    try:
+        return datetime.fromtimestamp(int(valor), tz=dt_timezone.utc)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return None
+
+
+def _detalle_error(evento):
+    errores = evento.get('errors') or []
+    if not errores:
+        return "Meta reportó el mensaje como fallido"
+    error = errores[0]
+    detalle = error.get('error_data', {}).get('details') or error.get('message') or error.get('title', '')
+    return f"Meta {error.get('code', '')}: {detalle}"[:1000]
+
+
+def compactar(statuses):
+    """{estado: {wamid: hora o detalle del error}} con un solo valor por wamid y estado."""
+    lote = {estado: {} for estado in TRANSICIONES}
+    for evento in statuses:
+        wa_id = evento.get('id')
+        estado = evento.get('status')
+        if not wa_id or estado not in lote:
+            continue
+        if estado == 'failed':
+            lote[estado].setdefault(wa_id, _detalle_error(evento))
+            continue
+        hora = _hora(evento.get('timestamp'))
+        anterior = lote[estado].get(wa_id)
+        if anterior is None or (hora and hora < anterior):
+            lote[estado][wa_id] = hora
+    return lote
+
+
+def registrar_estados(connection, statuses):
+    """
+    Aplica en bloque los estados recibidos a los mensajes salientes de la conexión.
+    Los de wamids aún sin mensaje quedan en PendingStatus. Retorna la cantidad de filas actualizadas.
+    """
+    lote = compactar(statuses)
+    actualizadas, sin_mensaje = _aplicar(connection, lote)
+    if sin_mensaje:
+        _guardar_pendientes(connection, lote, sin_mensaje)
+
+    if lote['failed']:
+        logger.warning(f"⚠️ [ID:{connection.id}] Meta reportó {len(lote['failed'])} mensaje(s) fallidos.")
+    return actualizadas
+
+
+def _aplicar(connection, lote):
+    """Aplica un lote de compactar(). Retorna (filas actualizadas, wamids sin mensaje)."""
+    base = Message.objects.filter(connection=connection, direction='outbound')
+    actualizadas = 0
+    tocados = set()
+
+    with transaction.atomic():
+        # Orden fijo: si el lote trae sent + delivered + read del mismo mensaje, termina en 'read'
+        for estado, (campo_hora, previos) in TRANSICIONES.items():
+            pendientes = list(lote[estado].items())
+            for i in range(0, len(pendientes), TAMANO_BLOQUE):
+                bloque = dict(pendientes[i:i + TAMANO_BLOQUE])
+                cambios = {
+                    'status': Case(When(status__in=previos, then=Value(estado)), default=F('status')),
+                }
+                if campo_hora:
+                    horas = [When(wa_id=wa_id, then=Value(hora)) for wa_id, hora in bloque.items() if hora]
+                    if horas:
+                        cambios[campo_hora] = Coalesce(F(campo_hora), Case(*horas, default=None))
+                else:
+                    cambios['error'] = Case(
+                        *[When(wa_id=wa_id, status__in=previos, then=Value(detalle)) for wa_id, detalle in bloque.items()],
+                        default=F('error'), output_field=TextField(),
+                    )
+                actualizadas += base.filter(wa_id__in=list(bloque)).update(**cambios)
+                tocados.update(bloque)
+
+        filas = []
+        if actualizadas:
+            # update() no emite señales: el change feed se alimenta a mano
+            filas = list(base.filter(wa_id__in=list(tocados)).values('id', 'wa_id', 'phone_number', 'status'))
+            registrar_cambios('message', [Message(id=fila['id'], connection=connection) for fila in filas])
+            live_hub.publicar_estados(connection.id, filas)
+
+    return actualizadas, tocados - {fila['wa_id'] for fila in filas}
+
+
+# --- ESTADOS ADELANTADOS (wamid aún sin guardar) ---
+
+def _guardar_pendientes(connection, lote, wa_ids):
+    PendingStatus.objects.bulk_create([
+        PendingStatus(
+            connection=connection, wa_id=wa_id, status=estado,
+            timestamp=None if estado == 'failed' else valor, error=valor if estado == 'failed' else '',
+        )
+        for estado, por_wamid in lote.items() for wa_id, valor in por_wamid.items() if wa_id in wa_ids
+    ], batch_size=TAMANO_BLOQUE)
+    # outbound_queue pudo guardar el wamid justo después de nuestro UPDATE (y no ver aún estas filas):
+    # al confirmar se vuelve a intentar; si el mensaje sigue sin existir, esperan a aplicar_pendientes
+    transaction.on_commit(lambda: aplicar_pendientes(connection, wa_ids))
+
+
+def aplicar_pendientes(connection, wa_ids):
+    """
+    Aplica y borra los estados guardados de estos wamids cuyo mensaje ya existe
+    (outbound_queue la llama al guardar el wamid de un envío). Retorna las filas actualizadas.
+    """
+    pendientes = list(PendingStatus.objects.filter(connection=connection, wa_id__in=list(wa_ids)))
+    if not pendientes:
+        return 0
+    existentes = set(Message.objects.filter(
+        connection=connection, direction='outbound', wa_id__in={p.wa_id for p in pendientes}
+    ).values_list('wa_id', flat=True))
+    listos = [p for p in pendientes if p.wa_id in existentes]
+    if not listos:
+        return 0
+
+    lote = {estado: {} for estado in TRANSICIONES}
+    for pendiente in listos:
+        lote[pendiente.status].setdefault(
+            pendiente.wa_id, pendiente.error if pendiente.status == 'failed' else pendiente.timestamp
+        )
+    with transaction.atomic():
+        actualizadas, _ = _aplicar(connection, lote)
+        PendingStatus.objects.filter(id__in=[p.id for p in listos]).delete()
+    return actualizadas
+
+
+def purgar_pendientes():
+    """Borra los estados que nunca encontraron su mensaje. Retorna cuántos se borraron."""
+    limite = timezone.now() - timedelta(seconds=RETENCION_PENDIENTES)
+    return PendingStatus.objects.filter(created_at__lt=limite).delete()[0]
@@ -0,0 +1,292 @@
+"""
+Cliente HTTP compartido para todas las llamadas salientes (Graph API de Meta, API de IA, correo).
+
+Mantiene una requests.Session por host, así las conexiones TCP/TLS se reutilizan (keep-alive)
+en lugar de negociarse en cada llamada. Además aplica timeouts configurables, reintentos con
+backoff y acumula métricas de latencia y tamaño por host.
+
+Reintentos: 429/5xx solo en métodos idempotentes (GET, PUT, DELETE...). Un POST se reintenta
+únicamente ante 429: un 5xx no prueba que el mensaje no se haya enviado, y la cola de salida
+(outbound_queue) ya decide si vuelve a intentarlo. El Retry-After se respeta hasta MAX_RETRY_AFTER.
+
+Las vistas async usan arequest (httpx) con la misma configuración de timeouts, reintentos y
+métricas, así cientos de llamadas pueden estar en vuelo a la vez sin ocupar un hilo cada una.
+Un httpx.AsyncClient no puede compartirse entre event loops y guarda referencia a su loop:
+- Servidor ASGI (DSI_COM/asgi.py registra su loop con registrar_loop_servidor): un solo cliente
+  con keep-alive para todo el proceso.
+- Cualquier otro loop (p. ej. WSGI/runserver, donde async_to_sync crea un loop por petición):
+  un cliente de vida corta dentro de 'async with', que se cierra al terminar la llamada.
+
+Configuración en settings.WHATSAPP_HTTP_CLIENT (ver DSI_COM/settings.py).
+"""
+import asyncio
+import contextlib
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# httpx registra cada petición en INFO; las métricas propias ya cubren eso
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+CONFIG_POR_DEFECTO = {
+    'POOL_MAXSIZE': 20,
+    'MAX_CONEXIONES_ASYNC': 200,  # conexiones simultáneas del cliente async (todas las vistas ASGI)
+    'TIMEOUT': (5, 30),  # (conexión, lectura) en segundos
+    'TIMEOUTS_POR_HOST': {},
+    'REINTENTOS': 3,
+    'BACKOFF': 0.5,
+    'STATUS_REINTENTABLES': (429, 500, 502, 503, 504),
+    'MAX_RETRY_AFTER': 30,  # segundos máximos de espera aunque el servidor pida más
+}
+
+_sesiones = {}
+_metricas = {}
+_lock = threading.Lock()
+
+
+def _config():
+    config = dict(CONFIG_POR_DEFECTO)
+    config.update(getattr(settings, 'WHATSAPP_HTTP_CLIENT', {}))
+    return config
+
+
+def _reintentable(method, status_code):
+    """429 siempre; 5xx solo si repetir la petición no puede duplicar nada."""
+    return status_code == 429 or method.upper() in Retry.DEFAULT_ALLOWED_METHODS
+
+
+class _Reintentos(Retry):
+    """Retry de urllib3 que también reintenta un POST, pero solo ante 429, y acota el Retry-After."""
+
+    def __init__(self, *args, max_retry_after=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_retry_after = max_retry_after
+
+    def new(self, **kwargs):
+        kwargs.setdefault('max_retry_after', self.max_retry_after)
+        return super().new(**kwargs)
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code == 429 and not self._is_method_retryable(method):
+            return bool(self.total)
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def get_retry_after(self, response):
+        espera = super().get_retry_after(response)
+        if espera is None or self.max_retry_after is None:
+            return espera
+        return min(espera, self.max_retry_after)
+
+
+def _crear_sesion(config):
+    reintentos = _Reintentos(
+        total=config['REINTENTOS'],
+        connect=config['REINTENTOS'],
+        read=0,  # Un timeout de lectura en un POST podría duplicar el envío
+        status=config['REINTENTOS'],
+        backoff_factor=config['BACKOFF'],
+        status_forcelist=config['STATUS_REINTENTABLES'],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+        max_retry_after=config['MAX_RETRY_AFTER'],
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config['POOL_MAXSIZE'], max_retries=reintentos)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def obtener_sesion(host):
+    """Devuelve (o crea) la sesión con pool propio para ese host."""
+    with _lock:
+        session = _sesiones.get(host)
+        if session is None:
+            session = _crear_sesion(_config())
+            _sesiones[host] = session
+        return session
+
+
+def _registrar_metrica(host, duracion, enviados, recibidos, status_code=None, error=False):
+    with _lock:
+        m = _metricas.setdefault(host, {
+            'peticiones': 0,
+            'errores': 0,
+            'latencia_total_ms': 0.0,
+            'latencia_max_ms': 0.0,
+            'bytes_enviados': 0,
+            'bytes_recibidos': 0,
+            'status': {},
+        })
+        duracion_ms = duracion * 1000
+        m['peticiones'] += 1
+        m['latencia_total_ms'] += duracion_ms
+        m['latencia_max_ms'] = max(m['latencia_max_ms'], duracion_ms)
+        m['bytes_enviados'] += enviados
+        m['bytes_recibidos'] += recibidos
+        if error or (status_code is not None and status_code >= 400):
+            m['errores'] += 1
+        if status_code is not None:
+            m['status'][str(status_code)] = m['status'].get(str(status_code), 0) + 1
+
+
+def request(method, url, **kwargs):
+    """
+    Equivalente a requests.request pero usando el pool del host.
+    Si no se indica timeout, se usa el configurado para el host (o el global).
+    """
+    config = _config()
+    host = urlsplit(url).hostname or ''
+    kwargs.setdefault('timeout', config['TIMEOUTS_POR_HOST'].get(host, config['TIMEOUT']))
+
+    inicio = time.monotonic()
+    try:
+        response = obtener_sesion(host).request(method, url, **kwargs)
+    except requests.exceptions.RequestException:
+        _registrar_metrica(host, time.monotonic() - inicio, 0, 0, error=True)
+        raise
+
+    body = response.request.body
+    enviados = len(body) if isinstance(body, (bytes, str)) else 0
+    if kwargs.get('stream'):
+        # No consumimos el cuerpo: usamos lo que declara el servidor
+        recibidos = int(response.headers.get('Content-Length') or 0)
+    else:
+        recibidos = len(response.content)
+
+    _registrar_metrica(host, time.monotonic() - inicio, enviados, recibidos, status_code=response.status_code)
+    return response
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+# --- CLIENTE ASÍNCRONO (vistas ASGI) ---
+
+_loop_servidor = None  # loop de larga vida del servidor ASGI
+_cliente_servidor = None
+
+
+def registrar_loop_servidor():
+    """
+    Marca el loop en curso como el del servidor ASGI: a partir de aquí arequest reutiliza
+    un único cliente en él. Llamarlo desde ese loop (idempotente).
+    """
+    global _loop_servidor, _cliente_servidor
+    loop = asyncio.get_running_loop()
+    if loop is not _loop_servidor:
+        # El cliente del loop anterior no se puede cerrar desde este: se suelta
+        _loop_servidor, _cliente_servidor = loop, None
+
+
+async def cerrar_cliente_servidor():
+    """Cierra el cliente compartido (p. ej. al apagar el servidor o terminar un benchmark)."""
+    global _loop_servidor, _cliente_servidor
+    cliente, _loop_servidor, _cliente_servidor = _cliente_servidor, None, None
+    if cliente is not None:
+        await cliente.aclose()
+
+
+def _crear_cliente_async(config):
+    limites = httpx.Limits(
+        max_connections=config['MAX_CONEXIONES_ASYNC'],
+        max_keepalive_connections=config['POOL_MAXSIZE'],
+    )
+    # retries del transporte = reintentos de conexión (como connect= en Retry)
+    transporte = httpx.AsyncHTTPTransport(retries=config['REINTENTOS'], limits=limites)
+    return httpx.AsyncClient(transport=transporte)
+
+
+@contextlib.asynccontextmanager
+async def _cliente_async(config):
+    global _cliente_servidor
+    if asyncio.get_running_loop() is _loop_servidor:
+        if _cliente_servidor is None:
+            _cliente_servidor = _crear_cliente_async(config)
+        yield _cliente_servidor
+        return
+    # Loop de una sola petición: el cliente (y sus sockets) no debe sobrevivirle
+    async with _crear_cliente_async(config) as cliente:
+        yield cliente
+
+
+def _timeout_httpx(timeout):
+    if isinstance(timeout, (tuple, list)):
+        conexion, lectura = timeout
+        return httpx.Timeout(lectura, connect=conexion)
+    return httpx.Timeout(timeout)
+
+
+def _espera_reintento(response, intento, config):
+    retry_after = response.headers.get('Retry-After', '')
+    if retry_after.isdigit():
+        return min(int(retry_after), config['MAX_RETRY_AFTER'])
+    return config['BACKOFF'] * 2 ** intento
+
+
+async def arequest(method, url, **kwargs):
+    """
+    Versión async de request (httpx). Mismos timeouts por host, política de reintentos
+    y métricas. Retorna un httpx.Response (usar is_success / raise_for_status).
+    """
+    config = _config()
+    host = urlsplit(url).hostname or ''
+    timeout = kwargs.pop('timeout', None) or config['TIMEOUTS_POR_HOST'].get(host, config['TIMEOUT'])
+
+    inicio = time.monotonic()
+    intento = 0
+    async with _cliente_async(config) as cliente:
+        while True:
+            try:
+                response = await cliente.request(method, url, timeout=_timeout_httpx(timeout), **kwargs)
+            except httpx.HTTPError:
+                _registrar_metrica(host, time.monotonic() - inicio, 0, 0, error=True)
+                raise
+            if (response.status_code not in config['STATUS_REINTENTABLES']
+                    or not _reintentable(method, response.status_code) or intento >= config['REINTENTOS']):
+                break
+            await asyncio.sleep(_espera_reintento(response, intento, config))
+            intento += 1
+
+    _registrar_metrica(host, time.monotonic() - inicio, len(response.request.content), len(response.content),
+                       status_code=response.status_code)
+    return response
+
+
+async def aget(url, **kwargs):
+    return await arequest('GET', url, **kwargs)
+
+
+async def apost(url, **kwargs):
+    return await arequest('POST', url, **kwargs)
+
+
+def obtener_metricas():
+    """Copia de las métricas por host, con la latencia media ya calculada."""
+    with _lock:
+        resultado = {}
+        for host, m in _metricas.items():
+            datos = dict(m, status=dict(m['status']))
+            datos['latencia_media_ms'] = round(m['latencia_total_ms'] / m['peticiones'], 2) if m['peticiones'] else 0
+            datos['latencia_total_ms'] = round(m['latencia_total_ms'], 2)
+            datos['latencia_max_ms'] = round(m['latencia_max_ms'], 2)
+            resultado[host] = datos
+        return resultado
+
+
+def reiniciar_metricas():
+    with _lock:
+        _metricas.clear()
@@ -0,0 +1,147 @@
+"""
+Procesado de las imágenes que recibe el bot de navegador (WhatsApp Web) y miniaturas del chat.
+
+El bot solo trae del navegador los bytes de la imagen (una vez por blob) y sigue con el siguiente
+mensaje sin soltar la sesión más de lo necesario. Lo demás corre en un pool de procesos
+(BOT_IMAGEN_WORKERS), fuera del lock del navegador y del GIL de los hilos del bot:
+- Hash sha256 del contenido: la ruta sale de él, así una imagen repetida se procesa y guarda una vez.
+  Mismo almacén que media_store (MEDIA_ROOT/whatsapp_received/ab/<sha256>.ext, ruta relativa en el
+  Message), así las imágenes del bot entran en el presupuesto de su caché.
+- Si la imagen ya es compacta (WEBP, o JPEG/PNG de pocos KB) o es un GIF (podría ser animado) se
+  guarda tal cual; si no, WEBP calidad 80.
+- Se devuelven dimensiones y tamaño, que se guardan en el Message.
+- Miniaturas para el chat: se generan la primera vez que se piden y quedan en disco junto al original.
+
+Sin Django: los procesos del pool importan solo este módulo (quien llama pasa MEDIA_ROOT).
+"""
+import base64
+import hashlib
+import io
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+WORKERS = int(os.environ.get('BOT_IMAGEN_WORKERS', 2))
+# Por debajo de este tamaño un JPEG/PNG no se recodifica: el ahorro no compensa la CPU
+BYTES_COMPACTO = int(os.environ.get('BOT_IMAGEN_BYTES_COMPACTO', 200 * 1024))
+LADO_MINIATURA = 320
+ESPERA_MAXIMA = 60  # segundos esperando un resultado del pool
+
+EXTENSIONES = {'image/jpeg': '.jpg', 'image/png': '.png', 'image/webp': '.webp', 'image/gif': '.gif'}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _obtener_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # 'spawn': el proceso del bot tiene hilos (Selenium, pools); hacer fork con ellos no es seguro
+            _executor = ProcessPoolExecutor(max_workers=WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _executor
+
+
+# --- IMÁGENES RECIBIDAS ---
+
+def procesar(data_url, raiz, subdirectorio):
+    """
+    Encola una imagen 'data:image/...;base64,...' para guardarla en raiz/subdirectorio.
+    Retorna un Future con el dict de _procesar.
+    """
+    return _obtener_executor().submit(_procesar, data_url, str(raiz), subdirectorio)
+
+
+def resolver(adjunto):
+    """
+    Espera el resultado si el adjunto es un Future de procesar.
+    Retorna (adjunto para el callback, dict de la imagen o None): la ruta guardada (relativa a la raíz),
+    o 'IMAGEN' si falló.
+    """
+    if not hasattr(adjunto, 'result'):
+        return adjunto, None
+    try:
+        imagen = adjunto.result(timeout=ESPERA_MAXIMA)
+        return imagen['ruta'], imagen
+    except Exception as e:
+        print(f"   ⚠️ Error imagen: {e}")
+        return 'IMAGEN', None
+
+
+def _guardar(ruta, escribir):
+    """Escribe vía temporal + rename: nadie ve nunca un archivo a medias."""
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    try:
+        with open(temporal, 'wb') as f:
+            escribir(f)
+        os.replace(temporal, ruta)
+    finally:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+
+
+def _procesar(data_url, raiz, subdirectorio):
+    """
+    Corre en el pool de procesos. Retorna {'ruta' (relativa a raiz), 'ancho', 'alto', 'bytes', 'nuevo'};
+    'nuevo' es False si el archivo ya estaba guardado.
+    """
+    header, encoded = data_url.split(",", 1)
+    mime = header[len('data:'):].split(';')[0]
+    datos = base64.b64decode(encoded)
+    digest = hashlib.sha256(datos).hexdigest()
+    base = os.path.join(subdirectorio, digest[:2], digest)
+
+    # Ya procesada antes (mismo contenido): no se vuelve a codificar
+    for extension in ('.webp', EXTENSIONES.get(mime, '.img')):
+        ruta = os.path.join(raiz, base + extension)
+        if os.path.exists(ruta):
+            os.utime(ruta)  # último uso para la caché LRU de media_store
+            with Image.open(ruta) as imagen:
+                ancho, alto = imagen.size
+            return {'ruta': base + extension, 'ancho': ancho, 'alto': alto, 'bytes': os.path.getsize(ruta),
+                    'nuevo': False}
+
+    imagen = Image.open(io.BytesIO(datos))
+    ancho, alto = imagen.size
+    if mime in ('image/webp', 'image/gif') or (mime in EXTENSIONES and len(datos) <= BYTES_COMPACTO):
+        # Ya es compacta (o un GIF, que al recodificar perdería la animación): se guardan los bytes originales
+        relativa = base + EXTENSIONES[mime]
+        _guardar(os.path.join(raiz, relativa), lambda f: f.write(datos))
+    else:
+        if imagen.mode not in ('RGB', 'RGBA'):
+            # CMYK, paletas, etc.: WEBP solo admite RGB(A)
+            imagen = imagen.convert('RGBA' if 'transparency' in imagen.info or 'A' in imagen.getbands() else 'RGB')
+        relativa = base + '.webp'
+        _guardar(os.path.join(raiz, relativa), lambda f: imagen.save(f, "WEBP", quality=80))
+    return {'ruta': relativa, 'ancho': ancho, 'alto': alto, 'bytes': os.path.getsize(os.path.join(raiz, relativa)),
+            'nuevo': True}
+
+
+# --- MINIATURAS ---
+
+def ruta_miniatura(ruta, lado=LADO_MINIATURA):
+    return f"{os.path.splitext(ruta)[0]}_min{lado}.webp"
+
+
+def miniatura(ruta, lado=LADO_MINIATURA):
+    """
+    Ruta de la miniatura de 'ruta' (lado mayor <= lado), generándola en el pool si aún no existe.
+    Si la imagen ya es pequeña retorna la propia ruta.
+    """
+    destino = ruta_miniatura(ruta, lado)
+    if os.path.exists(destino):
+        return destino
+    return _obtener_executor().submit(_miniatura, ruta, destino, lado).result(timeout=ESPERA_MAXIMA)
+
+
+def _miniatura(ruta, destino, lado):
+    with Image.open(ruta) as imagen:
+        if max(imagen.size) <= lado:
+            return ruta
+        imagen.thumbnail((lado, lado))
+        _guardar(destino, lambda f: imagen.save(f, "WEBP", quality=70))
+    return destino
@@ -0,0 +1,156 @@
+"""
+Actualizaciones en vivo (Server-Sent Events) para el inspector del webhook y el chat.
+
+Un hub en memoria reparte los eventos entre las conexiones SSE abiertas en este proceso:
+- 'webhook': cada WebhookLog guardado (inspector).
+- 'chat:<connection_id>': mensajes nuevos o modificados y cambios de estado de entrega.
+
+Quien publica suele ser código síncrono en otro hilo (webhook, cola de salida, workers);
+cada suscriptor vive en el event loop de ASGI, así que la entrega pasa por
+loop.call_soon_threadsafe. El evento se serializa una sola vez, se publique a 1 o a 100 pestañas,
+y solo al confirmarse la transacción. Sin suscriptores, publicar no cuesta nada.
+
+Cada suscriptor tiene una cola acotada: si un navegador no consume, se descartan sus
+eventos más viejos en lugar de acumular memoria.
+Solo llegan los eventos generados en este proceso (los workers lanzados con
+run_webhook_workers o run_bot_browser corren aparte).
+"""
+import asyncio
+import json
+import threading
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Message
+
+CANAL_WEBHOOK = 'webhook'
+
+
+def canal_chat(connection_id):
+    return f'chat:{connection_id}'
+
+
+class Suscripcion:
+    def __init__(self, canal, loop, max_pendientes):
+        self.canal = canal
+        self.loop = loop
+        self.cola = asyncio.Queue(maxsize=max_pendientes)
+        self.descartados = 0
+
+    def _entregar(self, evento):
+        # Corre dentro del event loop del suscriptor
+        if self.cola.full():
+            self.cola.get_nowait()
+            self.descartados += 1
+        self.cola.put_nowait(evento)
+
+
+class LiveHub:
+    def __init__(self, max_pendientes=200):
+        self.max_pendientes = max_pendientes
+        self._canales = {}  # canal -> set(Suscripcion)
+        self._lock = threading.Lock()
+
+    def suscribir(self, canal):
+        """Llamar desde una vista async: la suscripción queda ligada a su event loop."""
+        suscripcion = Suscripcion(canal, asyncio.get_running_loop(), self.max_pendientes)
+        with self._lock:
+            self._canales.setdefault(canal, set()).add(suscripcion)
+        return suscripcion
+
+    def cancelar(self, suscripcion):
+        with self._lock:
+            suscriptores = self._canales.get(suscripcion.canal)
+            if suscriptores is not None:
+                suscriptores.discard(suscripcion)
+                if not suscriptores:
+                    del self._canales[suscripcion.canal]
+
+    def tiene_suscriptores(self, canal):
+        return bool(self._canales.get(canal))
+
+    def publicar(self, canal, tipo, datos):
+        """Entrega (tipo, JSON) a todos los suscriptores del canal. Seguro desde cualquier hilo."""
+        with self._lock:
+            suscriptores = list(self._canales.get(canal, ()))
+        if not suscriptores:
+            return
+        evento = (tipo, json.dumps(datos, cls=DjangoJSONEncoder, ensure_ascii=False))
+        for suscripcion in suscriptores:
+            try:
+                suscripcion.loop.call_soon_threadsafe(suscripcion._entregar, evento)
+            except RuntimeError:
+                # El event loop ya se cerró (servidor reiniciándose)
+                self.cancelar(suscripcion)
+
+    def suscriptores(self):
+        with self._lock:
+            return {canal: len(subs) for canal, subs in self._canales.items()}
+
+
+hub = LiveHub(max_pendientes=getattr(settings, 'WHATSAPP_LIVE_MAX_PENDIENTES', 200))
+
+
+# ==============================================================================
+# PUBLICACIÓN
+# ==============================================================================
+
+def serializar_mensaje(m):
+    """Mismo formato que el historial del chat (renderMessage en chat.html)."""
+    return {
+        'id': m.id,
+        'phone_number': m.phone_number,
+        'direction': m.direction,
+        'msg_type': m.msg_type,
+        'body': m.body,
+        'media_file': m.media_file,
+        'media_id': m.media_id,
+        'status': m.status,
+        'time': timezone.localtime(m.timestamp).strftime('%H:%M'),
+    }
+
+
+def publicar_mensajes(mensajes):
+    """Publica mensajes nuevos o modificados en el canal de su conexión, al confirmarse la transacción."""
+    por_canal = {}
+    for m in mensajes:
+        canal = canal_chat(m.connection_id)
+        if hub.tiene_suscriptores(canal):
+            por_canal.setdefault(canal, []).append(serializar_mensaje(m))
+    if not por_canal:
+        return
+
+    def _publicar():
+        for canal, datos in por_canal.items():
+            for item in datos:
+                hub.publicar(canal, 'mensaje', item)
+
+    transaction.on_commit(_publicar)
+
+
+def publicar_estados(connection_id, filas):
+    """filas: dicts con id, phone_number y status (cambios de entrega aplicados con update())."""
+    canal = canal_chat(connection_id)
+    if not hub.tiene_suscriptores(canal):
+        return
+    filas = list(filas)
+    transaction.on_commit(lambda: [hub.publicar(canal, 'estado', fila) for fila in filas])
+
+
+def publicar_log(log):
+    if not hub.tiene_suscriptores(CANAL_WEBHOOK):
+        return
+    datos = {'id': log.id, 'created_at': log.created_at.strftime("%H:%M:%S"), 'payload': log.payload}
+    transaction.on_commit(lambda: hub.publicar(CANAL_WEBHOOK, 'log', datos))
+
+
+@receiver(post_save, sender=Message, dispatch_uid='live_hub_message_saved')
+def message_guardado(sender, instance, raw=False, **kwargs):
+    # Las escrituras en bloque (bulk_create / update) publican a mano
+    if not raw:
+        publicar_mensajes([instance])
@@ -0,0 +1,135 @@
+"""
+Retención del log crudo del webhook (WebhookLog).
+
+- Muestreo al escribir: cada POST se clasifica (mensajes, estados u otro) y se guarda
+  con la probabilidad configurada para su tipo. Por defecto se guardan todos los que traen
+  mensajes y una muestra de los que solo traen estados (el grueso del tráfico de Meta).
+- Archivado por antigüedad: los logs más viejos que RETENCION_DIAS se escriben en archivos
+  JSONL comprimidos, uno por día (webhook_log_AAAA-MM-DD.jsonl.gz), y se borran en lotes
+  pequeños por id con una pausa entre lotes, así el webhook nunca espera un DELETE largo.
+  El lote se escribe y sincroniza en disco antes de borrarse: si el proceso muere a mitad,
+  como mucho se repiten filas en el archivo, nunca se pierden.
+"""
+import gzip
+import json
+import logging
+import os
+import random
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from . import live_hub
+from .models import WebhookLog
+
+logger = logging.getLogger(__name__)
+
+CONFIG_POR_DEFECTO = {
+    'RETENCION_DIAS': 7,
+    # Probabilidad de guardar cada tipo de POST (1 = todos, 0 = ninguno)
+    'MUESTREO': {'messages': 1.0, 'statuses': 0.1, 'other': 1.0},
+    'DIRECTORIO_ARCHIVO': os.path.join(settings.BASE_DIR, 'webhook_archive'),
+    'LOTE': 1000,  # filas por lote de archivado/borrado
+    'PAUSA': 0.05,  # segundos entre lotes
+}
+
+
+def _config():
+    config = {**CONFIG_POR_DEFECTO, **getattr(settings, 'WHATSAPP_WEBHOOK_LOG', {})}
+    config['MUESTREO'] = {**CONFIG_POR_DEFECTO['MUESTREO'], **config['MUESTREO']}
+    return config
+
+
+# --- ESCRITURA CON MUESTREO ---
+
+def clasificar(payload):
+    """'messages' si algún cambio trae mensajes, 'statuses' si solo trae estados, si no 'other'."""
+    tipo = 'other'
+    if not isinstance(payload, dict):
+        return tipo
+    for entry in payload.get('entry') or []:
+        for change in entry.get('changes') or []:
+            value = change.get('value') or {}
+            if value.get('messages'):
+                return 'messages'
+            if value.get('statuses'):
+                tipo = 'statuses'
+    return tipo
+
+
+def registrar(payload, headers=None):
+    """Guarda el POST del webhook si le toca según el muestreo. Retorna el WebhookLog o None."""
+    tipo = clasificar(payload)
+    tasa = _config()['MUESTREO'].get(tipo, 1.0)
+    if tasa < 1 and random.random() >= tasa:
+        return None
+    log = WebhookLog.objects.create(payload=payload, headers=headers or {}, kind=tipo)
+    live_hub.publicar_log(log)
+    return log
+
+
+# --- ARCHIVADO ---
+
+def _escribir(directorio, filas):
+    """Agrega las filas al archivo de su día. gzip admite anexar miembros a un archivo existente."""
+    por_dia = {}
+    for fila in filas:
+        por_dia.setdefault(fila['created_at'].date(), []).append(fila)
+
+    for dia, filas_dia in por_dia.items():
+        ruta = os.path.join(directorio, f"webhook_log_{dia.isoformat()}.jsonl.gz")
+        with open(ruta, 'ab') as crudo:
+            with gzip.GzipFile(fileobj=crudo, mode='ab') as f:
+                for fila in filas_dia:
+                    f.write(json.dumps(fila, cls=DjangoJSONEncoder, ensure_ascii=False).encode('utf-8'))
+                    f.write(b'\n')
+            crudo.flush()
+            os.fsync(crudo.fileno())
+
+
+def archivar(dias=None, directorio=None, lote=None, pausa=None, guardar_archivo=True, simular=False):
+    """
+    Archiva y borra los logs más viejos que 'dias'. Retorna la cantidad de filas procesadas.
+    Con simular=True solo cuenta.
+    """
+    config = _config()
+    dias = config['RETENCION_DIAS'] if dias is None else dias
+    directorio = directorio or config['DIRECTORIO_ARCHIVO']
+    lote = lote or config['LOTE']
+    pausa = config['PAUSA'] if pausa is None else pausa
+
+    limite = timezone.now() - timedelta(days=dias)
+    viejos = WebhookLog.objects.filter(created_at__lt=limite)
+    if simular:
+        return viejos.count()
+
+    if guardar_archivo:
+        os.makedirs(directorio, exist_ok=True)
+
+    total = 0
+    ultimo_id = 0
+    while True:
+        # Recorrido por id: cada lote es una consulta corta sobre el índice de la PK
+        filas = list(
+            viejos.filter(id__gt=ultimo_id).order_by('id')
+            .values('id', 'created_at', 'kind', 'payload', 'headers')[:lote]
+        )
+        if not filas:
+            break
+        ultimo_id = filas[-1]['id']
+
+        if guardar_archivo:
+            _escribir(directorio, filas)
+        # Sin relaciones ni señales: Django lo resuelve con un único DELETE ... WHERE id IN (...)
+        WebhookLog.objects.filter(id__in=[f['id'] for f in filas]).delete()
+        total += len(filas)
+
+        if pausa:
+            time.sleep(pausa)
+
+    if total:
+        logger.info(f"🗄️ {total} logs del webhook anteriores a {limite:%Y-%m-%d} archivados.")
+    return total
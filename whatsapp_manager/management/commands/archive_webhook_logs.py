@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from whatsapp_manager import log_retention
+
+
+class Command(BaseCommand):
+    help = 'Archiva en JSONL comprimido y borra por lotes los logs del webhook más viejos que la retención'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dias', type=int, default=None,
+                            help='Conservar los últimos N días (por defecto WHATSAPP_WEBHOOK_LOG["RETENCION_DIAS"])')
+        parser.add_argument('--directorio', default=None, help='Carpeta de los archivos .jsonl.gz')
+        parser.add_argument('--lote', type=int, default=None, help='Filas por lote de borrado')
+        parser.add_argument('--sin-archivo', action='store_true', help='Borrar sin guardar copia')
+        parser.add_argument('--simular', action='store_true', help='Solo contar los logs que se archivarían')
+
+    def handle(self, *args, **options):
+        total = log_retention.archivar(
+            dias=options['dias'],
+            directorio=options['directorio'],
+            lote=options['lote'],
+            guardar_archivo=not options['sin_archivo'],
+            simular=options['simular'],
+        )
+        if options['simular']:
+            self.stdout.write(f"🔎 {total} logs se archivarían.")
+        else:
+            self.stdout.write(self.style.SUCCESS(f"✅ {total} logs archivados."))
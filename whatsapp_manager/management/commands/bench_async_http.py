@@ -0,0 +1,119 @@
+import asyncio
+import json
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings
+
+RUTA = '/whatsapp/test-ai/'
+
+
+class _ServidorFalso(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def _manejador(latencia):
+    class Manejador(BaseHTTPRequestHandler):
+        """Imita la API de IA y la Graph API: responde JSON tras 'latencia' segundos."""
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            time.sleep(latencia)
+            if '/messages' in self.path:
+                datos = {'messages': [{'id': f'wamid.bench.{time.monotonic_ns()}'}]}
+            else:
+                datos = {'response': {'content': 'ok'}}
+            cuerpo = json.dumps(datos).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
+
+        def log_message(self, *args):
+            pass
+
+    return Manejador
+
+
+class Command(BaseCommand):
+    help = 'Compara el rendimiento WSGI (hilos) vs ASGI (async) de las vistas que llaman a servicios HTTP externos'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--peticiones', type=int, default=200)
+        parser.add_argument('--concurrencia', type=int, default=100,
+                            help='Peticiones en vuelo a la vez en modo ASGI')
+        parser.add_argument('--hilos-wsgi', type=int, default=8,
+                            help='Hilos del servidor WSGI simulado (como los workers de gunicorn)')
+        parser.add_argument('--latencia', type=float, default=0.2,
+                            help='Segundos que tarda en responder el servidor falso')
+
+    def handle(self, *args, **options):
+        servidor = _ServidorFalso(('127.0.0.1', 0), _manejador(options['latencia']))
+        threading.Thread(target=servidor.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{servidor.server_address[1]}"
+        self.stdout.write(f"🧪 Servidor falso en {base} (latencia {options['latencia']}s)")
+
+        try:
+            with override_settings(DSI_API_URL=f"{base}/api/chat/", WHATSAPP_GRAPH_API_URL=f"{base}/v18.0"):
+                resultados = {
+                    f"WSGI ({options['hilos_wsgi']} hilos)": self._wsgi(options['peticiones'], options['hilos_wsgi']),
+                    f"ASGI ({options['concurrencia']} en vuelo)": asyncio.run(
+                        self._asgi(options['peticiones'], options['concurrencia'])
+                    ),
+                }
+        finally:
+            servidor.shutdown()
+            servidor.server_close()
+
+        self.stdout.write("\n📊 Resultados:")
+        for modo, (duracion, tiempos, errores) in resultados.items():
+            tiempos.sort()
+            self.stdout.write(self.style.SUCCESS(
+                f"  {modo:<22} {len(tiempos)} peticiones en {duracion:.2f}s | "
+                f"{len(tiempos) / duracion:.1f} req/s | "
+                f"p50 {statistics.median(tiempos) * 1000:.0f} ms | "
+                f"p95 {tiempos[int(len(tiempos) * 0.95) - 1] * 1000:.0f} ms | "
+                f"errores {errores}"
+            ))
+
+    def _wsgi(self, peticiones, hilos):
+        local = threading.local()
+
+        def una(i):
+            # Un Client por hilo, como un worker WSGI atendiendo una petición a la vez
+            if not hasattr(local, 'cliente'):
+                local.cliente = Client()
+            inicio = time.monotonic()
+            respuesta = local.cliente.post(RUTA, {'prompt': f'bench {i}'})
+            return time.monotonic() - inicio, respuesta.status_code == 200
+
+        inicio = time.monotonic()
+        with ThreadPoolExecutor(max_workers=hilos) as pool:
+            mediciones = list(pool.map(una, range(peticiones)))
+        return time.monotonic() - inicio, [t for t, _ in mediciones], sum(1 for _, ok in mediciones if not ok)
+
+    async def _asgi(self, peticiones, concurrencia):
+        from whatsapp_manager import http_client
+
+        # Como en DSI_COM/asgi.py: este loop vive toda la medición, las vistas comparten un cliente
+        http_client.registrar_loop_servidor()
+        cliente = AsyncClient()
+        semaforo = asyncio.Semaphore(concurrencia)
+
+        async def una(i):
+            async with semaforo:
+                inicio = time.monotonic()
+                respuesta = await cliente.post(RUTA, {'prompt': f'bench {i}'})
+                return time.monotonic() - inicio, respuesta.status_code == 200
+
+        inicio = time.monotonic()
+        mediciones = await asyncio.gather(*[una(i) for i in range(peticiones)])
+        await http_client.cerrar_cliente_servidor()
+        return time.monotonic() - inicio, [t for t, _ in mediciones], sum(1 for _, ok in mediciones if not ok)
@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+
+from whatsapp_manager import browser_service
+from whatsapp_manager.browser_supervisor import memoria_driver
+
+# Archivos de bloqueo y cachés que no hace falta copiar del perfil original
+IGNORAR_EN_COPIA = shutil.ignore_patterns('Singleton*', 'lockfile', 'Cache', 'Code Cache', 'GPUCache')
+
+
+class Command(BaseCommand):
+    help = 'Compara los perfiles de arranque de Chrome: tiempo hasta #pane-side (o QR) y memoria RSS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--conexion', type=int, default=None,
+                            help='Usa una copia del perfil de esta conexión (vinculada: mide hasta #pane-side)')
+        parser.add_argument('--perfiles', nargs='+', default=list(browser_service.PERFILES_CHROME),
+                            help='Perfiles a medir (por defecto todos)')
+        parser.add_argument('--repeticiones', type=int, default=3)
+        parser.add_argument('--espera', type=int, default=60, help='Segundos máximos esperando la página')
+        parser.add_argument('--asentar', type=float, default=5.0,
+                            help='Segundos tras cargar antes de medir la memoria')
+
+    def handle(self, *args, **options):
+        desconocidos = set(options['perfiles']) - set(browser_service.PERFILES_CHROME)
+        if desconocidos:
+            raise CommandError(f"Perfiles desconocidos: {', '.join(sorted(desconocidos))}")
+
+        origen = None
+        if options['conexion'] is not None:
+            origen = os.path.join(browser_service.CHROME_ROOT_MOUNT, f"session_{options['conexion']}")
+            if not os.path.isdir(origen):
+                raise CommandError(f"No existe el perfil {origen}")
+
+        resultados = {}
+        for perfil in options['perfiles']:
+            for i in range(options['repeticiones']):
+                medicion = self._medir(perfil, origen, options['espera'], options['asentar'])
+                resultados.setdefault(perfil, []).append(medicion)
+                self.stdout.write(
+                    f"  {perfil} #{i + 1}: arranque {medicion['arranque']:.1f}s | "
+                    f"{medicion['elemento']} en {medicion['carga']:.1f}s | "
+                    f"{medicion['memoria_mb']:.0f} MB en {medicion['procesos']} procesos"
+                )
+
+        self.stdout.write("\n📊 Promedios:")
+        for perfil, mediciones in resultados.items():
+            n = len(mediciones)
+            self.stdout.write(self.style.SUCCESS(
+                f"  {perfil:<10} arranque {sum(m['arranque'] for m in mediciones) / n:.1f}s | "
+                f"página {sum(m['carga'] for m in mediciones) / n:.1f}s | "
+                f"RSS {sum(m['memoria_mb'] for m in mediciones) / n:.0f} MB"
+            ))
+
+    def _medir(self, perfil, origen, espera, asentar):
+        # Siempre sobre una copia: no se toca (ni se bloquea) el perfil de un bot en marcha
+        directorio = tempfile.mkdtemp(prefix=f"bench_{perfil}_")
+        perfil_dir = os.path.join(directorio, 'perfil')
+        if origen:
+            shutil.copytree(origen, perfil_dir, ignore=IGNORAR_EN_COPIA)
+
+        driver = None
+        try:
+            inicio = time.monotonic()
+            driver = browser_service.crear_driver(perfil_dir, perfil=perfil)
+            arranque = time.monotonic() - inicio
+
+            inicio = time.monotonic()
+            driver.get("https://web.whatsapp.com")
+            try:
+                elemento = WebDriverWait(driver, espera).until(EC.any_of(
+                    EC.presence_of_element_located((By.ID, "pane-side")),
+                    EC.presence_of_element_located((By.TAG_NAME, "canvas")),
+                ))
+                nombre = "pane-side" if elemento.get_attribute("id") == "pane-side" else "QR"
+            except Exception:
+                nombre = "timeout"
+            carga = time.monotonic() - inicio
+
+            time.sleep(asentar)
+            procesos, rss = memoria_driver(driver)
+            return {
+                'arranque': arranque,
+                'carga': carga,
+                'elemento': nombre,
+                'procesos': procesos,
+                'memoria_mb': rss / (1024 * 1024),
+            }
+        finally:
+            if driver is not None:
+                driver.quit()
+            shutil.rmtree(directorio, ignore_errors=True)
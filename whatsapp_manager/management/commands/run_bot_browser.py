@@ -1,13 +1,36 @@
 from django.core.management.base import BaseCommand
-from whatsapp_manager.browser_service import iniciar_bucle_bot
+
+from whatsapp_manager.bot_channel import BotCommandWorker, ejecutar_local
+from whatsapp_manager.browser_supervisor import obtener_supervisor
+from whatsapp_manager.models import WhatsappConnection
+
 
 class Command(BaseCommand):
-    help = 'Disparador del Bot'
+    help = 'Worker de navegadores: dueño de todas las sesiones de Chrome y de los bots de WhatsApp Web'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--conexion', type=int, action='append', default=[],
+                            help='ID de conexión cuyo bot se arranca al iniciar (se puede repetir)')
+        parser.add_argument('--todas', action='store_true',
+                            help='Arrancar el bot de todas las conexiones de navegador activas')
+        parser.add_argument('--hilos', type=int, default=4, help='Órdenes del web atendidas en paralelo')
 
     def handle(self, *args, **options):
-        # Callback simple
-        def cerebro(texto, nombre):
-            return f"🤖 Recibido: {texto}"
+        conexiones = list(options['conexion'])
+        if options['todas']:
+            conexiones += WhatsappConnection.objects.filter(
+                is_active=True, phone_number_id__startswith='selenium_'
+            ).values_list('id', flat=True)
+
+        obtener_supervisor().iniciar()
+        for connection_id in dict.fromkeys(conexiones):
+            ejecutar_local(connection_id, 'start')
+            self.stdout.write(f"🚀 Bot de la conexión {connection_id} lanzado.")
 
-        # ESTA FUNCIÓN HACE TODO EL TRABAJO AUTOMÁTICAMENTE
-        iniciar_bucle_bot(cerebro)
\ No newline at end of file
+        worker = BotCommandWorker(num_hilos=options['hilos'])
+        self.stdout.write(self.style.SUCCESS("✅ Worker de navegadores escuchando órdenes del web..."))
+        try:
+            worker.ejecutar()
+        except KeyboardInterrupt:
+            self.stdout.write("\n🛑 Deteniendo worker de navegadores...")
+            worker.detener()
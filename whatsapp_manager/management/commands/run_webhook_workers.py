@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from whatsapp_manager.webhook_queue import obtener_pool
+
+
+class Command(BaseCommand):
+    help = 'Procesa la cola del webhook (WebhookEvent) en un proceso dedicado'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Cantidad de workers (por defecto WHATSAPP_WEBHOOK_WORKERS)')
+
+    def handle(self, *args, **options):
+        pool = obtener_pool(num_workers=options['workers'])
+        pool.iniciar()
+        self.stdout.write(self.style.SUCCESS(f"✅ {pool.num_workers} workers escuchando la cola del webhook..."))
+
+        try:
+            while pool.esta_activo():
+                time.sleep(1)
+        except KeyboardInterrupt:
+            self.stdout.write("\n🛑 Deteniendo workers...")
+            pool.detener()
@@ -0,0 +1,319 @@
+"""
+Descarga de la multimedia recibida por la Cloud API (imagen, audio, video, documento, sticker).
+
+- Streaming a disco en bloques: el archivo nunca está entero en memoria.
+- Límite de tamaño por tipo: se rechaza antes de descargar si Meta declara un file_size mayor,
+  y se corta la descarga si el servidor manda más de lo permitido.
+- Almacenamiento por contenido: la ruta sale del sha256 del archivo
+  (whatsapp_received/ab/<sha256>.jpg), así un sticker o una imagen repetida se guarda una sola vez.
+- Fuera del camino de la petición: las descargas corren en un pool acotado de hilos
+  (DESCARGAS_SIMULTANEAS). Al terminar se guarda la ruta en Message.media_file (relativa a MEDIA_ROOT).
+- Bajo demanda (BAJO_DEMANDA, por defecto): el webhook solo guarda media_id y mime_type, y el
+  archivo se descarga la primera vez que se pide (obtener, vista media_mensaje).
+- Caché en disco con presupuesto (PRESUPUESTO_BYTES): al superarlo se borran los archivos usados
+  hace más tiempo. Solo los que se pueden volver a pedir a Meta (mensajes con media_id); Meta
+  conserva cada media unos 30 días, después un archivo borrado ya no se recupera.
+- Las imágenes que recibe el bot de navegador (image_pipeline) se guardan en el mismo directorio
+  y cuentan en el presupuesto, aunque no se borran (no tienen media_id).
+
+Configuración en settings.WHATSAPP_MEDIA (ver DSI_COM/settings.py).
+"""
+import hashlib
+import logging
+import mimetypes
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from . import http_client
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+SUBDIRECTORIO = 'whatsapp_received'
+
+CONFIG_POR_DEFECTO = {
+    # Bytes máximos por tipo de mensaje (los límites de la Cloud API)
+    'MAX_BYTES': {
+        'image': 5 * 1024 * 1024,
+        'audio': 16 * 1024 * 1024,
+        'video': 16 * 1024 * 1024,
+        'document': 100 * 1024 * 1024,
+        'sticker': 500 * 1024,
+    },
+    'BLOQUE': 64 * 1024,  # bytes por lectura
+    'TIEMPO_MAXIMO': 120,  # segundos por descarga completa
+    'DESCARGAS_SIMULTANEAS': 4,
+    'BAJO_DEMANDA': True,
+    'PRESUPUESTO_BYTES': 2 * 1024 * 1024 * 1024,  # 0 = sin límite
+}
+
+
+class MediaRechazada(Exception):
+    """El archivo supera el límite de su tipo o la descarga tardó demasiado."""
+
+
+def _config():
+    config = {**CONFIG_POR_DEFECTO, **getattr(settings, 'WHATSAPP_MEDIA', {})}
+    config['MAX_BYTES'] = {**CONFIG_POR_DEFECTO['MAX_BYTES'], **config['MAX_BYTES']}
+    return config
+
+
+def ruta_absoluta(relativa):
+    return os.path.join(settings.MEDIA_ROOT, relativa)
+
+
+def _extension(mime_type):
+    # 'audio/ogg; codecs=opus' -> 'audio/ogg'
+    return mimetypes.guess_extension((mime_type or '').split(';')[0].strip()) or '.bin'
+
+
+# --- DESCARGA ---
+
+def descargar(connection, media_id, mime_type, tipo):
+    """
+    Descarga el media_id de Meta y lo guarda por contenido.
+    Retorna la ruta relativa a MEDIA_ROOT, None si Meta no da URL, o lanza MediaRechazada.
+    """
+    from .views import _graph_url
+
+    config = _config()
+    limite = config['MAX_BYTES'].get(tipo, max(config['MAX_BYTES'].values()))
+    headers = {"Authorization": f"Bearer {connection.access_token}"}
+
+    # Paso A: Obtener URL real (Meta informa también el tamaño)
+    resp_info = http_client.get(_graph_url(media_id), headers=headers)
+    resp_info.raise_for_status()
+    info = resp_info.json()
+    media_url = info.get('url')
+    if not media_url:
+        return None
+    if int(info.get('file_size') or 0) > limite:
+        raise MediaRechazada(f"{tipo} de {info['file_size']} bytes (máximo {limite})")
+
+    # Paso B: Descargar en bloques a un temporal del mismo directorio, calculando el hash
+    directorio = ruta_absoluta(SUBDIRECTORIO)
+    os.makedirs(directorio, exist_ok=True)
+    fd, temporal = tempfile.mkstemp(dir=directorio, prefix='.descarga_')
+    try:
+        sha256 = hashlib.sha256()
+        total = 0
+        limite_tiempo = time.monotonic() + config['TIEMPO_MAXIMO']
+        with os.fdopen(fd, 'wb') as f, http_client.get(media_url, headers=headers, stream=True) as resp:
+            resp.raise_for_status()
+            if int(resp.headers.get('Content-Length') or 0) > limite:
+                raise MediaRechazada(f"{tipo} de {resp.headers['Content-Length']} bytes (máximo {limite})")
+            for bloque in resp.iter_content(chunk_size=config['BLOQUE']):
+                total += len(bloque)
+                if total > limite:
+                    raise MediaRechazada(f"{tipo} de más de {limite} bytes")
+                if time.monotonic() > limite_tiempo:
+                    raise MediaRechazada(f"descarga de más de {config['TIEMPO_MAXIMO']}s")
+                sha256.update(bloque)
+                f.write(bloque)
+
+        # Paso C: Mover a su ruta por contenido (si ya existe, es el mismo archivo)
+        digest = sha256.hexdigest()
+        relativa = os.path.join(SUBDIRECTORIO, digest[:2], f"{digest}{_extension(mime_type or info.get('mime_type'))}")
+        destino = ruta_absoluta(relativa)
+        if os.path.exists(destino):
+            os.remove(temporal)
+            _tocar(destino)
+        else:
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            os.replace(temporal, destino)
+            registrar_en_cache(total)
+        return relativa
+    except BaseException:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+
+
+# --- POOL DE DESCARGAS ---
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _obtener_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=_config()['DESCARGAS_SIMULTANEAS'], thread_name_prefix="MediaDescarga"
+            )
+        return _executor
+
+
+def programar(connection, pendientes):
+    """
+    pendientes: [(Message entrante, nodo multimedia de Meta)].
+    Las descargas arrancan al confirmarse la transacción, sin esperar su resultado.
+    En modo BAJO_DEMANDA no se descarga nada: el mensaje ya guarda media_id y mime_type.
+    """
+    if _config()['BAJO_DEMANDA']:
+        return
+    trabajos = [
+        (inbound.id, inbound.msg_type, nodo.get('id'), nodo.get('mime_type'))
+        for inbound, nodo in pendientes if nodo.get('id')
+    ]
+    if not trabajos:
+        return
+
+    def _enviar():
+        executor = _obtener_executor()
+        for trabajo in trabajos:
+            executor.submit(_descargar_mensaje, connection, *trabajo)
+
+    transaction.on_commit(_enviar)
+
+
+def _descargar_mensaje(connection, message_id, tipo, media_id, mime_type):
+    close_old_connections()
+    try:
+        relativa = descargar(connection, media_id, mime_type, tipo)
+        if relativa:
+            mensaje = Message.objects.filter(id=message_id).first()
+            if mensaje:
+                # save() avisa al change feed y al chat en vivo
+                mensaje.media_file = relativa
+                mensaje.save(update_fields=['media_file'])
+    except MediaRechazada as e:
+        logger.warning(f"⚠️ [ID:{connection.id}] Media {media_id} descartada: {e}")
+    except Exception as e:
+        logger.error(f"Error descargando media {media_id}: {e}")
+    finally:
+        close_old_connections()
+
+
+# --- BAJO DEMANDA ---
+
+_en_curso = {}  # media_id -> Lock de su descarga
+_en_curso_lock = threading.Lock()
+_limite_descargas = None
+
+
+def _semaforo():
+    global _limite_descargas
+    with _en_curso_lock:
+        if _limite_descargas is None:
+            _limite_descargas = threading.BoundedSemaphore(_config()['DESCARGAS_SIMULTANEAS'])
+        return _limite_descargas
+
+
+def obtener(mensaje):
+    """
+    Ruta absoluta del archivo del mensaje, descargándolo de Meta si no está en disco.
+    Retorna None si no hay archivo ni media_id; puede lanzar MediaRechazada o errores HTTP.
+    """
+    if mensaje.media_file and os.path.exists(ruta_absoluta(mensaje.media_file)):
+        _tocar(ruta_absoluta(mensaje.media_file))
+        return ruta_absoluta(mensaje.media_file)
+    if not mensaje.media_id:
+        return None
+
+    # Dos pestañas pidiendo el mismo audio: una lo descarga y la otra espera y lo reutiliza
+    with _en_curso_lock:
+        lock = _en_curso.setdefault(mensaje.media_id, threading.Lock())
+    try:
+        with lock:
+            mensaje.refresh_from_db(fields=['media_file'])
+            if mensaje.media_file and os.path.exists(ruta_absoluta(mensaje.media_file)):
+                return ruta_absoluta(mensaje.media_file)
+            with _semaforo():
+                relativa = descargar(mensaje.connection, mensaje.media_id, mensaje.mime_type, mensaje.msg_type)
+            if not relativa:
+                return None
+            # save() avisa al change feed y al chat en vivo
+            mensaje.media_file = relativa
+            mensaje.save(update_fields=['media_file'])
+            return ruta_absoluta(relativa)
+    finally:
+        with _en_curso_lock:
+            if _en_curso.get(mensaje.media_id) is lock:
+                del _en_curso[mensaje.media_id]
+
+
+# --- CACHÉ EN DISCO (LRU) ---
+
+_ocupado = None  # bytes en disco; se calcula recorriendo el directorio la primera vez
+_cache_lock = threading.Lock()
+
+
+def _tocar(ruta):
+    # El mtime marca el último uso (atime no es fiable: muchos discos montan con noatime)
+    try:
+        os.utime(ruta)
+    except OSError:
+        pass
+
+
+def _archivos():
+    """(ruta, bytes, último uso) de cada archivo guardado."""
+    for carpeta, _, nombres in os.walk(ruta_absoluta(SUBDIRECTORIO)):
+        for nombre in nombres:
+            if nombre.startswith('.descarga_') or nombre.endswith('.tmp'):
+                continue  # a medio escribir
+            ruta = os.path.join(carpeta, nombre)
+            try:
+                stat = os.stat(ruta)
+            except FileNotFoundError:
+                continue
+            yield ruta, stat.st_size, stat.st_mtime
+
+
+def registrar_en_cache(nuevos_bytes):
+    """Suma un archivo nuevo guardado en SUBDIRECTORIO (aquí o en image_pipeline) y recorta si hace falta."""
+    global _ocupado
+    presupuesto = _config()['PRESUPUESTO_BYTES']
+    if not presupuesto:
+        return
+    with _cache_lock:
+        if _ocupado is None:
+            _ocupado = sum(tamano for _, tamano, _ in _archivos())
+        else:
+            _ocupado += nuevos_bytes
+        if _ocupado > presupuesto:
+            # Se baja al 90% para no recortar en cada descarga
+            _ocupado = recortar(int(presupuesto * 0.9))
+
+
+def recortar(objetivo):
+    """Borra los archivos usados hace más tiempo hasta quedar en 'objetivo' bytes. Retorna los bytes que quedan."""
+    archivos = sorted(_archivos(), key=lambda a: a[2])
+    total = sum(tamano for _, tamano, _ in archivos)
+    if total <= objetivo:
+        return total
+
+    base = settings.MEDIA_ROOT or os.curdir
+    candidatos = {os.path.relpath(ruta, base): (ruta, tamano) for ruta, tamano, _ in archivos}
+    # Sin media_id no hay forma de volver a pedirlo a Meta: esos archivos no se tocan
+    fijos = set()
+    relativas = list(candidatos)
+    for i in range(0, len(relativas), 500):
+        fijos.update(Message.objects.filter(
+            media_file__in=relativas[i:i + 500], media_id=''
+        ).values_list('media_file', flat=True))
+
+    borrados = 0
+    for relativa, (ruta, tamano) in candidatos.items():
+        if total <= objetivo:
+            break
+        if relativa in fijos:
+            continue
+        try:
+            os.remove(ruta)
+        except FileNotFoundError:
+            pass
+        total -= tamano
+        borrados += 1
+
+    if borrados:
+        logger.info(f"🧹 Caché de multimedia: {borrados} archivos borrados, quedan {total / (1024 * 1024):.0f} MB.")
+    return total
@@ -0,0 +1,40 @@
+# Generated by Django 6.0 on 2026-10-17 17:52
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def eliminar_duplicados(apps, schema_editor):
+    """
+    La comprobación anterior (exists() y luego create()) no era atómica: puede haber filas repetidas
+    del mismo wamid. Se conserva la primera de cada (connection, wa_id) para poder crear el índice único.
+    """
+    Message = apps.get_model('whatsapp_manager', 'Message')
+    # Vacío equivale a "sin wamid": como NULL, no debe chocar con el índice
+    Message.objects.filter(wa_id='').update(wa_id=None)
+
+    repetidos = (
+        Message.objects.filter(wa_id__isnull=False)
+        .values('connection_id', 'wa_id')
+        .annotate(total=Count('id'), primero=Min('id'))
+        .filter(total__gt=1)
+    )
+    for fila in list(repetidos):
+        Message.objects.filter(connection_id=fila['connection_id'], wa_id=fila['wa_id']).exclude(
+            id=fila['primero']
+        ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whatsapp_manager', '0007_webhookevent'),
+    ]
+
+    operations = [
+        migrations.RunPython(eliminar_duplicados, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('connection', 'wa_id'), name='uniq_message_connection_wa_id'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 6.0 on 2026-10-17 18:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def poblar_conversaciones(apps, schema_editor):
+    """Construye el resumen inicial a partir de los mensajes existentes."""
+    Message = apps.get_model('whatsapp_manager', 'Message')
+    Conversation = apps.get_model('whatsapp_manager', 'Conversation')
+
+    resumen = {}
+    for msg in Message.objects.order_by('timestamp', 'id').iterator(chunk_size=2000):
+        clave = (msg.connection_id, msg.phone_number.replace('+', '').strip())
+        conv = resumen.setdefault(clave, {'unread_count': 0})
+        conv.update(
+            last_message=(msg.body or f"[{msg.msg_type}]")[:255],
+            last_direction=msg.direction,
+            last_timestamp=msg.timestamp,
+        )
+
+    Conversation.objects.bulk_create([
+        Conversation(connection_id=connection_id, phone_number=phone, **datos)
+        for (connection_id, phone), datos in resumen.items()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whatsapp_manager', '0008_message_unique_wa_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('phone_number', models.CharField(max_length=20)),
+                ('last_message', models.CharField(blank=True, max_length=255)),
+                ('last_direction', models.CharField(blank=True, max_length=10)),
+                ('last_timestamp', models.DateTimeField()),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('connection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversations', to='whatsapp_manager.whatsappconnection')),
+            ],
+            options={
+                'ordering': ['-last_timestamp'],
+                'indexes': [models.Index(fields=['connection', '-last_timestamp'], name='conversation_inbox_idx')],
+                'constraints': [models.UniqueConstraint(fields=('connection', 'phone_number'), name='uniq_conversation_connection_phone')],
+            },
+        ),
+        migrations.RunPython(poblar_conversaciones, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 6.0 on 2026-10-17 18:20
+
+import re
+
+from django.db import migrations, models
+
+
+def _e164(phone):
+    # Copia de models.normalizar_telefono (las migraciones no deben depender del código actual)
+    valor = (phone or '').strip()
+    digitos = re.sub(r'[\s\-().]', '', valor)
+    if digitos.startswith('+'):
+        digitos = digitos[1:]
+    elif digitos.startswith('00'):
+        digitos = digitos[2:]
+    if digitos.isdigit() and 7 <= len(digitos) <= 15:
+        return f"+{digitos}"
+    return valor
+
+
+def normalizar_telefonos(apps, schema_editor):
+    Message = apps.get_model('whatsapp_manager', 'Message')
+    Conversation = apps.get_model('whatsapp_manager', 'Conversation')
+
+    pendientes = []
+    for msg in Message.objects.only('id', 'phone_number').iterator(chunk_size=2000):
+        normalizado = _e164(msg.phone_number)
+        if normalizado != msg.phone_number:
+            msg.phone_number = normalizado
+            pendientes.append(msg)
+        if len(pendientes) >= 1000:
+            Message.objects.bulk_update(pendientes, ['phone_number'])
+            pendientes = []
+    if pendientes:
+        Message.objects.bulk_update(pendientes, ['phone_number'])
+
+    for conv in Conversation.objects.all():
+        normalizado = _e164(conv.phone_number)
+        if normalizado == conv.phone_number:
+            continue
+        existente = Conversation.objects.filter(connection_id=conv.connection_id, phone_number=normalizado).first()
+        if existente:
+            # Dos variantes del mismo número: nos quedamos con una sola fila
+            existente.unread_count += conv.unread_count
+            if conv.last_timestamp > existente.last_timestamp:
+                existente.last_message = conv.last_message
+                existente.last_direction = conv.last_direction
+                existente.last_timestamp = conv.last_timestamp
+            existente.save()
+            conv.delete()
+        else:
+            conv.phone_number = normalizado
+            conv.save(update_fields=['phone_number'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whatsapp_manager', '0009_conversation'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalizar_telefonos, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['connection', 'phone_number', 'timestamp'], name='message_thread_idx'),
+        ),
+    ]
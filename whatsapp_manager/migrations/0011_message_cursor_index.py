@@ -0,0 +1,17 @@
+# Generated by Django 6.0 on 2026-10-17 18:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whatsapp_manager', '0010_message_thread_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['connection', 'id'], name='message_connection_id_idx'),
+        ),
+    ]
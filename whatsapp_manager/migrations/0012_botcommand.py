@@ -0,0 +1,31 @@
+# Generated by Django 6.0 on 2026-10-17 19:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whatsapp_manager', '0011_message_cursor_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BotCommand',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(choices=[('qr', 'Obtener QR'), ('status', 'Estado'), ('start', 'Iniciar bot'), ('stop', 'Detener bot'), ('send', 'Enviar mensaje')], max_length=10)),
+                ('payload', models.JSONField(blank=True, default=dict)),
+                ('status', models.CharField(choices=[('pending', 'Pendiente'), ('processing', 'Procesando'), ('done', 'Completado'), ('failed', 'Fallido')], default='pending', max_length=10)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+                ('connection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bot_commands', to='whatsapp_manager.whatsappconnection')),
+            ],
+            options={
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['status', 'id'], name='bot_command_status_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 6.0 on 2026-10-17 19:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whatsapp_manager', '0012_botcommand'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='status',
+            field=models.CharField(choices=[('queued', 'En cola'), ('sending', 'Enviando'), ('sent', 'Enviado'), ('failed', 'Fallido')], default='sent', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['status', 'id'], name='message_status_idx'),
+        ),
+    ]
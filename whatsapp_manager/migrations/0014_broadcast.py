@@ -0,0 +1,32 @@
+# Generated by Django 6.0 on 2026-10-17 20:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whatsapp_manager', '0013_message_delivery_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Broadcast',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('body', models.TextField()),
+                ('status', models.CharField(choices=[('loading', 'Cargando destinatarios'), ('sending', 'Enviando'), ('done', 'Terminado'), ('failed', 'Fallido')], default='loading', max_length=10)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('duplicates', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('connection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='broadcasts', to='whatsapp_manager.whatsappconnection')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='broadcast',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='messages', to='whatsapp_manager.broadcast'),
+        ),
+    ]
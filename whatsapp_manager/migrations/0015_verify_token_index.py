@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-17 18:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whatsapp_manager', '0014_broadcast'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='whatsappconnection',
+            name='verify_token',
+            field=models.CharField(db_index=True, default='token_por_defecto', help_text='Token de verificación para configurar en Meta', max_length=100),
+        ),
+    ]
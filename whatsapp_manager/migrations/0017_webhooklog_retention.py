@@ -0,0 +1,22 @@
+# Generated by Django 6.0 on 2026-10-17 18:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whatsapp_manager', '0016_message_delivery_receipts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhooklog',
+            name='kind',
+            field=models.CharField(choices=[('messages', 'Mensajes'), ('statuses', 'Estados'), ('other', 'Otro')], default='other', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='webhooklog',
+            index=models.Index(fields=['created_at'], name='webhooklog_created_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 6.0 on 2026-10-17 18:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whatsapp_manager', '0017_webhooklog_retention'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='media_id',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='mime_type',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
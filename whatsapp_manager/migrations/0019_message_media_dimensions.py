@@ -0,0 +1,28 @@
+# Generated by Django 6.0 on 2026-10-17 18:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whatsapp_manager', '0018_message_media_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='media_height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='media_size',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='media_width',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
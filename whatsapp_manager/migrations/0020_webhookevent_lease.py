@@ -0,0 +1,23 @@
+# Generated by Django 6.0 on 2026-10-17 09:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whatsapp_manager', '0019_message_media_dimensions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookevent',
+            name='claimed_by',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='webhookevent',
+            name='lease_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 6.0 on 2026-10-17 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whatsapp_manager', '0020_webhookevent_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='claimed_by',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 6.0 on 2026-10-17 10:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whatsapp_manager', '0021_message_claim'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['broadcast', 'status'], name='message_broadcast_status_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 6.0 on 2026-10-17 18:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whatsapp_manager', '0022_message_broadcast_status_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingStatus',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('wa_id', models.CharField(max_length=100)),
+                ('status', models.CharField(max_length=10)),
+                ('timestamp', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('connection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pending_statuses', to='whatsapp_manager.whatsappconnection')),
+            ],
+            options={
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['connection', 'wa_id'], name='pending_status_wa_id_idx'), models.Index(fields=['created_at'], name='pending_status_created_idx')],
+            },
+        ),
+    ]
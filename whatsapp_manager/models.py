@@ -1,8 +1,28 @@
+import re
+
 from django.db import models
 
 from api_manager.models import ApiClient
 
 
+def normalizar_telefono(phone):
+    """
+    Normaliza un número a E.164 (+5215555555555).
+    Meta envía los números sin '+'; desde la UI pueden venir con espacios o guiones.
+    Si no es un número (p. ej. el nombre de contacto que ve el bot de navegador) se deja tal cual.
+    """
+    valor = (phone or '').strip()
+    digitos = re.sub(r'[\s\-().]', '', valor)
+    if digitos.startswith('+'):
+        digitos = digitos[1:]
+    elif digitos.startswith('00'):
+        digitos = digitos[2:]
+
+    if digitos.isdigit() and 7 <= len(digitos) <= 15:
+        return f"+{digitos}"
+    return valor
+
+
 class Chatbot(models.Model):
     name = models.CharField(max_length=100, help_text="Nombre interno del bot (ej: Ventas, Soporte)")
     description = models.TextField(blank=True)
@@ -24,35 +44,239 @@ class WhatsappConnection(models.Model):
     chatbot = models.ForeignKey(Chatbot, on_delete=models.SET_NULL, null=True, blank=True, related_name='connections',
                                 help_text="El chatbot que gestionará esta línea")
     # Campo extra de seguridad para el Webhook de Meta
-    verify_token = models.CharField(max_length=100, default='token_por_defecto',
+    verify_token = models.CharField(max_length=100, default='token_por_defecto', db_index=True,
                                     help_text="Token de verificación para configurar en Meta")
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     display_phone_number = models.CharField(max_length=20, blank=True, null=True,
                                             help_text="Número real con código de país (sin +) para generar el enlace wa.me")
 
+    @property
+    def es_browser(self):
+        """Conexión del bot de WhatsApp Web (creada por /api/v1/setup/ con el prefijo 'selenium_')."""
+        return self.phone_number_id.startswith('selenium_')
+
 
 class WebhookLog(models.Model):
+    KIND_CHOICES = [
+        ('messages', 'Mensajes'),
+        ('statuses', 'Estados'),
+        ('other', 'Otro'),
+    ]
+
     created_at = models.DateTimeField(auto_now_add=True)
     payload = models.JSONField()  # Guarda el JSON completo tal cual llega
     headers = models.JSONField(default=dict, blank=True) # Opcional: para ver headers
+    # Para el muestreo y la retención (ver log_retention.py)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, default='other')
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Archivado por antigüedad (manage.py archive_webhook_logs)
+            models.Index(fields=['created_at'], name='webhooklog_created_idx'),
+        ]
 
     def __str__(self):
         return f"Log {self.id} - {self.created_at}"
 
 
+class Broadcast(models.Model):
+    """
+    Envío masivo de un mismo texto a muchos destinatarios (POST /api/v1/broadcast/).
+    Cada destinatario es un Message saliente con broadcast=este; el progreso se cuenta sobre ellos.
+    """
+    STATUS_CHOICES = [
+        ('loading', 'Cargando destinatarios'),
+        ('sending', 'Enviando'),
+        ('done', 'Terminado'),
+        ('failed', 'Fallido'),
+    ]
+
+    connection = models.ForeignKey(WhatsappConnection, on_delete=models.CASCADE, related_name='broadcasts')
+    body = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='loading')
+    total = models.PositiveIntegerField(default=0)
+    duplicates = models.PositiveIntegerField(default=0)  # Destinatarios repetidos, inválidos o sobre el máximo
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Broadcast {self.id} ({self.status}) - Conexión {self.connection_id}"
+
+
 class Message(models.Model):
+    STATUS_CHOICES = [
+        ('queued', 'En cola'),
+        ('sending', 'Enviando'),
+        ('sent', 'Enviado'),
+        ('delivered', 'Entregado'),
+        ('read', 'Leído'),
+        ('failed', 'Fallido'),
+    ]
+
     connection = models.ForeignKey(WhatsappConnection, on_delete=models.CASCADE, related_name='messages')
     wa_id = models.CharField(max_length=100, null=True, blank=True)
     phone_number = models.CharField(max_length=20)  # El número del cliente
     body = models.TextField(blank=True)
     media_file = models.CharField(max_length=255, null=True, blank=True)  # Ruta si es archivo
+    # Multimedia de la Cloud API: se descarga al pedirla (media_store.obtener) si no hay media_file
+    media_id = models.CharField(max_length=100, blank=True)
+    mime_type = models.CharField(max_length=100, blank=True)
+    # Imágenes: dimensiones y bytes del archivo guardado (la miniatura del chat se decide con esto)
+    media_width = models.PositiveIntegerField(null=True, blank=True)
+    media_height = models.PositiveIntegerField(null=True, blank=True)
+    media_size = models.PositiveIntegerField(null=True, blank=True)
     msg_type = models.CharField(max_length=20, default='text')
     direction = models.CharField(max_length=10, choices=[('inbound', 'Entrante'), ('outbound', 'Saliente')])
     timestamp = models.DateTimeField(auto_now_add=True)
+    # Entrega de los salientes (outbound_queue). Los entrantes quedan en 'sent'.
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='sent')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+    # Proceso dueño del envío y su último latido: sin latidos, otro proceso adopta el mensaje
+    claimed_by = models.CharField(max_length=100, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    # Confirmaciones de Meta (webhook 'statuses'), ver delivery_status.py
+    sent_at = models.DateTimeField(null=True, blank=True)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+    read_at = models.DateTimeField(null=True, blank=True)
+    broadcast = models.ForeignKey(Broadcast, on_delete=models.SET_NULL, null=True, blank=True, related_name='messages')
+
+    class Meta:
+        ordering = ['timestamp']
+        indexes = [
+            # Hilo de un contacto: búsqueda exacta + orden cronológico desde el índice
+            models.Index(fields=['connection', 'phone_number', 'timestamp'], name='message_thread_idx'),
+            # Paginación por cursor de la API (/api/v1/messages/)
+            models.Index(fields=['connection', 'id'], name='message_connection_id_idx'),
+            # Recuperación de la cola de salida al arrancar
+            models.Index(fields=['status', 'id'], name='message_status_idx'),
+            # ¿Le quedan mensajes por enviar al broadcast? (cierre al entregar el último)
+            models.Index(fields=['broadcast', 'status'], name='message_broadcast_status_idx'),
+        ]
+        constraints = [
+            # Un wamid solo puede existir una vez por conexión (las salientes sin wa_id quedan en NULL)
+            models.UniqueConstraint(fields=['connection', 'wa_id'], name='uniq_message_connection_wa_id'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.phone_number = normalizar_telefono(self.phone_number)
+        super().save(*args, **kwargs)
+
+class PendingStatus(models.Model):
+    """
+    Estado de entrega de Meta que llegó antes de que se guardara el wamid de su mensaje
+    (el webhook le ganó a la respuesta de la Graph API). Se aplica al guardar el wamid (delivery_status).
+    """
+    connection = models.ForeignKey(WhatsappConnection, on_delete=models.CASCADE, related_name='pending_statuses')
+    wa_id = models.CharField(max_length=100)
+    status = models.CharField(max_length=10)  # sent, delivered, read o failed
+    timestamp = models.DateTimeField(null=True, blank=True)  # Hora que informa Meta
+    error = models.TextField(blank=True)  # Detalle si status es 'failed'
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['connection', 'wa_id'], name='pending_status_wa_id_idx'),
+            models.Index(fields=['created_at'], name='pending_status_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.wa_id} ({self.status}) - Conexión {self.connection_id}"
+
+
+class WebhookEvent(models.Model):
+    """
+    Mensaje entrante pendiente de procesar (cola del webhook).
+    El webhook solo lo persiste y responde 200; los workers de webhook_queue lo consumen.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pendiente'),
+        ('processing', 'Procesando'),
+        ('done', 'Procesado'),
+        ('failed', 'Fallido'),
+    ]
+
+    connection = models.ForeignKey(WhatsappConnection, on_delete=models.CASCADE, related_name='webhook_events')
+    payload = models.JSONField()  # Nodo 'message' tal cual llega de Meta
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    # Proceso que lo está procesando y hasta cuándo; vencido el plazo otro proceso puede retomarlo
+    claimed_by = models.CharField(max_length=100, blank=True)
+    lease_until = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['status', 'connection', 'id'], name='wh_event_status_conn_idx'),
+        ]
+
+    def __str__(self):
+        return f"Evento {self.id} ({self.status}) - Conexión {self.connection_id}"
+
+
+class Conversation(models.Model):
+    """
+    Resumen por contacto para la bandeja del chat.
+    Se mantiene de forma incremental al guardar cada Message (ver conversations.py).
+    """
+    connection = models.ForeignKey(WhatsappConnection, on_delete=models.CASCADE, related_name='conversations')
+    phone_number = models.CharField(max_length=20)  # Número del cliente normalizado
+    last_message = models.CharField(max_length=255, blank=True)  # Vista previa del último mensaje
+    last_direction = models.CharField(max_length=10, blank=True)
+    last_timestamp = models.DateTimeField()
+    unread_count = models.PositiveIntegerField(default=0)
 
     class Meta:
-        ordering = ['timestamp']
\ No newline at end of file
+        ordering = ['-last_timestamp']
+        constraints = [
+            models.UniqueConstraint(fields=['connection', 'phone_number'], name='uniq_conversation_connection_phone'),
+        ]
+        indexes = [
+            models.Index(fields=['connection', '-last_timestamp'], name='conversation_inbox_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.phone_number} ({self.connection_id})"
+
+
+class BotCommand(models.Model):
+    """
+    Orden del proceso web al worker de navegadores (manage.py run_bot_browser).
+    El web la inserta y espera el resultado; el worker la reclama, la ejecuta y guarda 'result'.
+    """
+    ACTION_CHOICES = [
+        ('qr', 'Obtener QR'),
+        ('status', 'Estado'),
+        ('start', 'Iniciar bot'),
+        ('stop', 'Detener bot'),
+        ('send', 'Enviar mensaje'),
+    ]
+    STATUS_CHOICES = [
+        ('pending', 'Pendiente'),
+        ('processing', 'Procesando'),
+        ('done', 'Completado'),
+        ('failed', 'Fallido'),
+    ]
+
+    connection = models.ForeignKey(WhatsappConnection, on_delete=models.CASCADE, related_name='bot_commands')
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    result = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['status', 'id'], name='bot_command_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.action} ({self.status}) - Conexión {self.connection_id}"
@@ -0,0 +1,359 @@
+"""
+Cola de salida de mensajes por conexión (WhatsappConnection).
+
+Quien genera una respuesta (webhook, chat de la UI) ya no llama a Meta ni al navegador:
+guarda el Message en estado 'queued' y lo encola aquí. Cada conexión tiene su propio
+token bucket, así una línea con mucho tráfico no supera el límite de Meta ni frena a las demás.
+
+- Cloud API: varios hilos por conexión. Cada contacto cae siempre en el mismo hilo,
+  así sus mensajes salen en orden aunque la línea envíe en paralelo a distintos contactos.
+- Navegador (WhatsApp Web): un solo hilo; el envío pasa por bot_channel (orden 'send').
+- Fallos transitorios (red, 429, 5xx) se reintentan con backoff; el resto queda en 'failed'.
+  El resultado se escribe en Message.status / Message.error.
+
+Varios procesos: cada mensaje tiene dueño (Message.claimed_by, el proceso que lo encoló) y solo
+ese proceso lo envía. Un hilo de mantenimiento renueva claimed_at de los mensajes propios cada
+PLAZO_RECLAMO / 3 segundos; si un proceso muere, sus mensajes dejan de latir y otro los adopta
+(todos los de una línea en un solo UPDATE, así los recoge un único proceso). Un 'sending' sin
+latidos no se reenvía: pudo haber salido, queda en 'failed'.
+La tasa de cada línea se reparte entre PROCESOS (procesos que envían a la vez).
+"""
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from api_manager.changefeed import registrar_cambios
+
+from . import conversations, delivery_status, live_hub
+from .models import Message, normalizar_telefono
+
+logger = logging.getLogger(__name__)
+
+CONFIG_POR_DEFECTO = {
+    'TASA_API': 20,  # mensajes por segundo por línea (Cloud API)
+    'RAFAGA_API': 40,
+    'CONCURRENCIA_API': 4,  # hilos de envío por línea (Cloud API)
+    'TASA_BROWSER': 0.5,  # WhatsApp Web: un mensaje cada 2s en régimen sostenido
+    'RAFAGA_BROWSER': 3,
+    'MAX_INTENTOS': 4,
+    'BACKOFF': 2,  # segundos; se duplica en cada reintento
+    'PLAZO_RECLAMO': 120,  # segundos sin latido tras los que otro proceso adopta los mensajes
+    'PROCESOS': 1,  # procesos que envían a la vez: cada uno usa TASA / PROCESOS
+}
+
+# Identidad de este proceso como dueño de mensajes salientes
+DUENO = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def _config():
+    return {**CONFIG_POR_DEFECTO, **getattr(settings, 'WHATSAPP_OUTBOUND', {})}
+
+
+class TokenBucket:
+    """Limitador clásico: 'tasa' fichas por segundo, hasta 'capacidad' acumuladas."""
+
+    def __init__(self, tasa, capacidad):
+        self.tasa = float(tasa)
+        self.capacidad = float(capacidad)
+        self._fichas = self.capacidad
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def esperar(self):
+        """Bloquea hasta obtener una ficha."""
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                self._fichas = min(self.capacidad, self._fichas + (ahora - self._ultimo) * self.tasa)
+                self._ultimo = ahora
+                if self._fichas >= 1:
+                    self._fichas -= 1
+                    return
+                faltante = (1 - self._fichas) / self.tasa
+            time.sleep(faltante)
+
+
+class ColaConexion:
+    """Cola de una conexión: N sub-colas (una por hilo) que comparten el token bucket."""
+
+    def __init__(self, connection_id, es_browser, config):
+        self.connection_id = connection_id
+        self.max_intentos = config['MAX_INTENTOS']
+        self.backoff = config['BACKOFF']
+        procesos = max(1, int(config['PROCESOS']))
+        if es_browser:
+            self.bucket = TokenBucket(config['TASA_BROWSER'] / procesos, max(1, config['RAFAGA_BROWSER'] // procesos))
+            num_hilos = 1
+        else:
+            self.bucket = TokenBucket(config['TASA_API'] / procesos, max(1, config['RAFAGA_API'] // procesos))
+            num_hilos = max(1, int(config['CONCURRENCIA_API']))
+        self._colas = [queue.Queue() for _ in range(num_hilos)]
+        for i, cola in enumerate(self._colas):
+            threading.Thread(target=self._bucle, args=(cola,), name=f"Salida_{connection_id}_{i}", daemon=True).start()
+
+    def poner(self, message_id, phone_number, retraso=0, destino=None):
+        """destino: chat del navegador si no coincide con phone_number (solo se conserva en memoria)."""
+        # El mismo contacto siempre en la misma sub-cola: conserva el orden de sus mensajes
+        cola = self._colas[zlib.crc32(phone_number.encode()) % len(self._colas)]
+        if retraso:
+            timer = threading.Timer(retraso, cola.put, args=((message_id, phone_number, destino),))
+            timer.daemon = True
+            timer.start()
+        else:
+            cola.put((message_id, phone_number, destino))
+
+    def _bucle(self, cola):
+        while True:
+            message_id, phone_number, destino = cola.get()
+            self.bucket.esperar()
+            try:
+                self._entregar(message_id, phone_number, destino)
+            except Exception as e:
+                logger.error(f"❌ Error inesperado entregando el mensaje {message_id}: {e}")
+            finally:
+                close_old_connections()
+
+    # --- ENTREGA ---
+
+    def _entregar(self, message_id, phone_number, destino=None):
+        # Reclamo atómico: solo el proceso dueño pasa el mensaje a 'sending', y una sola vez
+        if not Message.objects.filter(id=message_id, status='queued', claimed_by=DUENO).update(
+                status='sending', attempts=F('attempts') + 1, claimed_at=timezone.now()):
+            return
+
+        msg = Message.objects.select_related('connection').get(id=message_id)
+        try:
+            if msg.connection.es_browser:
+                enviado, transitorio, detalle, wa_id = _enviar_browser(msg, destino)
+            else:
+                enviado, transitorio, detalle, wa_id = _enviar_cloud_api(msg)
+        except Exception as e:
+            enviado, transitorio, detalle, wa_id = False, True, str(e), None
+
+        campos = ['status', 'error']
+        msg.error = '' if enviado else detalle[:1000]
+        if enviado:
+            msg.status = 'sent'
+            msg.sent_at = timezone.now()
+            campos.append('sent_at')
+            if wa_id:
+                msg.wa_id = wa_id
+                campos.append('wa_id')
+        elif transitorio and msg.attempts < self.max_intentos:
+            msg.status = 'queued'
+            espera = self.backoff * 2 ** (msg.attempts - 1)
+            logger.warning(f"⏳ Mensaje {msg.id} no enviado ({detalle}). Reintento {msg.attempts} en {espera}s.")
+            self.poner(msg.id, phone_number, retraso=espera, destino=destino)
+        else:
+            msg.status = 'failed'
+            logger.error(f"❌ Mensaje {msg.id} descartado tras {msg.attempts} intento(s): {detalle}")
+
+        # save() (no update) para que el change feed de la API vea el cambio de estado
+        msg.save(update_fields=campos)
+        if 'wa_id' in campos:
+            # Meta pudo avisar 'sent'/'delivered' antes de que tuviéramos el wamid
+            delivery_status.aplicar_pendientes(msg.connection, [msg.wa_id])
+        if msg.broadcast_id and msg.status != 'queued':
+            _cerrar_broadcasts([msg.broadcast_id])
+
+
+def _cerrar_broadcasts(broadcast_ids):
+    from .broadcasts import cerrar_si_termino
+
+    for broadcast_id in set(broadcast_ids):
+        if cerrar_si_termino(broadcast_id):
+            logger.info(f"📣 Broadcast {broadcast_id} terminado.")
+
+
+def _enviar_cloud_api(msg):
+    """Retorna (enviado, transitorio, detalle, wa_id)."""
+    from .views import send_whatsapp_message
+
+    payload = {"messaging_product": "whatsapp", "to": msg.phone_number, "type": "text", "text": {"body": msg.body}}
+    response = send_whatsapp_message(msg.connection, payload)
+    if response is None:
+        return False, True, "Sin respuesta de Meta (error de red)", None
+    if response.ok:
+        try:
+            wa_id = response.json()['messages'][0]['id']
+        except (ValueError, KeyError, IndexError, TypeError):
+            wa_id = None
+        return True, False, '', wa_id
+
+    transitorio = response.status_code == 429 or response.status_code >= 500
+    return False, transitorio, f"HTTP {response.status_code}: {response.text[:500]}", None
+
+
+def _enviar_browser(msg, destino=None):
+    from . import bot_channel
+
+    resultado = bot_channel.ejecutar_comando(
+        msg.connection_id, 'send', {'destino': destino or msg.phone_number, 'mensaje': msg.body}
+    )
+    if resultado.get('enviado'):
+        return True, False, '', None
+    if resultado.get('error') == 'TIMEOUT' and not resultado.get('cancelado'):
+        # El worker ya tomó la orden y puede terminar de enviarla: reintentar duplicaría el mensaje
+        return False, False, "Estado incierto: el navegador no confirmó el envío a tiempo", None
+    # Chat no encontrado, orden cancelada sin ejecutar o navegador ocupado/caído: se puede reintentar
+    return False, True, resultado.get('error') or "El navegador no pudo enviar el mensaje", None
+
+
+# ==============================================================================
+# API DEL MÓDULO
+# ==============================================================================
+
+_colas = {}
+_colas_lock = threading.Lock()
+_mantenimiento = None
+
+
+def _cola(connection):
+    iniciar_mantenimiento()
+    with _colas_lock:
+        cola = _colas.get(connection.id)
+        if cola is None:
+            cola = _colas[connection.id] = ColaConexion(connection.id, connection.es_browser, _config())
+        return cola
+
+
+def encolar_texto(connection, phone_number, body, destino=None):
+    """
+    Crea el Message saliente en estado 'queued' (visible ya en el chat) y lo encola.
+    El envío real ocurre al confirmarse la transacción.
+    destino: chat del navegador cuando phone_number es solo la clave del hilo (nombre truncado).
+    """
+    cola = _cola(connection)
+    msg = Message.objects.create(
+        connection=connection, phone_number=phone_number, body=body, direction='outbound', status='queued',
+        claimed_by=DUENO, claimed_at=timezone.now(),
+    )
+    conversations.registrar_mensaje(msg)
+    transaction.on_commit(lambda: cola.poner(msg.id, msg.phone_number, destino=destino))
+    return msg
+
+
+def encolar_textos(connection, mensajes):
+    """
+    Versión en bloque de encolar_texto: mensajes es una lista de (teléfono, texto).
+    Todas las respuestas de un webhook entran con un único bulk_create.
+    """
+    if not mensajes:
+        return []
+    ahora = timezone.now()
+    with transaction.atomic():
+        creados = Message.objects.bulk_create([
+            # bulk_create no pasa por Message.save(): el teléfono se normaliza aquí
+            Message(connection=connection, phone_number=normalizar_telefono(phone_number), body=body,
+                    direction='outbound', status='queued', claimed_by=DUENO, claimed_at=ahora)
+            for phone_number, body in mensajes
+        ])
+        conversations.registrar_lote(connection.id, creados)
+        registrar_cambios('message', creados)
+        live_hub.publicar_mensajes(creados)
+        encolar_lote(connection, creados)
+    return creados
+
+
+def encolar_lote(connection, mensajes):
+    """
+    Encola Messages 'queued' ya creados en bloque (bulk_create), al confirmarse la transacción.
+    Deben haberse creado con claimed_by=DUENO.
+    """
+    cola = _cola(connection)
+    pendientes = [(m.id, m.phone_number) for m in mensajes]
+
+    def _poner():
+        for message_id, phone_number in pendientes:
+            cola.poner(message_id, phone_number)
+
+    transaction.on_commit(_poner)
+
+
+# --- MANTENIMIENTO: LATIDOS Y ADOPCIÓN DE HUÉRFANOS ---
+
+def iniciar_mantenimiento():
+    """Arranca (una vez por proceso) el hilo que renueva los reclamos propios y adopta huérfanos."""
+    global _mantenimiento
+    with _colas_lock:
+        if _mantenimiento is not None and _mantenimiento.is_alive():
+            return False
+        _mantenimiento = threading.Thread(target=_bucle_mantenimiento, name="SalidaMantenimiento", daemon=True)
+        _mantenimiento.start()
+        return True
+
+
+def _bucle_mantenimiento():
+    plazo = _config()['PLAZO_RECLAMO']
+    while True:
+        try:
+            renovar_reclamos()
+            adoptar_huerfanos(plazo)
+            delivery_status.purgar_pendientes()
+        except Exception as e:
+            logger.error(f"❌ Error en el mantenimiento de la cola de salida: {e}")
+        finally:
+            close_old_connections()
+        time.sleep(plazo / 3)
+
+
+def renovar_reclamos():
+    """Latido: los mensajes de este proceso siguen teniendo dueño vivo."""
+    return Message.objects.filter(claimed_by=DUENO, status__in=('queued', 'sending')).update(
+        claimed_at=timezone.now()
+    )
+
+
+def adoptar_huerfanos(plazo):
+    """
+    Mensajes cuyo dueño dejó de latir hace más de 'plazo' segundos (proceso muerto o colgado).
+    'queued' se adoptan y se encolan aquí; 'sending' pasan a 'failed' porque pudieron haber salido.
+    Retorna la cantidad de mensajes adoptados.
+    """
+    ahora = timezone.now()
+    huerfanos = Q(claimed_at__lt=ahora - timedelta(seconds=plazo)) | Q(claimed_at__isnull=True)
+
+    interrumpidos = list(Message.objects.filter(huerfanos, status='sending').exclude(claimed_by=DUENO))
+    if interrumpidos:
+        for msg in interrumpidos:
+            msg.status, msg.error = 'failed', 'Envío interrumpido: estado incierto'
+        Message.objects.filter(huerfanos, status='sending', id__in=[m.id for m in interrumpidos]).update(
+            status='failed', error='Envío interrumpido: estado incierto'
+        )
+        registrar_cambios('message', interrumpidos)
+        live_hub.publicar_mensajes(interrumpidos)
+        _cerrar_broadcasts([m.broadcast_id for m in interrumpidos if m.broadcast_id])
+        logger.warning(f"⚠️ {len(interrumpidos)} mensajes quedaron a medias en otro proceso; marcados como fallidos.")
+
+    adoptados = 0
+    lineas = set(Message.objects.filter(huerfanos, status='queued').values_list('connection_id', flat=True))
+    for connection_id in lineas:
+        # Un solo UPDATE por línea: todos sus huérfanos pasan a un único proceso (y a un solo token bucket)
+        if not Message.objects.filter(huerfanos, status='queued', connection_id=connection_id).update(
+                claimed_by=DUENO, claimed_at=ahora):
+            continue
+        mensajes = list(
+            Message.objects.filter(connection_id=connection_id, status='queued', claimed_by=DUENO, claimed_at=ahora)
+            .select_related('connection').order_by('id')
+        )
+        if not mensajes:
+            continue
+        cola = _cola(mensajes[0].connection)
+        for msg in mensajes:
+            cola.poner(msg.id, msg.phone_number)
+        adoptados += len(mensajes)
+
+    if adoptados:
+        logger.warning(f"♻️ {adoptados} mensajes salientes adoptados para enviar desde este proceso.")
+    return adoptados
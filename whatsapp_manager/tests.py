@@ -1,3 +1,339 @@
-from django.test import TestCase
+import asyncio
+import gc
+import gzip
+import json
+import os
+import tempfile
+import threading
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+import httpx
+from asgiref.sync import async_to_sync
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from whatsapp_manager import (
+    conversations, dedup, delivery_status, http_client, log_retention, media_store, outbound_queue, views,
+    webhook_queue,
+)
+from whatsapp_manager.models import Conversation, Message, PendingStatus, WebhookEvent, WebhookLog, WhatsappConnection
+
+
+@override_settings(WHATSAPP_WEBHOOK_ASYNC=False)
+class WebhookHiloTests(TestCase):
+    """Un mensaje de la Cloud API tiene que aparecer en el hilo del chat de su contacto."""
+
+    def setUp(self):
+        self.connection = WhatsappConnection.objects.create(
+            name='Línea', access_token='token', phone_number_id='pn-hilo'
+        )
+
+    def _webhook(self, mensajes):
+        body = {
+            'object': 'whatsapp_business_account',
+            'entry': [{'changes': [{'value': {
+                'metadata': {'phone_number_id': 'pn-hilo'},
+                'messages': mensajes,
+            }}]}],
+        }
+        respuesta_ia = mock.AsyncMock(side_effect=lambda connection, texto, phone: f"R: {texto}")
+        with mock.patch.object(views, 'aai_agent_logic', respuesta_ia), \
+                mock.patch('whatsapp_manager.outbound_queue.iniciar_mantenimiento'), \
+                mock.patch('whatsapp_manager.outbound_queue.ColaConexion.poner'):
+            response = self.client.post('/whatsapp/webhook/', json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_webhook_llega_al_historial(self):
+        # Meta manda el número sin '+'; la bandeja (Conversation) lo guarda en E.164
+        self._webhook([{'from': '5215555555555', 'id': 'wamid.hilo.1', 'type': 'text', 'text': {'body': 'hola'}}])
+
+        self.assertTrue(Conversation.objects.filter(connection=self.connection, phone_number='+5215555555555').exists())
+        mensajes, _ = views._pagina_hilo(self.connection, '+5215555555555')
+        self.assertEqual([(m.direction, m.body) for m in mensajes], [('inbound', 'hola'), ('outbound', 'R: hola')])
+
+        respuesta = mensajes[-1]
+        response = self.client.get(
+            f'/whatsapp/chat/{self.connection.id}/historial/', {'phone': '5215555555555', 'antes': respuesta.id}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m['body'] for m in response.json()['messages']], ['hola'])
+
+
+class _Eco(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive: la conexión queda en el pool del cliente
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class ClienteAsyncTests(SimpleTestCase):
+    """arequest no deja un httpx.AsyncClient vivo por cada loop de async_to_sync (WSGI)."""
+
+    def setUp(self):
+        self.servidor = ThreadingHTTPServer(('127.0.0.1', 0), _Eco)
+        threading.Thread(target=self.servidor.serve_forever, daemon=True).start()
+        self.addCleanup(self.servidor.server_close)
+        self.addCleanup(self.servidor.shutdown)
+        self.url = f"http://127.0.0.1:{self.servidor.server_port}/"
+
+    def _clientes_vivos(self):
+        gc.collect()
+        return sum(1 for o in gc.get_objects() if isinstance(o, httpx.AsyncClient) and not o.is_closed)
+
+    def test_llamadas_desde_wsgi_no_acumulan_clientes(self):
+        antes = self._clientes_vivos()
+        for _ in range(5):
+            self.assertEqual(async_to_sync(http_client.aget)(self.url).status_code, 200)
+        self.assertEqual(self._clientes_vivos(), antes)
+
+    def test_loop_del_servidor_reutiliza_un_cliente(self):
+        async def servidor():
+            http_client.registrar_loop_servidor()
+            try:
+                for _ in range(5):
+                    await http_client.aget(self.url)
+                return self._clientes_vivos()
+            finally:
+                await http_client.cerrar_cliente_servidor()
+
+        antes = self._clientes_vivos()
+        self.assertEqual(asyncio.run(servidor()), antes + 1)
+        self.assertEqual(self._clientes_vivos(), antes)
+
+
+class ConversacionLoteTests(TestCase):
+    """registrar_lote cuando otro hilo crea la conversación entre la consulta y el insert."""
+
+    def test_conversacion_creada_por_otro_hilo_recibe_el_lote(self):
+        connection = WhatsappConnection.objects.create(name='Línea', access_token='token', phone_number_id='pn-lote')
+        Conversation.objects.create(
+            connection=connection, phone_number='+5215555555555', unread_count=1, last_message='antes',
+            last_timestamp=timezone.now()
+        )
+        mensajes = [
+            Message(connection=connection, phone_number='+5215555555555', direction='inbound', body=texto,
+                    timestamp=timezone.now())
+            for texto in ('uno', 'dos')
+        ]
+        # La consulta de existentes no la ve, como si se hubiera creado justo después
+        with mock.patch.object(conversations, 'set', return_value=set(), create=True):
+            conversations.registrar_lote(connection.id, mensajes)
+
+        conversacion = Conversation.objects.get(connection=connection)
+        self.assertEqual((conversacion.last_message, conversacion.unread_count), ('dos', 3))
+
+
+class EstadoAdelantadoTests(TestCase):
+    """Un estado de Meta que llega antes de que outbound_queue guarde el wamid no se pierde."""
+
+    def test_estado_se_aplica_al_guardar_el_wamid(self):
+        connection = WhatsappConnection.objects.create(name='Línea', access_token='token', phone_number_id='pn-estado')
+        msg = Message.objects.create(
+            connection=connection, phone_number='+5215555555555', body='hola', direction='outbound',
+            status='queued', claimed_by=outbound_queue.DUENO,
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            actualizadas = delivery_status.registrar_estados(connection, [
+                {'id': 'wamid.adelantado', 'status': 'delivered', 'timestamp': '1790000000'},
+            ])
+        self.assertEqual(actualizadas, 0)
+        self.assertEqual(PendingStatus.objects.count(), 1)
+
+        cola = outbound_queue.ColaConexion(connection.id, False, outbound_queue._config())
+        with mock.patch.object(outbound_queue, '_enviar_cloud_api', return_value=(True, False, '', 'wamid.adelantado')):
+            cola._entregar(msg.id, msg.phone_number)
+
+        msg.refresh_from_db()
+        self.assertEqual((msg.wa_id, msg.status), ('wamid.adelantado', 'delivered'))
+        self.assertIsNotNone(msg.delivered_at)
+        self.assertFalse(PendingStatus.objects.exists())
+
+
+class ColaWebhookReintentoTests(TestCase):
+    """Un evento que falló tras guardar el entrante se reintenta sin perder la respuesta."""
+
+    def setUp(self):
+        self.connection = WhatsappConnection.objects.create(name='Línea', access_token='token', phone_number_id='pn-cola')
+        self.pool = webhook_queue.WebhookWorkerPool(num_workers=1, plazo=300)
+        self.evento = WebhookEvent.objects.create(connection=self.connection, payload={
+            'from': '5215555555555', 'id': 'wamid.cola.1', 'type': 'text', 'text': {'body': 'hola'},
+        })
+        for parche in (
+            mock.patch.object(views, 'ai_agent_logic', lambda connection, texto, phone: f"R: {texto}"),
+            mock.patch('whatsapp_manager.outbound_queue.iniciar_mantenimiento'),
+            mock.patch('whatsapp_manager.outbound_queue.ColaConexion.poner'),
+        ):
+            parche.start()
+            self.addCleanup(parche.stop)
+
+    def _reclamar(self):
+        # Lo que hace _procesar_lote: el objeto conserva attempts previo al reclamo
+        WebhookEvent.objects.filter(id=self.evento.id).update(
+            status='processing', attempts=F('attempts') + 1, claimed_by=self.pool.dueno
+        )
+        evento = WebhookEvent.objects.select_related('connection').get(id=self.evento.id)
+        evento.attempts -= 1
+        return evento
+
+    def test_reintento_responde_al_entrante_ya_guardado(self):
+        with mock.patch.object(views, '_guardar_respuestas', side_effect=RuntimeError('BD caída')):
+            self.assertFalse(self.pool._ejecutar(self._reclamar()))
+        self.assertEqual(Message.objects.filter(direction='inbound').count(), 1)
+        self.assertFalse(Message.objects.filter(direction='outbound').exists())
+
+        self.assertTrue(self.pool._ejecutar(self._reclamar()))
+        self.assertEqual(list(Message.objects.filter(direction='outbound').values_list('body', flat=True)), ['R: hola'])
+        self.assertEqual(WebhookEvent.objects.get(id=self.evento.id).status, 'done')
+
+        # Ya respondido: otro reintento no duplica la respuesta
+        views.process_message(self.connection, self.evento.payload, reintento=True)
+        self.assertEqual(Message.objects.filter(direction='outbound').count(), 1)
+
+    def test_latido_renueva_el_plazo(self):
+        evento = self._reclamar()
+        WebhookEvent.objects.filter(id=evento.id).update(lease_until=timezone.now())
+        self.assertEqual(self.pool.renovar_plazos(), 1)
+        restante = WebhookEvent.objects.get(id=evento.id).lease_until - timezone.now()
+        self.assertGreater(restante.total_seconds(), 290)
+
+
+class DedupTests(TestCase):
+    """Insert-or-ignore por (connection, wa_id): los reintentos de Meta no duplican filas."""
+
+    def setUp(self):
+        self.connection = WhatsappConnection.objects.create(name='Línea', access_token='token', phone_number_id='pn-dedup')
+        parche = mock.patch.object(dedup, 'recientes', dedup.CacheRecientes())
+        parche.start()
+        self.addCleanup(parche.stop)
+
+    def test_mismo_wamid_se_guarda_una_vez(self):
+        primero = dedup.registrar_entrante(self.connection, 'wamid.dup', phone_number='5215555555555', body='hola')
+        self.assertIsNotNone(primero)
+        self.assertIsNone(dedup.registrar_entrante(self.connection, 'wamid.dup', phone_number='5215555555555', body='hola'))
+        self.assertEqual(Message.objects.filter(wa_id='wamid.dup').count(), 1)
+
+    def test_lote_descarta_guardados_y_repetidos(self):
+        dedup.registrar_entrante(self.connection, 'wamid.viejo', phone_number='5215555555555')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            resultado = dedup.registrar_entrantes(self.connection, [
+                {'wa_id': 'wamid.viejo', 'phone_number': '5215555555555'},
+                {'wa_id': 'wamid.nuevo', 'phone_number': '5215555555555'},
+                {'wa_id': 'wamid.nuevo', 'phone_number': '5215555555555'},
+            ])
+
+        self.assertEqual([m and m.wa_id for m in resultado], [None, 'wamid.nuevo', None])
+        self.assertEqual(Message.objects.filter(connection=self.connection).count(), 2)
+        # Confirmado el guardado, el reintento se descarta en memoria, sin consultar la base
+        with self.assertNumQueries(0):
+            self.assertEqual(dedup.filtrar_nuevos(self.connection, [{'id': 'wamid.nuevo'}, {'id': 'wamid.otro'}]),
+                             [{'id': 'wamid.otro'}])
+
+
+class ColaSalidaReintentoTests(TestCase):
+    """Un 429 de Meta devuelve el mensaje a la cola con backoff; agotados los intentos queda en 'failed'."""
+
+    def setUp(self):
+        self.connection = WhatsappConnection.objects.create(name='Línea', access_token='token', phone_number_id='pn-429')
+        self.msg = Message.objects.create(
+            connection=self.connection, phone_number='+5215555555555', body='hola', direction='outbound',
+            status='queued', claimed_by=outbound_queue.DUENO,
+        )
+        self.config = outbound_queue._config()
+        self.cola = outbound_queue.ColaConexion(self.connection.id, False, self.config)
+        limitado = mock.Mock(ok=False, status_code=429, text='Too Many Requests')
+        parche = mock.patch.object(views, 'send_whatsapp_message', return_value=limitado)
+        parche.start()
+        self.addCleanup(parche.stop)
+
+    def test_429_vuelve_a_la_cola_con_backoff(self):
+        with mock.patch.object(self.cola, 'poner') as poner:
+            self.cola._entregar(self.msg.id, self.msg.phone_number)
+
+        self.msg.refresh_from_db()
+        self.assertEqual((self.msg.status, self.msg.attempts), ('queued', 1))
+        self.assertTrue(self.msg.error.startswith('HTTP 429'))
+        poner.assert_called_once_with(self.msg.id, self.msg.phone_number, retraso=self.config['BACKOFF'], destino=None)
+
+    def test_429_en_el_ultimo_intento_queda_fallido(self):
+        Message.objects.filter(id=self.msg.id).update(attempts=self.config['MAX_INTENTOS'] - 1)
+        with mock.patch.object(self.cola, 'poner') as poner:
+            self.cola._entregar(self.msg.id, self.msg.phone_number)
+
+        self.msg.refresh_from_db()
+        self.assertEqual(self.msg.status, 'failed')
+        poner.assert_not_called()
+
+
+class MediaRangoTests(TestCase):
+    """/whatsapp/media/<id>/ responde 206 al Range de audio y video, y 416 si el rango no existe."""
+
+    def setUp(self):
+        connection = WhatsappConnection.objects.create(name='Línea', access_token='token', phone_number_id='pn-media')
+        self.mensaje = Message.objects.create(
+            connection=connection, phone_number='5215555555555', direction='inbound', msg_type='audio', mime_type='audio/ogg'
+        )
+        archivo = tempfile.NamedTemporaryFile(suffix='.ogg', delete=False)
+        archivo.write(bytes(range(100)))
+        archivo.close()
+        self.addCleanup(os.remove, archivo.name)
+        parche = mock.patch.object(media_store, 'obtener', return_value=archivo.name)
+        parche.start()
+        self.addCleanup(parche.stop)
+
+    def _media(self, rango=None):
+        return self.client.get(f'/whatsapp/media/{self.mensaje.id}/', **({'HTTP_RANGE': rango} if rango else {}))
+
+    def test_sin_range_sirve_el_archivo_entero(self):
+        response = self._media()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(b''.join(response.streaming_content), bytes(range(100)))
+
+    def test_range_responde_206_con_el_tramo(self):
+        response = self._media('bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/100')
+        self.assertEqual(b''.join(response.streaming_content), bytes(range(10, 20)))
+
+        response = self._media('bytes=-5')
+        self.assertEqual(response['Content-Range'], 'bytes 95-99/100')
+        self.assertEqual(b''.join(response.streaming_content), bytes(range(95, 100)))
+
+    def test_range_fuera_del_archivo_responde_416(self):
+        response = self._media('bytes=200-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */100')
+
+
+class ArchivoLogsTests(TestCase):
+    """archive_webhook_logs: los logs viejos se escriben en el archivo de su día y se borran por lotes."""
+
+    def test_archiva_y_borra_en_lotes(self):
+        logs = [WebhookLog.objects.create(payload={'n': i}, kind='other') for i in range(5)]
+        hace_10_dias = timezone.now() - timedelta(days=10)
+        WebhookLog.objects.filter(id__in=[log.id for log in logs[:3]]).update(created_at=hace_10_dias)
+        directorio = tempfile.TemporaryDirectory()
+        self.addCleanup(directorio.cleanup)
+
+        # Lotes de 2 sobre 3 filas viejas: (SELECT + DELETE) x 2 y el SELECT vacío que termina
+        with self.assertNumQueries(5):
+            total = log_retention.archivar(dias=7, directorio=directorio.name, lote=2, pausa=0)
+
+        self.assertEqual(total, 3)
+        self.assertEqual(sorted(WebhookLog.objects.values_list('id', flat=True)), [log.id for log in logs[3:]])
+        ruta = os.path.join(directorio.name, f"webhook_log_{hace_10_dias.date().isoformat()}.jsonl.gz")
+        with gzip.open(ruta, 'rt', encoding='utf-8') as f:
+            archivados = [json.loads(linea) for linea in f]
+        self.assertEqual([(fila['id'], fila['payload']) for fila in archivados],
+                         [(log.id, {'n': i}) for i, log in enumerate(logs[:3])])
@@ -8,13 +8,20 @@ urlpatterns = [
     path('qr/<int:connection_id>/', views.generate_qr, name='connection_qr'),
     path('chat/<int:connection_id>/', views.chat_interface, name='chat_interface'),
     path('chat/<int:connection_id>/send/', views.send_message_ui, name='send_message_ui'),
+    path('chat/<int:connection_id>/historial/', views.historial_chat, name='chat_history'),
+    path('chat/<int:connection_id>/stream/', views.stream_chat, name='chat_stream'),
+    path('media/<int:message_id>/', views.media_mensaje, name='message_media'),
+    path('media/<int:message_id>/miniatura/', views.miniatura_mensaje, name='message_thumbnail'),
     path('inspector/', views.webhook_inspector, name='webhook_inspector'),
     path('inspector/api/', views.get_latest_logs, name='api_webhook_logs'),
+    path('inspector/stream/', views.stream_logs, name='webhook_logs_stream'),
     path('simulator/', views.webhook_simulator, name='webhook_simulator'),
     path('browser/vincular/', views.vincular_navegador, name='vincular_navegador'),
     path('iniciar-bot/', views.iniciar_bot_background, name='start_bot'),
     path('estado-bot/', views.estado_bot, name='status_bot'),
     path('browser/debug/', views.debug_browser_html, name='debug_browser_html'),
     path('test-ai/', views.test_ollama_connection, name='test_ollama'),
+    path('http/metricas/', views.metricas_http, name='http_metrics'),
+    path('browser/sesiones/', views.sesiones_navegador, name='browser_sessions'),
 
 ]
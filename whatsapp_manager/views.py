@@ -1,10 +1,16 @@
+import asyncio
 import json
+import re
 import time
 
 from django.conf import settings
 from django.contrib import messages
-from django.http import HttpResponse, JsonResponse
-from django.shortcuts import render, redirect, get_object_or_404
+from django.core.handlers.asgi import ASGIRequest
+from django.core.paginator import Paginator
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.http import FileResponse, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import aget_object_or_404, render, redirect, get_object_or_404
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from rest_framework.permissions import AllowAny
@@ -13,21 +19,18 @@ import logging
 import os
 import mimetypes
 from io import BytesIO
+import httpx
 import requests
 import qrcode
+from asgiref.sync import async_to_sync, sync_to_async
 
 logger = logging.getLogger(__name__)
 from .forms import ConnectionForm
-from .models import WhatsappConnection, WebhookLog, Message
+from .models import WhatsappConnection, WebhookLog, Message, normalizar_telefono
 from django.test import RequestFactory
-import threading
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
-from . import browser_service
-
-# Variable global para controlar que no arranques 2 veces el bot
-bot_thread = None
-
+from . import bot_channel, browser_service, browser_supervisor, connection_registry, conversations, dedup, delivery_status, http_client, live_hub, image_pipeline, log_retention, media_store, outbound_queue, webhook_queue
 
 def cerebro_ia(texto, remitente, adjunto=None):
     """
@@ -56,8 +59,8 @@ def cerebro_ia(texto, remitente, adjunto=None):
         url = "https://datmail.datametric-dsi.com/api/emails/unread/"
 
         try:
-            # Hacemos la petición a la API con un timeout prudente
-            response = requests.get(url, timeout=10)
+            # Hacemos la petición a la API (timeout configurado por host en http_client)
+            response = http_client.get(url)
 
             if response.status_code == 200:
                 data = response.json()
@@ -112,66 +115,141 @@ def cerebro_ia(texto, remitente, adjunto=None):
 
     # 3. FALLBACK (Si todo lo demás falla)
     return f"🤖 (Auto-Reply): Recibí tu mensaje: '{texto}'. (Configura la IA para respuestas más complejas)"
+
+
+# Tipos que reporta el bot de navegador -> msg_type de Message
+TIPOS_ADJUNTO_BROWSER = {'IMAGEN': 'image', 'VIDEO': 'video', 'AUDIO': 'audio', 'DOCUMENTO': 'document'}
+
+
+def _guardar_mensaje_browser(connection_id, contacto, direction, body, msg_type='text', media_file=None, imagen=None):
+    try:
+        imagen = imagen or {}
+        msg = Message.objects.create(
+            connection_id=connection_id,
+            phone_number=contacto,
+            body=body or '',
+            msg_type=msg_type,
+            media_file=media_file,
+            media_width=imagen.get('ancho'),
+            media_height=imagen.get('alto'),
+            media_size=imagen.get('bytes'),
+            direction=direction,
+        )
+        conversations.registrar_mensaje(msg)
+    except Exception as e:
+        logger.error(f"❌ Error guardando mensaje del bot ({connection_id}): {e}")
+
+
+def crear_callback_browser(connection_id):
+    """
+    Envuelve cerebro_ia para el bot de navegador de una conexión:
+    guarda el mensaje recibido en Message (y en la bandeja del chat) y encola la respuesta en
+    outbound_queue, como el resto de las respuestas (límite por línea, reintentos y estado de entrega).
+    Retorna None: el bot no escribe la respuesta por su cuenta.
+    """
+    def callback(texto, nombre, adjunto=None, lote=None, destino=None):
+        # Corre en el pool de IA del bot (hilos de larga vida): descartamos conexiones caducadas
+        close_old_connections()
+        # En WhatsApp Web solo conocemos el nombre visible del contacto
+        contacto = (nombre or 'Desconocido')[:20]
+
+        # 'lote' trae cada mensaje de la ráfaga por separado; la IA recibe el texto ya unido
+        for recibido in lote or [{'texto': texto, 'adjunto': adjunto}]:
+            adj = recibido['adjunto']
+            if adj in TIPOS_ADJUNTO_BROWSER:
+                msg_type, media_file = TIPOS_ADJUNTO_BROWSER[adj], None
+            elif adj:
+                msg_type, media_file = 'image', adj  # Ruta de la imagen ya guardada por el bot
+            else:
+                msg_type, media_file = 'text', None
+
+            _guardar_mensaje_browser(
+                connection_id, contacto, 'inbound', recibido['texto'], msg_type, media_file, recibido.get('imagen')
+            )
+
+        respuesta = cerebro_ia(texto, nombre, adjunto=adjunto)
+        if respuesta:
+            try:
+                connection = WhatsappConnection.objects.get(id=connection_id)
+                outbound_queue.encolar_texto(connection, contacto, respuesta, destino=destino or nombre)
+            except Exception as e:
+                logger.error(f"❌ Error encolando la respuesta del bot ({connection_id}): {e}")
+        return None
+
+    return callback
+
+
+def _connection_id_bot(request):
+    """connection_id de la conexión de navegador (?connection_id= o POST). None si falta o no es válido."""
+    valor = request.POST.get('connection_id') or request.GET.get('connection_id')
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        return None
+
+
 @csrf_exempt
 def iniciar_bot_background(request):
-    global bot_thread
+    connection_id = _connection_id_bot(request)
+    if connection_id is None:
+        return JsonResponse({"status": "error", "mensaje": "connection_id es requerido"}, status=400)
 
-    # 1. Verificar si ya está corriendo para no crear duplicados
-    if bot_thread is not None and bot_thread.is_alive():
-        _lanzar_hilo_bot()
+    # El bot vive donde están los navegadores (este proceso o manage.py run_bot_browser)
+    resultado = bot_channel.ejecutar_comando(connection_id, 'start')
+    if 'error' in resultado:
+        return JsonResponse({
+            "status": "error",
+            "mensaje": f"❌ El worker de navegadores no respondió ({resultado['error']})."
+        }, status=503)
+
+    if not resultado.get('iniciado'):
         return JsonResponse({
             "status": "warning",
             "mensaje": "⚠️ El bot YA está corriendo en segundo plano."
         })
 
-    # 2. Definir la tarea envoltorio
-    def tarea_en_segundo_plano():
-        try:
-            # Esto ejecutará validación -> QR -> Bucle infinito
-            browser_service.iniciar_bucle_bot(cerebro_ia)
-        except Exception as e:
-            print(f"❌ El hilo del bot murió: {e}")
-
-    # 3. Crear y lanzar el Hilo (Subproceso ligero)
-    bot_thread = threading.Thread(target=tarea_en_segundo_plano, name="BotWhatsApp")
-    bot_thread.daemon = True # Si se apaga el servidor, se apaga el bot
-    bot_thread.start()
-
     return JsonResponse({
         "status": "success",
         "mensaje": "🚀 Bot lanzado en segundo plano. Puedes cerrar esta pestaña."
     })
 
 
-def _lanzar_hilo_bot():
-    """Función auxiliar para iniciar el hilo de forma segura"""
-    global bot_thread
-    if bot_thread is not None and bot_thread.is_alive():
-        return False
+def estado_bot(request):
+    """Vista simple para saber si sigue vivo"""
+    connection_id = _connection_id_bot(request)
+    if connection_id is None:
+        return JsonResponse({"error": "connection_id es requerido"}, status=400)
 
-    def tarea_en_segundo_plano():
-        try:
-            browser_service.iniciar_bucle_bot(cerebro_ia)
-        except Exception as e:
-            print(f"❌ El hilo del bot murió: {e}")
+    resultado = bot_channel.ejecutar_comando(connection_id, 'status')
+    return JsonResponse({
+        "bot_corriendo": resultado.get('bot_activo', False),
+        "driver_activo": resultado.get('navegador_abierto', False),
+        "error": resultado.get('error'),
+    })
 
-    bot_thread = threading.Thread(target=tarea_en_segundo_plano, name="BotWhatsApp")
-    bot_thread.daemon = True
-    bot_thread.start()
-    return True
 
-def estado_bot(request):
-    """Vista simple para saber si sigue vivo"""
-    esta_vivo = bot_thread is not None and bot_thread.is_alive()
+def metricas_http(request):
+    """Latencia, tamaño y errores de las llamadas salientes agrupadas por host."""
+    return JsonResponse({"hosts": http_client.obtener_metricas()})
+
+
+def sesiones_navegador(request):
+    """Sesiones de Chrome del bot en este proceso: estado, memoria y CPU."""
     return JsonResponse({
-        "bot_corriendo": esta_vivo,
-        "driver_activo": browser_service.driver_instance is not None
+        "max_navegadores": browser_service.MAX_NAVEGADORES,
+        "abiertos": len(browser_service.navegadores_abiertos()),
+        "sesiones": browser_supervisor.obtener_supervisor().metricas(),
     })
 
-# Configuración de la API de Meta
+# Configuración de la API de Meta (la URL base se cambia con settings.WHATSAPP_GRAPH_API_URL)
 GRAPH_API_VERSION = "v18.0"
 
 
+def _graph_url(ruta):
+    base = getattr(settings, 'WHATSAPP_GRAPH_API_URL', f"https://graph.facebook.com/{GRAPH_API_VERSION}")
+    return f"{base.rstrip('/')}/{ruta}"
+
+
 # ==============================================================================
 # 1. CAPA DE HABILIDADES (HERRAMIENTAS / TOOLS)
 # Aquí definimos las acciones concretas que el "Dispositivo" puede ejecutar.
@@ -207,6 +285,25 @@ def ai_agent_logic(connection, user_text, sender_phone):
     """
     Decide qué herramienta usar o delega a la IA Generativa (Ollama).
     """
+    respuesta, system_role = _resolver_agente(connection, user_text, sender_phone)
+    if respuesta is not None:
+        return respuesta
+    return call_ollama_ai(user_text, system_role)
+
+
+async def aai_agent_logic(connection, user_text, sender_phone):
+    """Versión async de ai_agent_logic (la conexión debe traer el chatbot ya cargado)."""
+    respuesta, system_role = _resolver_agente(connection, user_text, sender_phone)
+    if respuesta is not None:
+        return respuesta
+    return await acall_ollama_ai(user_text, system_role)
+
+
+def _resolver_agente(connection, user_text, sender_phone):
+    """
+    Retorna (respuesta, None) si contesta una herramienta exacta,
+    o (None, system_role) si hay que delegar en la IA generativa.
+    """
     text = user_text.lower().strip()
 
     # Obtenemos el "rol" o personalidad asignada
@@ -225,7 +322,7 @@ def ai_agent_logic(connection, user_text, sender_phone):
         # Prioridad: Herramientas exactas
         if 'precio' in text and ('web' in text or 'api' in text):
             servicio_detectado = 'web' if 'web' in text else 'api'
-            return tool_consultar_precio_servicio(servicio_detectado)
+            return tool_consultar_precio_servicio(servicio_detectado), None
 
     elif bot_slug == 'bot_soporte':
         system_role = (
@@ -235,12 +332,12 @@ def ai_agent_logic(connection, user_text, sender_phone):
         )
         # Prioridad: Herramientas exactas
         if 'ticket' in text:
-            return tool_generar_ticket_soporte(sender_phone, text)
+            return tool_generar_ticket_soporte(sender_phone, text), None
 
     # --- RESPUESTA GENERATIVA (OLLAMA) ---
     # Si no cayó en un IF de herramienta específica, dejamos que Qwen conteste libremente.
 
-    return call_ollama_ai(user_text, system_role)
+    return None, system_role
 # ==============================================================================
 # 3. SERVICIOS AUXILIARES (INFRAESTRUCTURA)
 # ==============================================================================
@@ -248,148 +345,233 @@ def ai_agent_logic(connection, user_text, sender_phone):
 def send_whatsapp_message(connection, payload):
     """
     Envía una carga útil (payload) JSON a la API de WhatsApp Business.
+    Retorna la respuesta de Meta (también si es un error HTTP) o None si no hubo respuesta.
+    Las respuestas normales no llaman aquí directamente: pasan por outbound_queue.
     """
-    url = f"https://graph.facebook.com/{GRAPH_API_VERSION}/{connection.phone_number_id}/messages"
+    url = _graph_url(f"{connection.phone_number_id}/messages")
     headers = {
         "Authorization": f"Bearer {connection.access_token}",
         "Content-Type": "application/json",
     }
 
     try:
-        response = requests.post(url, json=payload, headers=headers)
-        response.raise_for_status()
-        # logger.info(f"Mensaje enviado: {response.json()}")
+        response = http_client.post(url, json=payload, headers=headers)
     except requests.exceptions.RequestException as e:
         logger.error(f"Error enviando mensaje a WhatsApp: {e}")
-        if 'response' in locals() and response is not None:
-            logger.error(f"Detalle respuesta Meta: {response.text}")
+        return None
+
+    if not response.ok:
+        logger.error(f"Error enviando mensaje a WhatsApp: HTTP {response.status_code}")
+        logger.error(f"Detalle respuesta Meta: {response.text}")
+    return response
 
 
-def handle_received_media(connection, media_id, mime_type):
+def handle_received_media(connection, media_id, mime_type, tipo=None):
     """
-    Descarga un archivo multimedia desde los servidores de Meta.
+    Descarga un archivo multimedia desde los servidores de Meta (en streaming, ver media_store).
+    Retorna la ruta relativa a MEDIA_ROOT o None.
     """
-    url_info = f"https://graph.facebook.com/{GRAPH_API_VERSION}/{media_id}"
-    headers = {"Authorization": f"Bearer {connection.access_token}"}
-
     try:
-        # Paso A: Obtener URL real
-        resp_info = requests.get(url_info, headers=headers)
-        resp_info.raise_for_status()
-        media_url = resp_info.json().get('url')
+        return media_store.descargar(connection, media_id, mime_type, tipo)
+    except Exception as e:
+        logger.error(f"Error descargando media {media_id}: {e}")
+        return None
+
 
-        if not media_url:
-            return None
+TIPOS_MEDIA = ('image', 'document', 'audio', 'video', 'sticker')
 
-        # Paso B: Descargar binario
-        media_content = requests.get(media_url, headers=headers)
-        media_content.raise_for_status()
 
-        # Paso C: Guardar
-        extension = mimetypes.guess_extension(mime_type) or '.bin'
-        filename = f"{media_id}{extension}"
-        save_dir = os.path.join(settings.MEDIA_ROOT, 'whatsapp_received')
-        os.makedirs(save_dir, exist_ok=True)
-        full_path = os.path.join(save_dir, filename)
+def process_message(connection, message_data, reintento=False):
+    """
+    Orquestador: Recibe el JSON de Meta, guarda en BD y llama al Agente IA.
+    reintento: el intento anterior falló (cola del webhook); si el entrante ya se había guardado
+    pero su respuesta no, se vuelve a generar.
+    """
+    process_messages(connection, [message_data], reintento=reintento)
 
-        with open(full_path, 'wb') as f:
-            f.write(media_content.content)
 
-        return full_path
-    except Exception as e:
-        logger.error(f"Error descargando media {media_id}: {e}")
-        return None
+def process_messages(connection, messages_list, reintento=False):
+    """
+    Versión por lotes de process_message para todos los mensajes de un cambio del webhook.
+    Los entrantes se guardan con un solo INSERT y las respuestas con otro; la IA corre entre
+    ambos, fuera de toda transacción, y la multimedia se descarga después en segundo plano.
+    """
+    entrantes = _guardar_entrantes(connection, messages_list, reintento)
+    respuestas = [_generar_respuesta(connection, inbound, message_data) for inbound, message_data in entrantes]
+    _guardar_respuestas(connection, entrantes, respuestas)
 
 
-def process_message(connection, message_data):
+async def aprocess_messages(connection, messages_list):
     """
-    Orquestador: Recibe el JSON de Meta, guarda en BD y llama al Agente IA.
+    Versión async de process_messages (webhook bajo ASGI): las llamadas a la IA de todos
+    los mensajes del lote están en vuelo a la vez y no ocupan un hilo mientras esperan.
     """
-    sender_phone = message_data.get('from')
-    msg_type = message_data.get('type')
-    msg_id = message_data.get('id')
-
-    # 1. EVITAR DUPLICADOS
-    if Message.objects.filter(wa_id=msg_id).exists():
-        logger.info(f"Mensaje duplicado ignorado: {msg_id}")
-        return
-
-    reply_payload = None
-
-    # --- A. SI ES TEXTO ---
-    if msg_type == 'text':
-        text_body = message_data['text']['body']
-
-        # Guardar Mensaje Entrante
-        Message.objects.create(
-            connection=connection,
-            wa_id=msg_id,
-            phone_number=sender_phone,
-            body=text_body,
-            msg_type='text',
-            direction='inbound'
-        )
+    entrantes = await sync_to_async(_guardar_entrantes)(connection, messages_list)
+    respuestas = await asyncio.gather(*[
+        _agenerar_respuesta(connection, inbound, message_data) for inbound, message_data in entrantes
+    ])
+    await sync_to_async(_guardar_respuestas)(connection, entrantes, respuestas)
 
-        # >>> LLAMADA AL AGENTE INTELIGENTE <<<
-        response_text = ai_agent_logic(connection, text_body, sender_phone)
-
-        # Preparar Respuesta
-        reply_payload = {
-            "messaging_product": "whatsapp",
-            "to": sender_phone,
-            "type": "text",
-            "text": {"body": response_text}
+
+def _guardar_entrantes(connection, messages_list, reintento=False):
+    """
+    Inserta los entrantes nuevos del lote. Retorna [(Message, nodo de Meta)] sin los duplicados;
+    en un reintento incluye también los ya guardados que se quedaron sin respuesta.
+    """
+    filas = []
+    datos = []
+    for message_data in messages_list:
+        msg_type = message_data.get('type')
+        if msg_type == 'text':
+            body = message_data['text']['body']
+        elif msg_type in TIPOS_MEDIA:
+            body = f"Archivo recibido: {msg_type}"
+        else:
+            continue
+        fila = {
+            'wa_id': message_data.get('id'),
+            'phone_number': message_data.get('from'),
+            'body': body,
+            'msg_type': msg_type,
         }
+        if msg_type in TIPOS_MEDIA:
+            # Con esto basta para descargarlo después (media_store.obtener)
+            fila['media_id'] = message_data[msg_type].get('id') or ''
+            fila['mime_type'] = message_data[msg_type].get('mime_type') or ''
+        filas.append(fila)
+        datos.append(message_data)
+
+    # Insert-or-ignore: los ya existentes son reintentos de Meta
+    with transaction.atomic():
+        entrantes = dedup.registrar_entrantes(connection, filas)
+        conversations.registrar_lote(connection.id, [m for m in entrantes if m])
+
+    sin_respuesta = {}
+    if reintento:
+        duplicados = [fila['wa_id'] for fila, inbound in zip(filas, entrantes) if inbound is None and fila['wa_id']]
+        sin_respuesta = {m.wa_id: m for m in _entrantes_sin_respuesta(connection, duplicados)}
+
+    nuevos = []
+    for inbound, message_data in zip(entrantes, datos):
+        if inbound is None and message_data.get('id') in sin_respuesta:
+            logger.info(f"♻️ Mensaje {message_data['id']} ya guardado pero sin respuesta: se responde de nuevo.")
+            nuevos.append((sin_respuesta[message_data['id']], message_data))
+        elif inbound is None:
+            logger.info(f"Mensaje duplicado ignorado: {message_data.get('id')}")
+        else:
+            nuevos.append((inbound, message_data))
+    return nuevos
 
-    # --- B. SI ES MULTIMEDIA ---
-    elif msg_type in ['image', 'document', 'audio', 'video', 'sticker']:
-        media_node = message_data[msg_type]
-        media_id = media_node.get('id')
-        mime_type = media_node.get('mime_type')
 
-        saved_path = handle_received_media(connection, media_id, mime_type)
+def _entrantes_sin_respuesta(connection, wa_ids):
+    """
+    Entrantes ya guardados sin ningún saliente posterior a su contacto. Las respuestas de un lote
+    se guardan juntas (_guardar_respuestas), así que o están todas o falta la de cada entrante.
+    """
+    if not wa_ids:
+        return []
+    return [
+        inbound for inbound in Message.objects.filter(connection=connection, direction='inbound', wa_id__in=wa_ids)
+        if not Message.objects.filter(
+            connection=connection, direction='outbound', phone_number=inbound.phone_number, id__gt=inbound.id
+        ).exists()
+    ]
+
+
+def _generar_respuesta(connection, inbound, message_data):
+    """Texto de respuesta para un entrante. La multimedia se descarga después, en media_store."""
+    if inbound.msg_type == 'text':
+        # >>> LLAMADA AL AGENTE INTELIGENTE <<<
+        return ai_agent_logic(connection, inbound.body, inbound.phone_number)
 
-        Message.objects.create(
-            connection=connection,
-            wa_id=msg_id,
-            phone_number=sender_phone,
-            body=f"Archivo recibido: {msg_type}",
-            media_file=saved_path,
-            msg_type=msg_type,
-            direction='inbound'
-        )
+    # Respuesta simple para multimedia (se podría mejorar con IA visual)
+    return f"✅ Archivo ({inbound.msg_type}) recibido y procesado por el sistema."
 
-        # Respuesta simple para multimedia (se podría mejorar con IA visual)
-        reply_text = f"✅ Archivo ({msg_type}) recibido y procesado por el sistema."
-        reply_payload = {
-            "messaging_product": "whatsapp",
-            "to": sender_phone,
-            "type": "text",
-            "text": {"body": reply_text}
-        }
 
-    # --- ENVIAR RESPUESTA ---
-    if reply_payload:
-        send_whatsapp_message(connection, reply_payload)
-
-        # Guardar Respuesta Saliente
-        if reply_payload['type'] == 'text':
-            Message.objects.create(
-                connection=connection,
-                phone_number=sender_phone,
-                body=reply_payload['text']['body'],
-                direction='outbound'
-            )
+async def _agenerar_respuesta(connection, inbound, message_data):
+    if inbound.msg_type == 'text':
+        return await aai_agent_logic(connection, inbound.body, inbound.phone_number)
+    return f"✅ Archivo ({inbound.msg_type}) recibido y procesado por el sistema."
+
+
+def _guardar_respuestas(connection, entrantes, respuestas):
+    # Las respuestas se guardan como salientes 'queued'; outbound_queue las envía respetando el límite de la línea
+    with transaction.atomic():
+        outbound_queue.encolar_textos(connection, [
+            (inbound.phone_number, respuesta) for (inbound, _), respuesta in zip(entrantes, respuestas)
+        ])
+        # Las descargas van a su propio pool: un video grande no retrasa la respuesta
+        media_store.programar(connection, [
+            (inbound, message_data[inbound.msg_type]) for inbound, message_data in entrantes
+            if inbound.msg_type in TIPOS_MEDIA
+        ])
 
 
 # ==============================================================================
 # 4. VISTAS WEB (WEBHOOK Y UI)
 # ==============================================================================
 
+def _registrar_webhook(body):
+    """
+    Parte síncrona del webhook: log, eventos de la cola y estados de entrega.
+    Retorna [(conexión, mensajes)] a procesar en línea si WHATSAPP_WEBHOOK_ASYNC está apagado.
+    """
+    # Todo lo que el webhook escribe (log, eventos) va en una sola transacción:
+    # un commit por petición en lugar de uno por fila
+    por_procesar = []
+    with transaction.atomic():
+        # Guardar Log Crudo, según el muestreo (savepoint: si falla no arrastra al resto)
+        try:
+            with transaction.atomic():
+                log_retention.registrar(body)
+        except Exception:
+            pass
+
+        if 'object' in body and body['object'] == 'whatsapp_business_account':
+            estados = {}  # connection_id -> (conexión, statuses)
+            entries = body.get('entry', [])
+
+            for entry in entries:
+                changes = entry.get('changes', [])
+                for change in changes:
+                    value = change.get('value', {})
+                    metadata = value.get('metadata', {})
+                    phone_number_id = metadata.get('phone_number_id')
+
+                    if not phone_number_id:
+                        continue
+
+                    # Buscamos la conexión (Dispositivo) que coincide con el ID (en memoria, con TTL)
+                    connection = connection_registry.registro.por_phone_number_id(phone_number_id)
+
+                    if connection:
+                        # A. Mensajes
+                        messages_list = dedup.filtrar_nuevos(connection, value.get('messages', []))
+                        if getattr(settings, 'WHATSAPP_WEBHOOK_ASYNC', False):
+                            # Solo encolamos: los workers procesan y Meta recibe el 200 al instante
+                            webhook_queue.encolar_mensajes(connection, messages_list)
+                            dedup.recordar(connection, [mensaje.get('id') for mensaje in messages_list])
+                        elif messages_list:
+                            por_procesar.append((connection, messages_list))
+
+                        # B. Estados (se aplican todos juntos al final, por conexión)
+                        if value.get('statuses'):
+                            estados.setdefault(connection.id, (connection, []))[1].extend(value['statuses'])
+                    else:
+                        # AQUÍ ESTABA EL ERROR: AVISAMOS SI NO HAY CONEXIÓN
+                        logger.warning(
+                            f"⚠️ ID Recibido desconocido: {phone_number_id}. No coincide con ninguna conexión activa.")
+
+            for connection, statuses_list in estados.values():
+                delivery_status.registrar_estados(connection, statuses_list)
+    return por_procesar
+
+
 @csrf_exempt
-def webhook(request):
+async def webhook(request):
     """
     Endpoint principal (Puerta de entrada de Meta).
+    Vista async: bajo ASGI las llamadas a la IA no ocupan un hilo; el ORM va por sync_to_async.
     """
     # 1. VERIFICACIÓN (GET)
     if request.method == "GET":
@@ -399,8 +581,7 @@ def webhook(request):
 
         if mode and token:
             if mode == 'subscribe':
-                exists = WhatsappConnection.objects.filter(verify_token=token, is_active=True).exists()
-                if exists:
+                if await sync_to_async(connection_registry.registro.token_valido)(token):
                     return HttpResponse(challenge, status=200)
                 else:
                     return HttpResponse("Token de verificación inválido", status=403)
@@ -411,43 +592,12 @@ def webhook(request):
         try:
             body = json.loads(request.body.decode('utf-8'))
 
-            # Guardar Log Crudo
-            try:
-                WebhookLog.objects.create(payload=body)
-            except Exception:
-                pass
+            # El ORM async no abre transacciones: la escritura en bloque corre en un hilo
+            por_procesar = await sync_to_async(_registrar_webhook)(body)
 
-            if 'object' in body and body['object'] == 'whatsapp_business_account':
-                entries = body.get('entry', [])
-
-                for entry in entries:
-                    changes = entry.get('changes', [])
-                    for change in changes:
-                        value = change.get('value', {})
-                        metadata = value.get('metadata', {})
-                        phone_number_id = metadata.get('phone_number_id')
-
-                        if phone_number_id:
-                            # Buscamos la conexión (Dispositivo) que coincide con el ID
-                            connection = WhatsappConnection.objects.filter(
-                                phone_number_id=phone_number_id,
-                                is_active=True
-                            ).first()
-
-                            if connection:
-                                # A. Mensajes
-                                messages_list = value.get('messages', [])
-                                for message in messages_list:
-                                    process_message(connection, message)
-
-                                # B. Estados
-                                statuses_list = value.get('statuses', [])
-                                for status in statuses_list:
-                                    logger.info(f"Estado recibido: {status.get('status')}")
-                            else:
-                                # AQUÍ ESTABA EL ERROR: AVISAMOS SI NO HAY CONEXIÓN
-                                logger.warning(
-                                    f"⚠️ ID Recibido desconocido: {phone_number_id}. No coincide con ninguna conexión activa.")
+            # Modo síncrono: la IA se llama ya fuera de la transacción
+            for connection, messages_list in por_procesar:
+                await aprocess_messages(connection, messages_list)
 
             return JsonResponse({'status': 'ok'}, status=200)
 
@@ -502,7 +652,7 @@ def webhook_simulator(request):
                 data=payload,
                 content_type='application/json'
             )
-            response = webhook(mock_request)
+            response = async_to_sync(webhook)(mock_request)
 
             if response.status_code == 200:
                 result = {'status': 'success',
@@ -528,11 +678,56 @@ def webhook_inspector(request):
 
 def get_latest_logs(request):
     last_id = request.GET.get('last_id', 0)
-    logs = WebhookLog.objects.filter(id__gt=last_id).order_by('-id')[:20]
+    logs = WebhookLog.objects.filter(id__gt=last_id).only('id', 'created_at', 'payload').order_by('-id')[:20]
     data = [{'id': l.id, 'created_at': l.created_at.strftime("%H:%M:%S"), 'payload': l.payload} for l in logs]
     return JsonResponse({'logs': list(reversed(data))})
 
 
+# --- ACTUALIZACIONES EN VIVO (SSE) ---
+
+def _flujo_sse(request, canal):
+    """
+    Respuesta text/event-stream alimentada por live_hub.
+    Solo bajo ASGI: con WSGI un flujo infinito ocuparía un worker para siempre, así que se
+    responde 204 y la página vuelve al sondeo.
+    """
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+
+    latido = getattr(settings, 'WHATSAPP_LIVE_LATIDO', 15)
+
+    async def eventos():
+        # La suscripción nace con el flujo: si el cliente nunca lo lee, no queda colgada en el hub
+        suscripcion = live_hub.hub.suscribir(canal)
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    tipo, datos = await asyncio.wait_for(suscripcion.cola.get(), timeout=latido)
+                except asyncio.TimeoutError:
+                    # Comentario SSE: mantiene viva la conexión a través de proxies
+                    yield ": ping\n\n"
+                    continue
+                yield f"event: {tipo}\ndata: {datos}\n\n"
+        finally:
+            live_hub.hub.cancelar(suscripcion)
+
+    response = StreamingHttpResponse(eventos(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # nginx: no acumular el flujo
+    return response
+
+
+async def stream_logs(request):
+    """Nuevos WebhookLog en vivo para el inspector. GET /whatsapp/inspector/stream/"""
+    return _flujo_sse(request, live_hub.CANAL_WEBHOOK)
+
+
+async def stream_chat(request, connection_id):
+    """Mensajes y estados de entrega de una conexión en vivo. GET /whatsapp/chat/<id>/stream/"""
+    return _flujo_sse(request, live_hub.canal_chat(connection_id))
+
+
 def dashboard(request):
     connections = WhatsappConnection.objects.all()
     return render(request, 'whatsapp_manager/dashboard.html', {'connections': connections})
@@ -569,40 +764,172 @@ def generate_qr(request, connection_id):
 
 def chat_interface(request, connection_id):
     connection = get_object_or_404(WhatsappConnection, pk=connection_id)
-    all_messages = connection.messages.all().order_by('-timestamp')
-    contacts = {}
-    for msg in all_messages:
-        clean_phone = msg.phone_number.replace('+', '').strip()
-        if clean_phone not in contacts:
-            contacts[clean_phone] = {'phone': clean_phone, 'last_msg': msg.body, 'timestamp': msg.timestamp}
-    conversations = list(contacts.values())
+
+    # Bandeja: una fila por contacto, paginada sobre el índice (connection, -last_timestamp)
+    inbox = connection.conversations.order_by('-last_timestamp', '-id')
+    paginator = Paginator(inbox, getattr(settings, 'WHATSAPP_INBOX_PAGE_SIZE', 50))
+    conversations_page = paginator.get_page(request.GET.get('pagina'))
 
     active_phone = request.GET.get('phone')
     active_messages = []
+    has_older = False
     if active_phone:
-        clean_active = active_phone.replace('+', '').strip()
-        active_messages = connection.messages.filter(phone_number__icontains=clean_active).order_by('timestamp')
+        active_phone = normalizar_telefono(active_phone)
+        # Solo la página más reciente; el resto se pide con "Cargar anteriores" (historial_chat)
+        active_messages, has_older = _pagina_hilo(connection, active_phone)
+        conversations.marcar_leida(connection, active_phone)
 
     return render(request, 'whatsapp_manager/chat.html', {
-        'connection': connection, 'conversations': conversations,
-        'active_phone': active_phone, 'active_messages': active_messages
+        'connection': connection, 'conversations': conversations_page,
+        'active_phone': active_phone, 'active_messages': active_messages, 'has_older': has_older
     })
 
 
-@require_http_methods(["POST"])
-def send_message_ui(request, connection_id):
+def _pagina_hilo(connection, phone, antes_de=None):
+    """
+    Página de un hilo con paginación por cursor (timestamp, id) sobre message_thread_idx.
+    Retorna (mensajes en orden cronológico, hay_mas_antiguos).
+    """
+    page_size = getattr(settings, 'WHATSAPP_THREAD_PAGE_SIZE', 50)
+    qs = connection.messages.filter(phone_number=phone)
+    if antes_de is not None:
+        qs = qs.filter(Q(timestamp__lt=antes_de.timestamp) | Q(timestamp=antes_de.timestamp, id__lt=antes_de.id))
+
+    pagina = list(qs.order_by('-timestamp', '-id')[:page_size + 1])
+    has_older = len(pagina) > page_size
+    return list(reversed(pagina[:page_size])), has_older
+
+
+def historial_chat(request, connection_id):
+    """
+    JSON con los mensajes anteriores a 'antes' (id de mensaje) para el hilo de 'phone'.
+    GET /whatsapp/chat/<id>/historial/?phone=+521...&antes=123
+    """
     connection = get_object_or_404(WhatsappConnection, pk=connection_id)
+    phone = normalizar_telefono(request.GET.get('phone'))
+    antes_id = request.GET.get('antes')
+    if not phone or not antes_id:
+        return JsonResponse({'status': 'error', 'message': 'phone y antes son requeridos'}, status=400)
+
+    cursor = get_object_or_404(Message, pk=antes_id, connection=connection)
+    mensajes, has_older = _pagina_hilo(connection, phone, antes_de=cursor)
+
+    return JsonResponse({
+        'has_older': has_older,
+        'messages': [live_hub.serializar_mensaje(m) for m in mensajes],
+    })
+
+
+RANGO_BYTES = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def media_mensaje(request, message_id):
+    """
+    Sirve el archivo de un mensaje. Si aún no está en disco (modo bajo demanda o caché recortada)
+    se descarga de Meta en este momento. Soporta Range para adelantar audio y video.
+    GET /whatsapp/media/<id>/
+    """
+    mensaje = get_object_or_404(Message.objects.select_related('connection'), pk=message_id)
+    try:
+        ruta = media_store.obtener(mensaje)
+    except media_store.MediaRechazada as e:
+        return HttpResponse(f"Archivo no disponible: {e}", status=413)
+    except Exception as e:
+        logger.error(f"Error obteniendo media del mensaje {message_id}: {e}")
+        return HttpResponse("No se pudo obtener el archivo de Meta", status=502)
+    if not ruta:
+        return HttpResponse("El mensaje no tiene archivo", status=404)
+
+    content_type = (
+        mensaje.mime_type.split(';')[0].strip() or mimetypes.guess_type(ruta)[0] or 'application/octet-stream'
+    )
+    response = _servir_archivo(request, ruta, content_type)
+    # La ruta sale del hash del contenido: el archivo de un mensaje no cambia
+    response['Cache-Control'] = 'private, max-age=86400'
+    return response
+
+
+def miniatura_mensaje(request, message_id):
+    """
+    Miniatura de una imagen para el chat (lado mayor LADO_MINIATURA), generada una sola vez.
+    GET /whatsapp/media/<id>/miniatura/
+    """
+    mensaje = get_object_or_404(
+        Message.objects.select_related('connection'), pk=message_id, msg_type__in=('image', 'sticker')
+    )
+    try:
+        ruta = media_store.obtener(mensaje)
+        if not ruta:
+            return HttpResponse("El mensaje no tiene archivo", status=404)
+        # Con las dimensiones guardadas se sabe si hace falta miniatura sin abrir la imagen
+        if mensaje.media_width and max(mensaje.media_width, mensaje.media_height or 0) <= image_pipeline.LADO_MINIATURA:
+            ruta_min = ruta
+        else:
+            ruta_min = image_pipeline.miniatura(ruta)
+    except media_store.MediaRechazada as e:
+        return HttpResponse(f"Archivo no disponible: {e}", status=413)
+    except Exception as e:
+        logger.error(f"Error generando miniatura del mensaje {message_id}: {e}")
+        return HttpResponse("No se pudo generar la miniatura", status=502)
+
+    content_type = mimetypes.guess_type(ruta_min)[0] or mensaje.mime_type or 'application/octet-stream'
+    response = FileResponse(open(ruta_min, 'rb'), content_type=content_type)
+    response['Cache-Control'] = 'private, max-age=86400'
+    return response
+
+
+def _servir_archivo(request, ruta, content_type):
+    """FileResponse, o 206 con el rango pedido (un solo rango por petición)."""
+    tamano = os.path.getsize(ruta)
+    rango = RANGO_BYTES.match(request.headers.get('Range', '').strip())
+    if not rango or not any(rango.groups()):
+        response = FileResponse(open(ruta, 'rb'), content_type=content_type)
+        response['Accept-Ranges'] = 'bytes'
+        return response
+
+    inicio, fin = rango.groups()
+    if inicio:
+        inicio = int(inicio)
+        fin = min(int(fin), tamano - 1) if fin else tamano - 1
+    else:
+        # 'bytes=-500': los últimos 500 bytes
+        inicio = max(tamano - int(fin), 0)
+        fin = tamano - 1
+    if inicio > fin:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f"bytes */{tamano}"
+        return response
+
+    response = StreamingHttpResponse(_leer_rango(ruta, inicio, fin - inicio + 1), status=206, content_type=content_type)
+    response['Content-Length'] = str(fin - inicio + 1)
+    response['Content-Range'] = f"bytes {inicio}-{fin}/{tamano}"
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def _leer_rango(ruta, inicio, largo, bloque=64 * 1024):
+    with open(ruta, 'rb') as f:
+        f.seek(inicio)
+        while largo > 0:
+            datos = f.read(min(bloque, largo))
+            if not datos:
+                break
+            largo -= len(datos)
+            yield datos
+
+
+@require_http_methods(["POST"])
+async def send_message_ui(request, connection_id):
+    connection = await aget_object_or_404(WhatsappConnection, pk=connection_id)
     try:
         data = json.loads(request.body)
         phone = data.get('phone')
         msg = data.get('message')
         if not phone or not msg: return JsonResponse({'status': 'error'}, status=400)
 
-        payload = {"messaging_product": "whatsapp", "to": phone, "type": "text", "text": {"body": msg}}
-        send_whatsapp_message(connection, payload)
-
-        Message.objects.create(connection=connection, phone_number=phone, body=msg, direction='outbound')
-        return JsonResponse({'status': 'ok'}, status=200)
+        # Cloud API o navegador: lo decide la cola según la conexión
+        outbound = await sync_to_async(outbound_queue.encolar_texto)(connection, phone, msg)
+        return JsonResponse({'status': 'ok', 'id': outbound.id, 'delivery': outbound.status}, status=200)
     except Exception as e:
         return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
 
@@ -612,22 +939,25 @@ def vincular_navegador(request):
     Vista que inicia el navegador backend y muestra el QR al usuario.
     Valida la sesión y transiciona a las respuestas automáticas.
     """
-    global bot_thread
+    connection_id = _connection_id_bot(request)
+    if connection_id is None:
+        return render(request, 'whatsapp_manager/vincular_browser.html', {'estado': 'ERROR', 'qr_image': None})
 
     # 1. INTEGRIDAD: Si el bot ya está corriendo, no tocamos el driver ni pedimos QR.
-    if bot_thread is not None and bot_thread.is_alive():
+    if bot_channel.ejecutar_comando(connection_id, 'status').get('bot_activo'):
         return render(request, 'whatsapp_manager/vincular_browser.html', {
             'estado': 'BOT_ACTIVO',
             'qr_image': None
         })
 
     # 2. Consultamos al servicio (protegido por Lock)
-    qr_image, estado = browser_service.obtener_qr_screenshot()
+    resultado = bot_channel.ejecutar_comando(connection_id, 'qr')
+    qr_image, estado = resultado.get('qr_image'), resultado.get('estado', 'CARGANDO')
 
     # 3. LÓGICA DE TRANSICIÓN: Si detectamos que ya se vinculó, arrancamos el bot.
     if estado == "YA_VINCULADO":
         logger.info("✅ Sesión detectada en la vista. Arrancando bot automáticamente...")
-        _lanzar_hilo_bot()
+        bot_channel.ejecutar_comando(connection_id, 'start', timeout=0)
         # Cambiamos el estado visual para que el usuario sepa que está iniciando
         estado = "INICIANDO_BOT"
 
@@ -653,34 +983,60 @@ DSI_API_URL = "https://dsi-a.datametric-dsi.com/api/chat/"
 PROVIDER_SLUG = "ollama-qwen"
 
 
+def _dsi_api_url():
+    return getattr(settings, 'DSI_API_URL', DSI_API_URL)
+
+
+def _payload_ia(user_text):
+    return {
+        "message": user_text,
+        "provider_slug": PROVIDER_SLUG
+    }
+
+
+def _contenido_ia(result):
+    # Parseamos la respuesta según la estructura:
+    # { "response": { "content": "Texto de respuesta...", ... } }
+    ai_data = result.get('response', {})
+    content = ai_data.get('content', '')
+    return content.strip()
+
+
 def call_ollama_ai(user_text, system_prompt, adjunto=None):
         """
         Envía el prompt a la API REST externa de DSI.
         Nota: 'system_prompt' se recibe por compatibilidad, pero la API usa 'message' y 'provider_slug'.
         """
-        logger.info(f"🔌 Conectando a API Externa en: {DSI_API_URL}")
+        api_url = _dsi_api_url()
+        logger.info(f"🔌 Conectando a API Externa en: {api_url}")
 
         try:
-            payload = {
-                "message": user_text,
-                "provider_slug": PROVIDER_SLUG
-            }
-
-            # Timeout de 30s
-            response = requests.post(DSI_API_URL, json=payload, timeout=30)
+            # Timeout configurado por host (WHATSAPP_HTTP_CLIENT)
+            response = http_client.post(api_url, json=_payload_ia(user_text))
             response.raise_for_status()
+            return _contenido_ia(response.json())
 
-            result = response.json()
+        except requests.exceptions.ConnectionError:
+            error_msg = f"⚠️ Error de Conexión: No puedo conectar con '{api_url}'."
+            logger.error(error_msg)
+            return error_msg
+        except Exception as e:
+            logger.error(f"❌ Error en API IA: {e}")
+            return f"⚠️ Error externo IA: {str(e)}"
 
-            # Parseamos la respuesta según la estructura:
-            # { "response": { "content": "Texto de respuesta...", ... } }
-            ai_data = result.get('response', {})
-            content = ai_data.get('content', '')
 
-            return content.strip()
+async def acall_ollama_ai(user_text, system_prompt, adjunto=None):
+        """Versión async de call_ollama_ai: no ocupa un hilo mientras la IA responde."""
+        api_url = _dsi_api_url()
+        logger.info(f"🔌 Conectando a API Externa en: {api_url}")
 
-        except requests.exceptions.ConnectionError:
-            error_msg = f"⚠️ Error de Conexión: No puedo conectar con '{DSI_API_URL}'."
+        try:
+            response = await http_client.apost(api_url, json=_payload_ia(user_text))
+            response.raise_for_status()
+            return _contenido_ia(response.json())
+
+        except httpx.ConnectError:
+            error_msg = f"⚠️ Error de Conexión: No puedo conectar con '{api_url}'."
             logger.error(error_msg)
             return error_msg
         except Exception as e:
@@ -688,12 +1044,12 @@ def call_ollama_ai(user_text, system_prompt, adjunto=None):
             return f"⚠️ Error externo IA: {str(e)}"
 
 
-def test_ollama_connection(request):
+async def test_ollama_connection(request):
         """
         Vista visual para probar la conexión con la API REST sin usar WhatsApp.
         """
         context = {
-            'api_url': DSI_API_URL,
+            'api_url': _dsi_api_url(),
             'model': PROVIDER_SLUG,
             'response': None,
             'duration': 0,
@@ -705,7 +1061,7 @@ def test_ollama_connection(request):
             start_time = time.time()
 
             # Llamada real (el system_prompt se ignora en la nueva implementación pero se mantiene la firma)
-            respuesta = call_ollama_ai(prompt, "Eres un asistente de pruebas conciso.")
+            respuesta = await acall_ollama_ai(prompt, "Eres un asistente de pruebas conciso.")
 
             end_time = time.time()
             context['duration'] = str(round(end_time - start_time, 2))
@@ -0,0 +1,256 @@
+"""
+Cola de procesamiento para los mensajes que llegan por el webhook de Meta.
+
+El webhook solo valida, guarda cada mensaje como WebhookEvent y responde 200 al instante.
+Un pool de workers en segundo plano consume la tabla y ejecuta process_message
+(descarga de media, IA, respuesta) con concurrencia acotada.
+
+Orden por conexión: cada conexión se asigna siempre al mismo worker (connection_id % N)
+y ese worker procesa sus eventos uno a uno por orden de id. Entre procesos (varios web,
+run_webhook_workers) el orden se mantiene porque un evento no se toma mientras otro anterior
+de la misma conexión siga en proceso con su plazo vigente.
+
+Reclamo con dueño y plazo: cada evento en proceso guarda qué proceso lo tiene (claimed_by) y hasta
+cuándo (lease_until, WHATSAPP_WEBHOOK_LEASE). Un hilo de latido renueva el plazo de los eventos
+propios cada WHATSAPP_WEBHOOK_LEASE / 3 segundos, así una llamada larga a la IA no lo deja vencer.
+Solo se recuperan los eventos con el plazo vencido (su proceso murió); los que otro proceso está
+atendiendo no se tocan.
+
+Reintentos: si un intento falló después de guardar el entrante, el siguiente lo encuentra duplicado;
+process_message(reintento=True) vuelve a generar la respuesta si no llegó a guardarse.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q, Value
+from django.db.models.functions import Mod
+from django.utils import timezone
+
+from .models import WebhookEvent
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookWorkerPool:
+    """
+    Pool de hilos que consume WebhookEvent pendientes.
+    Puede vivir dentro del proceso web o en un proceso aparte (manage.py run_webhook_workers).
+    """
+
+    def __init__(self, num_workers=4, max_intentos=3, intervalo_sondeo=2.0, tamano_lote=20, plazo=300):
+        self.num_workers = max(1, int(num_workers))
+        self.max_intentos = max_intentos
+        self.intervalo_sondeo = intervalo_sondeo
+        self.tamano_lote = tamano_lote
+        self.plazo = timedelta(seconds=plazo)
+        self.dueno = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._avisos = [threading.Event() for _ in range(self.num_workers)]
+        self._detener = threading.Event()
+        self._hilos = []
+        self._lock = threading.Lock()
+
+    def esta_activo(self):
+        return any(t.is_alive() for t in self._hilos)
+
+    def iniciar(self):
+        with self._lock:
+            if self.esta_activo():
+                return False
+
+            # Los eventos que quedaron a medias se retoman solos al vencer su plazo (_procesar_lote)
+            self._detener.clear()
+            self._hilos = []
+            for shard in range(self.num_workers):
+                t = threading.Thread(target=self._bucle, args=(shard,), name=f"WebhookWorker_{shard}", daemon=True)
+                t.start()
+                self._hilos.append(t)
+            threading.Thread(target=self._bucle_latido, name="WebhookLatido", daemon=True).start()
+
+            logger.info(f"🚀 Pool de webhook iniciado con {self.num_workers} workers.")
+            return True
+
+    def detener(self):
+        self._detener.set()
+        for aviso in self._avisos:
+            aviso.set()
+
+    def notificar(self, connection_id):
+        """Despierta al worker dueño de la conexión sin esperar al siguiente sondeo."""
+        self._avisos[connection_id % self.num_workers].set()
+
+    # --- BUCLE DE CADA WORKER ---
+
+    def _bucle(self, shard):
+        aviso = self._avisos[shard]
+        while not self._detener.is_set():
+            procesados = 0
+            try:
+                procesados = self._procesar_lote(shard)
+            except Exception as e:
+                logger.error(f"❌ Worker webhook {shard} falló leyendo la cola: {e}")
+            finally:
+                close_old_connections()
+
+            if procesados:
+                continue
+
+            aviso.wait(self.intervalo_sondeo)
+            aviso.clear()
+
+    def _bucle_latido(self):
+        while not self._detener.wait(self.plazo.total_seconds() / 3):
+            try:
+                self.renovar_plazos()
+            except Exception as e:
+                logger.error(f"❌ Error renovando el plazo de los eventos del webhook: {e}")
+            finally:
+                close_old_connections()
+
+    def renovar_plazos(self):
+        """Latido: los eventos que este proceso tiene en curso siguen siendo suyos."""
+        return WebhookEvent.objects.filter(claimed_by=self.dueno, status='processing').update(
+            lease_until=timezone.now() + self.plazo
+        )
+
+    def _disponibles(self, ahora):
+        """Pendientes, o en proceso con el plazo vencido (su proceso murió o se colgó)."""
+        return Q(status='pending') | Q(status='processing', lease_until__lt=ahora) | Q(
+            status='processing', lease_until__isnull=True
+        )
+
+    def _procesar_lote(self, shard):
+        ahora = timezone.now()
+        eventos = list(
+            WebhookEvent.objects
+            .filter(self._disponibles(ahora))
+            .annotate(shard=Mod('connection_id', Value(self.num_workers)))
+            .filter(shard=shard)
+            .select_related('connection', 'connection__chatbot')
+            .order_by('id')[:self.tamano_lote]
+        )
+
+        procesados = 0
+        bloqueadas = set()  # conexiones con un evento anterior en manos de otro proceso
+        for evento in eventos:
+            if self._detener.is_set():
+                break
+            if evento.connection_id in bloqueadas:
+                continue
+
+            ahora = timezone.now()
+            if evento.status == 'processing' and evento.attempts >= self.max_intentos:
+                # Abandonado con los intentos agotados: no se vuelve a ejecutar
+                WebhookEvent.objects.filter(id=evento.id, claimed_by=evento.claimed_by).filter(
+                    self._disponibles(ahora)
+                ).update(status='failed', last_error='Plazo vencido sin terminar', processed_at=ahora)
+                logger.warning(f"⚠️ Evento {evento.id} abandonado por su proceso; intentos agotados.")
+                continue
+
+            # Otro proceso tiene en curso un evento anterior de la conexión: esperamos a que termine
+            en_curso = WebhookEvent.objects.filter(
+                connection_id=evento.connection_id, id__lt=evento.id, status='processing', lease_until__gte=ahora
+            ).exists()
+            if en_curso:
+                bloqueadas.add(evento.connection_id)
+                continue
+
+            # Reclamamos el evento de forma atómica (otro proceso podría estar leyendo la misma tabla)
+            reclamado = WebhookEvent.objects.filter(id=evento.id).filter(self._disponibles(ahora)).update(
+                status='processing', attempts=F('attempts') + 1, claimed_by=self.dueno, lease_until=ahora + self.plazo
+            )
+            if not reclamado:
+                bloqueadas.add(evento.connection_id)
+                continue
+
+            if not self._ejecutar(evento):
+                # Cortamos el lote para no adelantar mensajes posteriores de la misma conexión
+                time.sleep(min(self.intervalo_sondeo * (evento.attempts + 1), 30))
+                break
+            procesados += 1
+
+        return procesados
+
+    def _ejecutar(self, evento):
+        from .views import process_message
+
+        try:
+            # attempts es el valor previo al reclamo: > 0 si un intento anterior no terminó
+            process_message(evento.connection, evento.payload, reintento=evento.attempts > 0)
+        except Exception as e:
+            intentos = evento.attempts + 1
+            agotado = intentos >= self.max_intentos
+            logger.error(f"❌ Error procesando evento {evento.id} (intento {intentos}): {e}")
+            WebhookEvent.objects.filter(id=evento.id, claimed_by=self.dueno).update(
+                status='failed' if agotado else 'pending',
+                last_error=str(e),
+                processed_at=timezone.now() if agotado else None,
+                claimed_by='',
+                lease_until=None,
+            )
+            # Si ya no se reintenta, el siguiente mensaje de la conexión puede continuar
+            return agotado
+
+        # Condicionado al dueño: si el plazo venció y otro proceso lo retomó, ese decide el estado
+        WebhookEvent.objects.filter(id=evento.id, claimed_by=self.dueno).update(
+            status='done', processed_at=timezone.now(), lease_until=None
+        )
+        return True
+
+
+# --- INSTANCIA DEL PROCESO ---
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def obtener_pool(num_workers=None):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = WebhookWorkerPool(
+                num_workers=num_workers or getattr(settings, 'WHATSAPP_WEBHOOK_WORKERS', 4),
+                max_intentos=getattr(settings, 'WHATSAPP_WEBHOOK_MAX_INTENTOS', 3),
+                intervalo_sondeo=getattr(settings, 'WHATSAPP_WEBHOOK_INTERVALO_SONDEO', 2.0),
+                plazo=getattr(settings, 'WHATSAPP_WEBHOOK_LEASE', 300),
+            )
+        return _pool
+
+
+def iniciar_en_proceso():
+    """
+    Arranca el pool al levantar el servidor (wsgi.py / asgi.py) para vaciar lo que quedó pendiente
+    sin esperar al siguiente mensaje. No hace nada si los workers corren aparte.
+    """
+    if not getattr(settings, 'WHATSAPP_WEBHOOK_ASYNC', False):
+        return False
+    if not getattr(settings, 'WHATSAPP_WEBHOOK_WORKERS_EN_PROCESO', True):
+        return False
+    return obtener_pool().iniciar()
+
+
+def encolar_mensajes(connection, mensajes):
+    """
+    Persiste los mensajes de un cambio del webhook y avisa al worker de la conexión.
+    Retorna la cantidad de eventos encolados.
+    """
+    if not mensajes:
+        return 0
+
+    WebhookEvent.objects.bulk_create([
+        WebhookEvent(connection=connection, payload=mensaje) for mensaje in mensajes
+    ])
+
+    pool = obtener_pool()
+    if getattr(settings, 'WHATSAPP_WEBHOOK_WORKERS_EN_PROCESO', True) and not pool.esta_activo():
+        pool.iniciar()
+
+    # Solo avisamos cuando los eventos ya son visibles para los workers
+    transaction.on_commit(lambda: pool.notificar(connection.id))
+    return len(mensajes)